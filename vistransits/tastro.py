@@ -0,0 +1,208 @@
+import numpy as np
+
+# Low-precision vectorised positional astronomy used by the fast paths
+# in tephem. All angles are in radians and all times are Julian dates
+# (UT) unless stated otherwise. Accuracies are roughly 0.01deg for the
+# Sun, 0.3deg for the Moon and a few arcsec for the fixed targets, which
+# is plenty for altitude thresholds and the rounded values that appear
+# in the tephem output files.
+
+JD2000 = 2451545.0 # julian date of the J2000.0 epoch
+PYEPHEM_JD0 = 2415020.0 # julian date of the pyephem zero date
+RADIUS_EARTH_KM = 6378.14 # equatorial radius of the earth in km
+AU_KM = 1.49598e8 # astronomical unit in km
+
+
+def pyephem2jd( date ):
+    """
+    Converts pyephem date float(s) to Julian date(s).
+    """
+    return np.asarray( date, dtype=float ) + PYEPHEM_JD0
+
+
+def gmst( jd ):
+    """
+    Greenwich mean sidereal time (radians) for Julian date(s) jd
+    using the expression in Meeus (1998) Eq 12.4.
+    """
+    jd = np.asarray( jd, dtype=float )
+    T = ( jd - JD2000 ) / 36525.
+    theta = 280.46061837 + 360.98564736629*( jd - JD2000 ) \
+            + 0.000387933*( T**2. ) - ( T**3. )/38710000.
+    return np.deg2rad( np.mod( theta, 360. ) )
+
+
+def precess( ra, dec, jd ):
+    """
+    Precesses J2000 coordinates to the mean equinox of date using
+    the rigorous zeta/z/theta formulation (Meeus 1998 Eq 21.3).
+    Nutation and aberration are neglected.
+    """
+    T = ( np.asarray( jd, dtype=float ) - JD2000 ) / 36525.
+    arcsec = np.pi / 180. / 3600.
+    zeta = ( 2306.2181*T + 0.30188*( T**2. ) + 0.017998*( T**3. ) ) * arcsec
+    z = ( 2306.2181*T + 1.09468*( T**2. ) + 0.018203*( T**3. ) ) * arcsec
+    theta = ( 2004.3109*T - 0.42665*( T**2. ) - 0.041833*( T**3. ) ) * arcsec
+    A = np.cos( dec ) * np.sin( ra + zeta )
+    B = np.cos( theta ) * np.cos( dec ) * np.cos( ra + zeta ) - np.sin( theta ) * np.sin( dec )
+    C = np.sin( theta ) * np.cos( dec ) * np.cos( ra + zeta ) + np.cos( theta ) * np.sin( dec )
+    ra_date = np.mod( np.arctan2( A, B ) + z, 2*np.pi )
+    dec_date = np.arcsin( np.clip( C, -1, 1 ) )
+    return ra_date, dec_date
+
+
+def altaz( ra, dec, jd, lat, lon ):
+    """
+    Geometric altitude and azimuth (measured from North through
+    East) of objects with equatorial coordinates ra, dec at Julian
+    date(s) jd, for an observer at latitude lat and East longitude lon.
+    """
+    ha = gmst( jd ) + lon - ra
+    sinalt = np.sin( lat ) * np.sin( dec ) + np.cos( lat ) * np.cos( dec ) * np.cos( ha )
+    alt = np.arcsin( np.clip( sinalt, -1, 1 ) )
+    az = np.arctan2( -np.cos( dec ) * np.sin( ha ), \
+                     np.sin( dec ) * np.cos( lat ) - np.cos( dec ) * np.sin( lat ) * np.cos( ha ) )
+    az = np.mod( az, 2*np.pi )
+    return alt, az
+
+
+def max_altitude( dec, lat ):
+    """
+    Geometric altitude of objects with declination dec as they cross
+    the meridian, which is the highest they get for an observer at
+    latitude lat.
+    """
+    return np.pi/2. - np.abs( lat - dec )
+
+
+def refraction( alt, pressure=1010., temp=15. ):
+    """
+    Atmospheric refraction (radians) to be added to a geometric altitude,
+    for the given pressure (mbar) and temperature (Celsius). This mirrors
+    the refraction model used by libastro (and hence pyephem), including
+    the secant-method inversion of unrefraction().
+    """
+    ta = np.asarray( alt, dtype=float )
+    t = ta - unrefraction( ta, pressure=pressure, temp=temp )
+    d = 0.8*( ta - t )
+    t0 = t
+    aa = ta.copy()
+    for i in range( 20 ):
+        aa = aa + d
+        t = aa - unrefraction( aa, pressure=pressure, temp=temp )
+        dt = t0 - t
+        d = np.where( dt!=0, -d*( ta - t )/np.where( dt!=0, dt, 1 ), 0 )
+        t0 = t
+        if np.all( np.abs( ta - t )<=np.deg2rad( 0.1/3600. ) ):
+            break
+    return aa - ta
+
+
+def unrefraction( aa, pressure=1010., temp=15. ):
+    """
+    Atmospheric refraction (radians) to be subtracted from an apparent
+    altitude aa to give the geometric altitude. The formulae used above
+    and below 15deg are blended linearly between 14.5deg and 15.5deg,
+    following libastro.
+    """
+    aadeg = np.rad2deg( aa )
+    r_lt15 = ( pressure*( .1594 + .0196*aadeg + .00002*aadeg**2. ) ) \
+             / ( ( 273 + temp )*( 1. + .505*aadeg + .0845*aadeg**2. ) )
+    r_lt15 = np.deg2rad( np.maximum( r_lt15, 0 ) )
+    r_ge15 = 7.888888e-5*pressure / ( ( 273 + temp )*np.tan( np.clip( aa, np.deg2rad( 14. ), np.pi/2. ) ) )
+    w = np.clip( aadeg - 14.5, 0, 1 )
+    return ( 1 - w )*r_lt15 + w*r_ge15
+
+
+def sun_radec( jd ):
+    """
+    Apparent right ascension, declination and distance (AU) of the
+    Sun using the low-precision formulae of the Astronomical Almanac.
+    """
+    n = np.asarray( jd, dtype=float ) - JD2000
+    L = np.deg2rad( np.mod( 280.460 + 0.9856474*n, 360. ) )
+    g = np.deg2rad( np.mod( 357.528 + 0.9856003*n, 360. ) )
+    lam = L + np.deg2rad( 1.915*np.sin( g ) + 0.020*np.sin( 2*g ) )
+    eps = np.deg2rad( 23.439 - 0.0000004*n )
+    ra = np.mod( np.arctan2( np.cos( eps ) * np.sin( lam ), np.cos( lam ) ), 2*np.pi )
+    dec = np.arcsin( np.sin( eps ) * np.sin( lam ) )
+    dist = 1.00014 - 0.01671*np.cos( g ) - 0.00014*np.cos( 2*g )
+    return ra, dec, dist
+
+
+def moon_radec( jd ):
+    """
+    Geocentric right ascension, declination and horizontal parallax
+    of the Moon using the low-precision formulae of the Astronomical
+    Almanac.
+    """
+    T = ( np.asarray( jd, dtype=float ) - JD2000 ) / 36525.
+    s = lambda a, b: np.sin( np.deg2rad( a + b*T ) )
+    c = lambda a, b: np.cos( np.deg2rad( a + b*T ) )
+    lam = 218.32 + 481267.881*T \
+          + 6.29*s( 135.0, 477198.87 ) - 1.27*s( 259.3, -413335.36 ) \
+          + 0.66*s( 235.7, 890534.22 ) + 0.21*s( 269.9, 954397.74 ) \
+          - 0.19*s( 357.5, 35999.05 ) - 0.11*s( 186.5, 966404.03 )
+    beta = 5.13*s( 93.3, 483202.02 ) + 0.28*s( 228.2, 960400.89 ) \
+           - 0.28*s( 318.3, 6003.15 ) - 0.17*s( 217.6, -407332.21 )
+    hp = 0.9508 + 0.0518*c( 135.0, 477198.87 ) + 0.0095*c( 259.3, -413335.36 ) \
+         + 0.0078*c( 235.7, 890534.22 ) + 0.0028*c( 269.9, 954397.74 )
+    lam = np.deg2rad( np.mod( lam, 360. ) )
+    beta = np.deg2rad( beta )
+    eps = np.deg2rad( 23.439 - 0.013*T )
+    ra = np.arctan2( np.sin( lam ) * np.cos( eps ) - np.tan( beta ) * np.sin( eps ), np.cos( lam ) )
+    ra = np.mod( ra, 2*np.pi )
+    dec = np.arcsin( np.sin( beta ) * np.cos( eps ) + np.cos( beta ) * np.sin( eps ) * np.sin( lam ) )
+    return ra, dec, np.deg2rad( hp )
+
+
+def moon_phase( jd ):
+    """
+    Percentage of the lunar disc that is illuminated, following
+    Meeus (1998) Chapter 48.
+    """
+    ra_s, dec_s, dist_s = sun_radec( jd )
+    ra_m, dec_m, hp = moon_radec( jd )
+    psi = separation( ra_s, dec_s, ra_m, dec_m )
+    dist_m = RADIUS_EARTH_KM / np.sin( hp )
+    i = np.arctan2( dist_s*AU_KM*np.sin( psi ), dist_m - dist_s*AU_KM*np.cos( psi ) )
+    return 100. * ( 1 + np.cos( i ) ) / 2.
+
+
+def sun_altaz( jd, lat, lon, pressure=1010., temp=15. ):
+    """
+    Apparent altitude and azimuth of the Sun.
+    """
+    ra, dec, dist = sun_radec( jd )
+    alt, az = altaz( ra, dec, jd, lat, lon )
+    return alt + refraction( alt, pressure=pressure, temp=temp ), az
+
+
+def moon_altaz( jd, lat, lon, pressure=1010., temp=15. ):
+    """
+    Apparent topocentric altitude and azimuth of the Moon. The
+    topocentric correction is applied as a parallax in altitude.
+    """
+    ra, dec, hp = moon_radec( jd )
+    alt, az = altaz( ra, dec, jd, lat, lon )
+    alt = alt - np.arcsin( np.sin( hp ) * np.cos( alt ) )
+    return alt + refraction( alt, pressure=pressure, temp=temp ), az
+
+
+def fixed_altaz( ra, dec, jd, lat, lon, pressure=1010., temp=15. ):
+    """
+    Apparent altitude and azimuth of fixed J2000 targets.
+    """
+    ra_date, dec_date = precess( ra, dec, jd )
+    alt, az = altaz( ra_date, dec_date, jd, lat, lon )
+    return alt + refraction( alt, pressure=pressure, temp=temp ), az
+
+
+def separation( lon1, lat1, lon2, lat2 ):
+    """
+    Angular separation between points on the sphere, for either
+    (ra, dec) or (az, alt) pairs.
+    """
+    sinhav = np.sin( 0.5*( lat2 - lat1 ) )**2. \
+             + np.cos( lat1 ) * np.cos( lat2 ) * np.sin( 0.5*( lon2 - lon1 ) )**2.
+    return 2 * np.arcsin( np.sqrt( np.clip( sinhav, 0, 1 ) ) )
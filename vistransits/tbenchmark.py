@@ -0,0 +1,332 @@
+import numpy as np
+import os
+import time
+import json
+import shutil
+import tempfile
+import platform
+import ephem
+import tutilities
+import tsignals
+import tephem
+
+# Benchmarks for the planning pipeline, run on synthetic catalogues so
+# that they are repeatable and don't need a network connection. Results
+# are saved as JSON files that can be compared between versions of the
+# code with compare_benchmarks().
+
+BENCH_COLUMNS = [ 'NAME', 'TRANSIT', 'RA', 'DEC', 'RA_STRING', 'DEC_STRING', 'TT', 'T14', 'PER', \
+                  'RSTAR', 'R', 'A', 'TEFF', 'KS', 'V', 'MSINI', 'MASS' ] # columns of the synthetic csv
+BENCH_STAGES = [ 'make_eph', 'read_eph', 'emission', 'transmission', 'prepare_targets', \
+                 'calc_visible', 'write_visible', 'write_visible_legacy' ] # stages timed by run_benchmarks(), in order
+
+
+def run_benchmarks( nplanets=[ 100, 1000, 10000 ], observatories=[ 'LaPalma', 'Paranal' ], \
+                    windows=[ 7, 30 ], date_start='2014/01/01', sigtype='transits', \
+                    engine='pyephem', stages=BENCH_STAGES, nrepeats=1, seed=1, \
+                    outfile='benchmarks.json', workdir=None ):
+    """
+    Times each stage of the planning pipeline for synthetic catalogues of
+    different sizes, and saves the results to a JSON file.
+
+    For each catalogue size, a synthetic exoplanets.org csv file and its
+    binary cache are generated in a scratch directory (see make_catalogue()),
+    after which the following stages are run there in turn:
+
+      make_eph - tephem.make_eph()
+      read_eph - tephem.read_eph()
+      emission - tsignals.emission() with download_latest=False
+      transmission - tsignals.transmission() with download_latest=False
+      prepare_targets - tephem.prepare_targets()
+      calc_visible - tephem.calc_visible(), for every combination of the
+          observatories and window lengths
+      write_visible - tephem.write_visible() on its own, for the events of
+          each calc_visible() combination
+      write_visible_legacy - The same with bulk=False, i.e. formatting each
+          line separately with make_outstr_bp() and make_outstr_ch()
+
+    Nothing is downloaded, so the benchmarks can be run offline.
+
+    INPUTS
+      **nplanets - List of catalogue sizes.
+      **observatories - List of observatories to run calc_visible() for.
+      **windows - List of observing window lengths in days, each starting
+          at date_start.
+      **date_start - String in the format 'YYYY/MM/DD'.
+      **sigtype, engine - Passed to prepare_targets() and calc_visible().
+      **stages - Stages to time; any stages left out are still run if later
+          stages need their output files, but aren't timed.
+      **nrepeats - Number of times each stage is run; the fastest is reported.
+      **seed - Random seed for the synthetic catalogues.
+      **outfile - JSON file that the results are saved to; can be set to None.
+      **workdir - Directory that the scratch files are written to. If None, a
+          temporary directory is used and deleted afterwards.
+
+    OUTPUT
+      Returns a dictionary with the settings, details of the environment, and
+      a list of 'results', each entry of which gives the 'stage', 'nplanets',
+      'observatory' and 'window' (None for the stages that don't depend on
+      them) and the time taken in 'seconds'.
+    """
+
+    if outfile!=None:
+        outfile = os.path.abspath( outfile )
+    if workdir==None:
+        scratch = tempfile.mkdtemp( prefix='vistransits_bench_' )
+    else:
+        scratch = os.path.abspath( workdir )
+        if os.path.isdir( scratch )==False:
+            os.makedirs( scratch )
+
+    settings = { 'nplanets':list( nplanets ), 'observatories':list( observatories ), \
+                 'windows':list( windows ), 'date_start':date_start, 'sigtype':sigtype, \
+                 'engine':engine, 'stages':list( stages ), 'nrepeats':nrepeats, 'seed':seed }
+    bench = { 'created':time.strftime( '%Y-%m-%d %H:%M:%S' ), 'settings':settings, \
+              'environment':environment(), 'results':[] }
+
+    cwd = os.getcwd()
+    try:
+        for n in nplanets:
+            ndir = os.path.join( scratch, 'n{0}'.format( n ) )
+            if os.path.isdir( ndir )==False:
+                os.makedirs( ndir )
+            os.chdir( ndir )
+            make_catalogue( n, seed=seed )
+            bench['results'] += benchmark_catalogue( n, observatories, windows, date_start, \
+                                                     sigtype=sigtype, engine=engine, \
+                                                     stages=stages, nrepeats=nrepeats )
+    finally:
+        os.chdir( cwd )
+        if workdir==None:
+            shutil.rmtree( scratch, ignore_errors=True )
+
+    print_benchmarks( bench )
+    if outfile!=None:
+        ofile = open( outfile, 'w' )
+        json.dump( bench, ofile, indent=2, sort_keys=True )
+        ofile.close()
+        print '\nSaved benchmarks in {0}'.format( outfile )
+
+    return bench
+
+
+def benchmark_catalogue( nplanets, observatories, windows, date_start, sigtype='transits', \
+                         engine='pyephem', stages=BENCH_STAGES, nrepeats=1 ):
+    """
+    Runs the pipeline stages for the catalogue in the current directory,
+    as described for run_benchmarks(), and returns the list of results.
+    """
+
+    results = []
+    def add_result( stage, seconds, observatory=None, window=None ):
+        results.append( { 'stage':stage, 'nplanets':nplanets, 'observatory':observatory, \
+                          'window':window, 'seconds':seconds } )
+
+    # The ephemeris and signals files are needed by the later stages, so
+    # these stages are always run once even if they aren't being timed:
+    for stage, func in [ [ 'make_eph', tephem.make_eph ], \
+                         [ 'read_eph', lambda: tephem.read_eph( tephem.EPH_FILE ) ], \
+                         [ 'emission', lambda: tsignals.emission( download_latest=False ) ], \
+                         [ 'transmission', lambda: tsignals.transmission( download_latest=False ) ], \
+                         [ 'prepare_targets', lambda: tephem.prepare_targets( sigtype=sigtype ) ] ]:
+        if stage in stages:
+            add_result( stage, time_call( func, nrepeats=nrepeats ) )
+        elif stage in [ 'make_eph', 'emission', 'transmission' ]:
+            func()
+
+    if 'calc_visible' in stages:
+        for window in windows:
+            date_end = ephem.Date( ephem.Date( date_start ) + window ).datetime().strftime( '%Y/%m/%d' )
+            for observatory in observatories:
+                func = lambda: tephem.calc_visible( observatory, date_start, date_end, \
+                                                    sigtype=sigtype, engine=engine )
+                add_result( 'calc_visible', time_call( func, nrepeats=nrepeats ), \
+                            observatory=observatory, window=window )
+
+    writers = [ stage for stage in [ 'write_visible', 'write_visible_legacy' ] if stage in stages ]
+    if len( writers )>0:
+        tinfo = tephem.prepare_targets( sigtype=sigtype )
+        for window in windows:
+            date_end = ephem.Date( ephem.Date( date_start ) + window ).datetime().strftime( '%Y/%m/%d' )
+            for observatory in observatories:
+                obs = tephem.setup_observatory( observatory )[0]
+                events = tephem.calc_events( tinfo, obs, ephem.Date( date_start ), ephem.Date( date_end ), \
+                                             sigtype=sigtype, engine=engine )
+                for stage in writers:
+                    func = lambda: tephem.write_visible( observatory, date_start, date_end, tinfo, events, \
+                                                         sigtype=sigtype, bulk=( stage=='write_visible' ) )
+                    add_result( stage, time_call( func, nrepeats=nrepeats ), \
+                                observatory=observatory, window=window )
+
+    return results
+
+
+def time_call( func, nrepeats=1 ):
+    """
+    Returns the shortest time in seconds taken by func() over nrepeats calls.
+    """
+
+    seconds = []
+    for i in range( nrepeats ):
+        t1 = time.time()
+        func()
+        seconds += [ time.time() - t1 ]
+
+    return min( seconds )
+
+
+def make_catalogue( nplanets, seed=1 ):
+    """
+    Writes a synthetic exoplanets.org csv file containing nplanets transiting
+    planets to the current directory, along with the binary cache of it that
+    is normally generated by tutilities.convert_data(), so the catalogue can
+    be used without atpy. Returns the table as a NumPy record array.
+    """
+
+    table = synthetic_table( nplanets, seed=seed )
+    ofile = open( tutilities.ALL_CSV, 'w' )
+    ofile.write( '{0}\n'.format( ','.join( BENCH_COLUMNS ) ) )
+    for row in table:
+        ofile.write( '{0}\n'.format( ','.join( [ str( entry ) for entry in row ] ) ) )
+    ofile.close()
+    tutilities.write_cache( table, tutilities.ALL_CSV )
+
+    return table
+
+
+def synthetic_table( nplanets, seed=1 ):
+    """
+    Generates a table of nplanets transiting planets with random positions
+    spread uniformly over the sky, periods distributed uniformly in log
+    between 0.5 and 20 days, and reference mid-times spread over the ten
+    years before 2014, along with plausible stellar and planetary properties.
+    The first planet is always WASP-19 b, which is the default reference
+    object for the signals calculated by tsignals. The others are named
+    S000001 b, S000002 b, etc., which fit within the ten characters kept
+    for the names in the ephemeris file (see tephem.make_eph()), so that
+    the targets can be matched to their ranks in the signals files.
+    """
+
+    state = np.random.RandomState( seed )
+    ra = state.uniform( 0, 2*np.pi, nplanets )
+    dec = np.arcsin( state.uniform( -1, 1, nplanets ) )
+
+    dtype = [ ( 'NAME', 'S20' ), ( 'TRANSIT', 'i8' ), ( 'RA', 'S12' ), ( 'DEC', 'S12' ), \
+              ( 'RA_STRING', 'S16' ), ( 'DEC_STRING', 'S16' ) ] \
+              + [ ( column, 'f8' ) for column in BENCH_COLUMNS[6:] ]
+    table = np.empty( nplanets, dtype=dtype ).view( np.recarray )
+    table.NAME = [ 'S{0:06d} b'.format( i ) for i in range( nplanets ) ]
+    table.TRANSIT = 1
+    table.RA = [ '{0:.6f}'.format( value ) for value in np.rad2deg( ra ) / 15. ]
+    table.DEC = [ '{0:.6f}'.format( value ) for value in np.rad2deg( dec ) ]
+    table.RA_STRING = [ str( ephem.hours( value ) ) for value in ra ]
+    table.DEC_STRING = [ str( ephem.degrees( value ) ) for value in dec ]
+    table.PER = np.exp( state.uniform( np.log( 0.5 ), np.log( 20. ), nplanets ) )
+    table.TT = state.uniform( 2453371.5, 2456658.5, nplanets )
+    table.T14 = state.uniform( 0.04, 0.2, nplanets )
+    table.RSTAR = state.uniform( 0.6, 1.6, nplanets )
+    table.R = state.uniform( 0.3, 1.8, nplanets )
+    table.A = 0.0196 * ( table.PER**( 2./3. ) ) * ( table.RSTAR**( 1./3. ) )
+    table.TEFF = state.uniform( 4000., 6500., nplanets )
+    table.KS = state.uniform( 8., 13., nplanets )
+    table.V = table.KS + state.uniform( 1., 3., nplanets )
+    table.MASS = state.uniform( 0.1, 5., nplanets )
+    table.MSINI = table.MASS * np.sin( state.uniform( np.deg2rad( 80. ), np.pi/2., nplanets ) )
+    if nplanets>0:
+        table[0] = ( 'WASP-19 b', 1, '15.000000', '-45.000000', '15:00:00.00', '-45:00:00.0', \
+                     2455168.96801, 0.06586, 0.788839, 1.004, 1.386, 0.01655, 5500., 10.48, \
+                     12.59, 1.168, 1.168 )
+
+    return table
+
+
+def environment():
+    """
+    Returns a dictionary describing the versions of Python and the
+    packages that the pipeline depends on, and the host platform.
+    """
+
+    env = { 'python':platform.python_version(), 'numpy':np.__version__, \
+            'ephem':ephem.__version__, 'platform':platform.platform(), \
+            'processor':platform.processor() }
+
+    return env
+
+
+def print_benchmarks( bench ):
+    """
+    Prints the results returned by run_benchmarks() as a table.
+    """
+
+    print '\n{0:<22s}{1:>9s}  {2:<14s}{3:>7s}{4:>12s}'\
+          .format( 'Stage', 'Planets', 'Observatory', 'Days', 'Seconds' )
+    for result in bench['results']:
+        print result_line( result, '{0:12.4f}'.format( result['seconds'] ) )
+
+    return None
+
+
+def compare_benchmarks( old_file, new_file ):
+    """
+    Compares two JSON files saved by run_benchmarks(), e.g. before and after
+    a change to the code. Prints the times for each stage that appears in
+    both files along with the ratio between them, and returns a list of
+    ( result, old_seconds, new_seconds ) for these stages.
+    """
+
+    results = []
+    old = load_benchmarks( old_file )
+    new = load_benchmarks( new_file )
+    old_index = dict( [ [ result_key( result ), result ] for result in old['results'] ] )
+    print '\n{0:<22s}{1:>9s}  {2:<14s}{3:>7s}{4:>12s}{5:>12s}{6:>9s}'\
+          .format( 'Stage', 'Planets', 'Observatory', 'Days', 'Old', 'New', 'Speedup' )
+    for result in new['results']:
+        old_result = old_index.get( result_key( result ) )
+        if old_result==None:
+            continue
+        old_seconds = old_result['seconds']
+        new_seconds = result['seconds']
+        speedup = old_seconds / max( new_seconds, 1e-9 )
+        print result_line( result, '{0:12.4f}{1:12.4f}{2:8.2f}x'\
+                           .format( old_seconds, new_seconds, speedup ) )
+        results += [ [ result, old_seconds, new_seconds ] ]
+
+    return results
+
+
+def load_benchmarks( bench_file ):
+    """
+    Reads a JSON file saved by run_benchmarks().
+    """
+
+    ifile = open( bench_file, 'r' )
+    bench = json.load( ifile )
+    ifile.close()
+
+    return bench
+
+
+def result_key( result ):
+    """
+    Returns the key identifying which stage, catalogue size, observatory
+    and window length a benchmark result is for.
+    """
+
+    return ( result['stage'], result['nplanets'], result['observatory'], result['window'] )
+
+
+def result_line( result, times_str ):
+    """
+    Formats a line of the tables printed by print_benchmarks() and
+    compare_benchmarks().
+    """
+
+    if result['observatory']==None:
+        observatory, window = '-', '-'
+    else:
+        observatory, window = result['observatory'], result['window']
+    line = '{0:<22s}{1:>9d}  {2:<14s}{3:>7s}{4}'\
+           .format( result['stage'], result['nplanets'], observatory, str( window ), times_str )
+
+    return line
+
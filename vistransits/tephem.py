@@ -1,14 +1,42 @@
 import numpy as np
-import pdb
 import os
 import ephem
-import atpy
 import pytz
 import datetime
+import multiprocessing
+import heapq
+import itertools
+import hashlib
+import json
+import zlib
+import struct
+import errno
+import time
+import tempfile
 import tutilities
+import tastro
+import tprofile
+import tintervals
 
 
 EPH_FILE = 'exoplanets-org-ephem.txt'
+WORKER_SETUP = {} # settings shared by the calc_events() worker processes
+EVENT_DTYPE = [ ( 'target', 'S20' ), ( 'epoch', 'i8' ), ( 'mjd', 'f8' ), \
+                ( 'mjd_start', 'f8' ), ( 'mjd_end', 'f8' ), ( 'zenith', 'f8' ), \
+                ( 'airmass', 'f8' ), ( 'trtype', 'S21' ), ( 'moonpos', 'S12' ), \
+                ( 'moondist', 'f8' ), ( 'moonphase', 'f8' ), ( 'rank', 'i8' ), \
+                ( 'observable', 'f8' ) ] # see events_to_array()
+PREFILTER_MARGIN = 1. # degrees of slack allowed by the geometric prefilters (see reachable_targets())
+SUN_TRACK_STEP = 10. # minutes between the samples used to bracket the Sun/Moon crossings (see body_crossings())
+SIDEREAL_RATE = 1.00273790935 # sidereal days per solar day (see target_crossings())
+RESULT_CACHE_VERSION = 1 # increment whenever the output format changes, to invalidate the result cache
+RESULT_CACHE_MAX_BYTES = 64*1024**2 # size limit of the result cache, beyond which the least recently used are removed
+RESULT_CACHE_INDEX = 'index.json' # index of the result cache entries (see read_result_index())
+RESULT_CACHE_LOCK = 'index.lock' # lock file held while the result cache index is updated (see lock_result_cache())
+RESULT_CACHE_LOCK_TIMEOUT = 60. # seconds after which a lock file is assumed to have been abandoned
+DATE_SECOND_TOL = 1e-4 # seconds from a whole second within which pyephem2strings() defers to pyephem
+WRITE_BLOCK_SIZE = 10000 # number of events formatted together by write_visible()
+ROW_TEMPLATE_BP = ' {0:^8.2f}  {1}  {2}  {3:^6d} {4:^4.2f} {5} {6:^12} {7} {8:^10}\n' # see format_rows_bp()
 
 
 def calc_visible( observatory, date_start, date_end, sigtype='transits', \
@@ -16,7 +44,8 @@ def calc_visible( observatory, date_start, date_end, sigtype='transits', \
                   sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, \
                   moon_alt_set=-6, target_elev_min=25, oot_deltdur=0.5, \
                   tr_signals='signals_transits.txt', ec_signals='signals_eclipses.txt', \
-                  exclude_unranked=False, max_rank=None ):
+                  exclude_unranked=False, max_rank=None, engine='pyephem', sunmoon_step=None, \
+                  workers=1, tinfo=None, events_file=None, incremental=False, result_cache=None ):
     """
     Calculates the visible transits for a list of targets at a given observatory within
     a specified time window. Saves them in an output file with name of the form:
@@ -49,43 +78,254 @@ def calc_visible( observatory, date_start, date_end, sigtype='transits', \
           for those planets where a transmission/emission signal estimate was possible.
       **max_rank - Lowest ranked signal that output will be printed for; can be set
           to None if no such constraint is to be applied.
+      **engine - 'pyephem' (default) to calculate the target, Sun and Moon positions
+          with pyephem one event at a time, or 'vectorized' to evaluate all epochs
+          of all targets in bulk using the low-precision formulae in the tastro
+          module; compare_engines() checks that the two agree within tolerances.
+      **sunmoon_step - If set to a time step in minutes, the Sun and Moon altitudes,
+          Moon phase and Moon position are tabulated once over the observing window
+          at this sampling (see sunmoon_table()) and interpolated for each event,
+          rather than being calculated separately for every event.
+      **workers - Number of processes to split the targets between. The events
+          calculated by each process are merged back together in target order,
+          so the output files are identical to those from a serial run.
+      **tinfo - Target information already generated by prepare_targets() using the
+          same sigtype, tr_signals, ec_signals, exclude_unranked and max_rank values,
+          which saves re-reading the input files (see calc_visible_batch()).
+      **events_file - If set, the calculated events are saved to this file along
+          with the settings used and a fingerprint of each target's ephemeris (see
+          save_events()). If the file already exists and was made with the same
+          settings, only the targets that are new or whose ephemerides have changed
+          since (e.g. after the catalogue has been updated and make_eph() rerun)
+          are recalculated, and the previous events are reused for the others.
+      **incremental - If set to True, the events saved in events_file are also reused
+          when they were calculated for a different time window (e.g. when the window
+          is rolled forward by a day). The saved events that have fallen out of the
+          new window are dropped and only the transits/eclipses outside the saved
+          window are calculated, with the chronolog file regenerated from the merged
+          events. The other settings must still match.
+      **result_cache - If set to a directory name, the contents of the output files
+          are cached there, keyed by a hash of the observatory, the time window, the
+          thresholds and the ephemerides and ranks of the targets (see result_key()).
+          A repeated call with identical inputs then writes the output files straight
+          from the cache without calculating any events (so events_file is not
+          updated). The least recently used results are discarded once the cache
+          exceeds RESULT_CACHE_MAX_BYTES, and results that are larger than this
+          even after compression are not cached at all.
       
     OUTPUT
       Output is printed to the files specified by the ofilename_byplanet and
       ofilename_chronolog keyword arguments.
+
+    To see where the time goes, run calc_visible() through tprofile.profile(),
+    which reports the number of pyephem compute() calls for each type of body,
+    the number of events evaluated and rejected by the target altitude and Sun
+    altitude limits, and the time spent calculating and formatting the events.
     """
 
-    # Convert the minimum target altitude to a maximum zenith angle:
-    zenith_max = 90 - target_elev_min
+    # Read in the basic target information for all transiting exoplanets
+    # and work out which of them have been ranked highly enough:
+    if tinfo==None:
+        t1 = tprofile.start()
+        tinfo = prepare_targets( sigtype=sigtype, tr_signals=tr_signals, ec_signals=ec_signals, \
+                                 exclude_unranked=exclude_unranked, max_rank=max_rank )
+        tprofile.stop( 'prepare_targets', t1 )
 
-    # Read in the basic target information for all transiting exoplanets:
-    targets, vmags, ras, decs, ttrs, pers, durs = read_eph( EPH_FILE )
+    # Create the observatory and timezone objects:
+    obs, tz = setup_observatory( observatory )
+    if ( obs==None ) and ( tz==None ):
+        return None
 
-    # Read in the rankings for transit and eclipse signals:
-    targets_ec, ranks_ec = eclipse_ranks( ec_signals )
-    targets_tr, ranks_tr = transit_ranks( tr_signals )    
+    # Identify the visible transits for each of the selected targets; unless
+    # they're being saved, these are generated a target at a time and written
+    # out as they arrive:
+    settings = events_settings( obs, ephem.Date( date_start ), ephem.Date( date_end ), \
+                                sigtype=sigtype, engine=engine, \
+                                sun_alt_max=sun_alt_max, sun_alt_twil=sun_alt_twil, \
+                                sun_alt_dark=sun_alt_dark, moon_alt_set=moon_alt_set, \
+                                target_elev_min=target_elev_min, oot_deltdur=oot_deltdur, \
+                                sunmoon_step=sunmoon_step )
+    if result_cache!=None:
+        key = result_key( observatory, date_start, date_end, tinfo, settings, max_rank=max_rank )
+        t1 = tprofile.start()
+        result = load_result( result_cache, key )
+        tprofile.stop( 'load_result', t1 )
+        if result!=None:
+            tprofile.count( 'result_cache_hits' )
+            ofilename_byplanet, ofilename_chronolog = output_filenames( observatory, sigtype=sigtype, \
+                                                                        ofilename_byplanet=ofilename_byplanet, \
+                                                                        ofilename_chronolog=ofilename_chronolog )
+            for ofilename, contents in zip( [ ofilename_byplanet, ofilename_chronolog ], result ):
+                ofile = open( ofilename, 'wb' )
+                ofile.write( contents )
+                ofile.close()
+            print '\nSaved output from the result cache in:'
+            print '  %s' % ofilename_byplanet
+            print '  %s' % ofilename_chronolog
+            return ofilename_byplanet, ofilename_chronolog
+        tprofile.count( 'result_cache_misses' )
+    if events_file!=None:
+        t1 = tprofile.start()
+        reuse = load_events( events_file, settings, incremental=incremental )
+        tprofile.stop( 'load_events', t1 )
+    else:
+        reuse = None
+    events = iter_events( tinfo, obs, ephem.Date( date_start ), ephem.Date( date_end ), \
+                          sigtype=sigtype, engine=engine, \
+                          sun_alt_max=sun_alt_max, sun_alt_twil=sun_alt_twil, \
+                          sun_alt_dark=sun_alt_dark, moon_alt_set=moon_alt_set, \
+                          target_elev_min=target_elev_min, oot_deltdur=oot_deltdur, \
+                          sunmoon_step=sunmoon_step, workers=workers, reuse=reuse )
+    if events_file!=None:
+        events = [ events_k for k, events_k in events ]
+        t1 = tprofile.start()
+        save_events( events_file, tinfo, events, settings )
+        tprofile.stop( 'save_events', t1 )
+
+    # Format the events and write them to the output files:
+    ofilenames = write_visible( observatory, date_start, date_end, tinfo, events, sigtype=sigtype, \
+                                ofilename_byplanet=ofilename_byplanet, \
+                                ofilename_chronolog=ofilename_chronolog, \
+                                sun_alt_max=sun_alt_max, sun_alt_twil=sun_alt_twil, \
+                                sun_alt_dark=sun_alt_dark, target_elev_min=target_elev_min, \
+                                oot_deltdur=oot_deltdur, max_rank=max_rank )
+    if result_cache!=None:
+        t1 = tprofile.start()
+        contents = []
+        for ofilename in ofilenames:
+            ifile = open( ofilename, 'rb' )
+            contents += [ ifile.read() ]
+            ifile.close()
+        save_result( result_cache, key, contents[0], contents[1] )
+        tprofile.stop( 'save_result', t1 )
+
+    return ofilenames
+
+
+def visible_events( observatory, date_start, date_end, sigtype='transits', \
+                    sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, \
+                    moon_alt_set=-6, target_elev_min=25, oot_deltdur=0.5, \
+                    tr_signals='signals_transits.txt', ec_signals='signals_eclipses.txt', \
+                    exclude_unranked=False, max_rank=None, engine='pyephem', sunmoon_step=None, \
+                    workers=1, tinfo=None, chronological=True ):
+    """
+    Identifies the visible transits/eclipses in the same way as calc_visible(),
+    but returns them as a NumPy structured array rather than formatting them
+    and writing them to output files.
 
-    # Create the databases that will be used by pyephem for calculating
-    # ephemerides for each object:
-    ntargets = len( targets )
-    dbs = []
-    for i in range( ntargets ):
-        db_str = '{targ},f|S,{ra},{dec},{vmag}'.format( targ=targets[i], \
-                                                        ra=ras[i], \
-                                                        dec=decs[i], \
-                                                        vmag=vmags[i] )
-        dbs += [ db_str ]
+    INPUTS
+      **chronological - If set to True (default) the events are sorted in order
+          of mid-time, otherwise they are grouped by target in the same order as
+          the byplanet output file of calc_visible().
+      Other inputs are the same as for calc_visible().
 
-    # Open the output file and write a header:
-    if ofilename_byplanet=='default':
-        if sigtype=='transits':
-            ofilename_byplanet = '{0}_transits_byplanet.txt'.format( observatory )
-            ofilename_chronolog = '{0}_transits_chronolog.txt'.format( observatory )
-        elif sigtype=='eclipses':
-            ofilename_byplanet = '{0}_eclipses_byplanet.txt'.format( observatory )
-            ofilename_chronolog = '{0}_eclipses_chronolog.txt'.format( observatory )            
+    OUTPUT
+      Returns a structured array with the fields described in events_to_array(),
+      or None if the observatory is not recognised.
+    """
+
+    if tinfo==None:
+        tinfo = prepare_targets( sigtype=sigtype, tr_signals=tr_signals, ec_signals=ec_signals, \
+                                 exclude_unranked=exclude_unranked, max_rank=max_rank )
+    obs, tz = setup_observatory( observatory )
+    if ( obs==None ) and ( tz==None ):
+        return None
+    events = calc_events( tinfo, obs, ephem.Date( date_start ), ephem.Date( date_end ), \
+                          sigtype=sigtype, engine=engine, \
+                          sun_alt_max=sun_alt_max, sun_alt_twil=sun_alt_twil, \
+                          sun_alt_dark=sun_alt_dark, moon_alt_set=moon_alt_set, \
+                          target_elev_min=target_elev_min, oot_deltdur=oot_deltdur, \
+                          sunmoon_step=sunmoon_step, workers=workers )
+
+    return events_to_array( tinfo, events, chronological=chronological )
+
+
+def events_to_array( tinfo, events, chronological=False ):
+    """
+    Converts the events returned by calc_events() into a NumPy structured
+    array with one row per event and the following fields:
+
+      target - Target name.
+      epoch - Epoch number counted from the reference mid-time.
+      mjd - Mid-time as a Modified Julian Date (UT).
+      mjd_start, mjd_end - Start and end of the transit/eclipse as Modified
+          Julian Dates (UT).
+      zenith - Zenith angle of the target at mid-time in degrees.
+      airmass - Airmass of the target at mid-time.
+      trtype - Transit-type string (see classify_sun() and full_trtype()).
+      moonpos - Moon-type string (see classify_moon()).
+      moondist - Target-Moon separation in degrees (NaN if the Moon is down).
+      moonphase - Percentage of the Moon illuminated (NaN if the Moon is down).
+      rank - Signal rank of the target, or -1 if it hasn't been ranked.
+      observable - Fraction of the observations, including the out-of-transit
+          baseline, for which the Sun is below sun_alt_max (see classify_sun()).
+
+    The rows are grouped by target unless chronological is True, in which
+    case they are sorted in order of mid-time.
+    """
+
+    rows = []
+    for k in range( len( tinfo['selected'] ) ):
+        i = tinfo['selected'][k]
+        if tinfo['unranked'][k]==True:
+            rank = -1
         else:
-            pdb.set_trace() #this shouldn't happen
+            rank = tinfo['ranks'][k]
+        for event in events[k]:
+            if event['moonpos']=='moon-down':
+                moondist = np.nan
+                moonphase = np.nan
+            else:
+                moondist = float( event['moondist'] )
+                moonphase = float( event['moonphase'] )
+            rows += [ ( tinfo['targets'][i], event['epoch'], event['mjd'], \
+                        ( event['tstart'] + tastro.PYEPHEM_JD0 ) - 2400000.5, \
+                        ( event['tend'] + tastro.PYEPHEM_JD0 ) - 2400000.5, \
+                        event['zenith'], event['airmass'], event['trtype'], \
+                        event['moonpos'], moondist, moonphase, rank, event['observable'] ) ]
+    arr = np.array( rows, dtype=EVENT_DTYPE )
+    if chronological==True:
+        arr = arr[ np.argsort( arr['mjd'], kind='mergesort' ) ]
+
+    return arr
+
+
+def write_visible( observatory, date_start, date_end, tinfo, events, sigtype='transits', \
+                   ofilename_byplanet='default', ofilename_chronolog='default', \
+                   sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, \
+                   target_elev_min=25, oot_deltdur=0.5, max_rank=None, bulk=True ):
+    """
+    Formats the events returned by calc_events() and writes them to the
+    byplanet and chronolog output files described in calc_visible(). The
+    events can also be given as a (target index, target events) generator
+    such as iter_events(), in which case each target is written to the
+    byplanet file as soon as it arrives and the chronolog file is written
+    by merging the per-target events (see merge_events()), so no more than
+    one block of output lines is held in memory at a time. The remaining
+    inputs are only used for the file names and headers, and have the same
+    meanings as for calc_visible().
+
+    The lines for each target, and for each block of WRITE_BLOCK_SIZE
+    events in the chronolog file, are formatted together with
+    format_rows_bp() and format_rows_ch(). If bulk is set to False, each
+    line is formatted separately with make_outstr_bp() and make_outstr_ch()
+    instead, which gives identical files but is slower (see tbenchmark).
+
+    Returns the names of the byplanet and chronolog output files.
+    """
+
+    # Convert the minimum target altitude to a maximum zenith angle:
+    zenith_max = 90 - target_elev_min
+
+    targets = tinfo['targets']
+    ras = tinfo['ras']
+    decs = tinfo['decs']
+    obs_name = observatory_name( observatory )
+
+    # Open the output file and write a header:
+    ofilename_byplanet, ofilename_chronolog = output_filenames( observatory, sigtype=sigtype, \
+                                                                ofilename_byplanet=ofilename_byplanet, \
+                                                                ofilename_chronolog=ofilename_chronolog )
 
     # Create the strings that will be used for column headers:
     colheadingsa_bp, colheadingsb_bp = make_colheadings( 'byplanet' )
@@ -107,9 +347,9 @@ def calc_visible( observatory, date_start, date_end, sigtype='transits', \
         sigtype_upper_singular = 'Eclipse'
 
     ofile_bp.write( '# Visible primary {0}s from {1} between {2} and {3}, arranged by planet\n#\n'\
-                 .format( sigtype_lower_singular, observatory, date_start, date_end ) )
+                 .format( sigtype_lower_singular, obs_name, date_start, date_end ) )
     ofile_ch.write( '# Visible primary {0}s from {1} between {2} and {3}, arranged in chronological order\n#\n'\
-                 .format( sigtype_lower_singular, observatory, date_start, date_end ) )
+                 .format( sigtype_lower_singular, obs_name, date_start, date_end ) )
     if max_rank!=None:
         header_str = '# Only considered the top {0} ranked signals and of these only those with {1}s\n'\
                      .format( max_rank, sigtype_lower_singular )
@@ -117,7 +357,8 @@ def calc_visible( observatory, date_start, date_end, sigtype='transits', \
                       .format( zenith_max )
     else:
         header_str = '# Considered all published transiting planets but output only printed where the\n'
-        header_str += '# {0} mid-time occurs at a zenith angle <{0}deg\n#\n'.format( zenith_max )
+        header_str += '# {0} mid-time occurs at a zenith angle <{1}deg\n#\n'\
+                      .format( sigtype_lower_singular, zenith_max )
     if oot_deltdur>0:
         header_str += '# Accounts for {0:.2f} transit durations before and after the transit to sample\n'.format( oot_deltdur )
         header_str += '# the out-of-transit baseline flux level\n#\n'
@@ -141,131 +382,1237 @@ def calc_visible( observatory, date_start, date_end, sigtype='transits', \
     if oot_deltdur==0:
         header_str += '#   {details} can have the following values:\n'
     else:
-        header_str += '#   {{details}} refer to the full span of the observations including the {0:.2f} transit\n'.format( oot_deltdur )
-        header_str += '#   durations before and after the {0} itself for sampling the baseline flux:\n'.format( sigtype_lower_singular )
-    header_str += '#     - \'all_in_darktime\' if the sun elevation is within the dark range for the entire\n'
-    header_str += '#     duration of the observations\n'
-    header_str += '#     - \'dark_to_twilight\' if the sun elevation is within the dark range at the start\n'
-    header_str += '#       of the observations and within the twilight range at the end of the observations\n'
-    header_str += '#     - \'twilight_to_dark\' if the sun elevation is within the twilight range at the \n'
-    header_str += '#       start of the observations and within the dark range at the end of the observations\n'
-    header_str += '#     - \'start_at_dusk\' if the sun elevation is within the twilight range at the start\n'
-    header_str += '#       of the observations\n'
-    header_str += '#     - \'end_at_dawn\' if the sun elevation is within the twilight range at the end of\n'
-    header_str += '#       the observations\n'
-    if oot_deltdur>0:
-        header_str += '#     - \'partial_oot\' if the sun elevation is above the maximum acceptable value at some\n'
-        header_str += '#       time during either the pre- or post-{0} baseline flux observations\n'.format( sigtype_lower_singular )
-    header_str += '#     - \'miss_ingress\' if the sun elevation is above the maximum acceptable value at\n'
-    header_str += '#       ingress but below this value at egress\n'
-    header_str += '#     - \'miss_ingress\' if the sun elevation is below the maximum acceptable value at\n'
-    header_str += '#       ingress but above this value at egress\n'
-    header_str += '#     - \'only_middle\' if the sun elevation is above the maximum acceptable value at\n'
-    header_str += '#       value at both ingress and egress, but descends below this value at some point\n'
-    header_str += '#       during the {0}\n#\n'.format( sigtype_lower_singular )
-    ofile_bp.write( header_str )
-    ofile_ch.write( header_str )
+        header_str += '#   {{details}} refer to the full span of the observations including the {0:.2f} transit\n'.format( oot_deltdur )
+        header_str += '#   durations before and after the {0} itself for sampling the baseline flux:\n'.format( sigtype_lower_singular )
+    header_str += '#     - \'all_in_darktime\' if the sun elevation is within the dark range for the entire\n'
+    header_str += '#     duration of the observations\n'
+    header_str += '#     - \'dark_to_twilight\' if the sun elevation is within the dark range at the start\n'
+    header_str += '#       of the observations and within the twilight range at the end of the observations\n'
+    header_str += '#     - \'twilight_to_dark\' if the sun elevation is within the twilight range at the \n'
+    header_str += '#       start of the observations and within the dark range at the end of the observations\n'
+    header_str += '#     - \'start_at_dusk\' if the sun elevation is within the twilight range at the start\n'
+    header_str += '#       of the observations\n'
+    header_str += '#     - \'end_at_dawn\' if the sun elevation is within the twilight range at the end of\n'
+    header_str += '#       the observations\n'
+    if oot_deltdur>0:
+        header_str += '#     - \'partial_oot\' if the sun elevation is above the maximum acceptable value at some\n'
+        header_str += '#       time during either the pre- or post-{0} baseline flux observations\n'.format( sigtype_lower_singular )
+    header_str += '#     - \'miss_ingress\' if the sun elevation is above the maximum acceptable value at\n'
+    header_str += '#       ingress but below this value at egress\n'
+    header_str += '#     - \'miss_ingress\' if the sun elevation is below the maximum acceptable value at\n'
+    header_str += '#       ingress but above this value at egress\n'
+    header_str += '#     - \'only_middle\' if the sun elevation is above the maximum acceptable value at\n'
+    header_str += '#       value at both ingress and egress, but descends below this value at some point\n'
+    header_str += '#       during the {0}\n#\n'.format( sigtype_lower_singular )
+    ofile_bp.write( header_str )
+    ofile_ch.write( header_str )
+
+    # Go through the targets one-at-a-time, writing the visible transits
+    # to the by-planet output file:
+    if type( events )==list:
+        events = enumerate( events )
+    events_kept = []
+    pending = [] # targets waiting to be written in bulk (see write_rows_bp())
+    npending = 0
+    nranked = tinfo['nranked']
+    for k, events_k in events:
+
+        i = tinfo['selected'][k]
+        if len( events_k )==0:
+            continue
+        events_kept += [ ( k, events_k ) ]
+        rank_i = tinfo['ranks'][k]
+        unranked = tinfo['unranked'][k]
+
+        # Write the header for the current object to the output file:
+        header_bp = '\n\n{0}\n#\n'.format( '#'*( nchar_bp ) )
+        if unranked==True:
+            if sigtype=='transits':
+                header_str = '#  {0}   -->   not enough information to rank primary transit signal \n#\n'\
+                             .format( targets[i]  )
+            else:
+                header_str = '#  {0}   -->   not enough information to rank secondary eclipse signal \n#\n'\
+                             .format( targets[i]  )
+        else:
+            if sigtype=='transits':
+                header_str = '#  {0}   -->   primary transit signal ranked {1} out of {2} \n#\n'\
+                             .format( targets[i], str( rank_i ), str( nranked ) )
+            else:
+                header_str = '#  {0}   -->   secondary eclipse signal ranked {1} out of {2} \n#\n'\
+                             .format( targets[i], str( rank_i ), str( nranked ) )
+        header_str += '#  RA (hh mm ss.s) Dec (dd mm ss.s)\n'
+        ra_str = ras[i].replace( ':', ' ' )
+        dec_str = decs[i].replace( ':', ' ' )
+        header_str += '#  {0} {1}\n#\n'.format( ra_str, dec_str )
+        header_str += colheadingsa_bp
+        header_str += colheadingsb_bp
+
+        header_bp += header_str
+        header_bp += '{0}{1}\n'.format( '#', '-'*( nchar_bp-1 ) )
+
+        # In bulk mode, the targets are held back until WRITE_BLOCK_SIZE
+        # events have built up, which are then formatted together:
+        if bulk:
+            pending += [ ( header_bp, events_k ) ]
+            npending += len( events_k )
+            if npending>=WRITE_BLOCK_SIZE:
+                write_rows_bp( ofile_bp, pending )
+                pending = []
+                npending = 0
+            continue
+        ofile_bp.write( header_bp )
+        for event in events_k:
+
+            # Determine the start and end times of transit in UT: 
+            t1 = tprofile.start()
+            utc_tstart_dt = pyephem2datetime( event['tstart'] )
+            utc_tend_dt = pyephem2datetime( event['tend'] )
+
+            # Prepare and write output line to file:
+            outstr_bp = make_outstr_bp( event['mjd'], utc_tstart_dt, utc_tend_dt, event['zenith'], \
+                                        event['airmass'], event['trtype'], event['moonpos'], \
+                                        event['moondist'], event['moonphase'] )
+            tprofile.stop( 'format_byplanet', t1 )
+            ofile_bp.write( outstr_bp )
+        tprofile.count( 'events_written', len( events_k ) )
+    if bulk:
+        write_rows_bp( ofile_bp, pending )
+
+    # Now that we've identified all of the transits, merge them into
+    # chronological order and write this information to output:
+    header_str = '#\n#\n{0}\n'.format( '#'*nchar_ch )
+    header_str += colheadingsa_ch
+    header_str += colheadingsb_ch
+    ofile_ch.write( header_str )
+    ofile_ch.write( '{0}{1}\n'.format( '#', '-'*( nchar_ch-1 ) ) )
+    df_prev = None
+    merged = merge_events( events_kept )
+    while bulk:
+        block = list( itertools.islice( merged, WRITE_BLOCK_SIZE ) )
+        if len( block )==0:
+            break
+        t1 = tprofile.start()
+        names = [ targets[tinfo['selected'][k]] for k, event in block ]
+        rows_ch, df_prev = format_rows_ch( names, [ event for k, event in block ], nchar_ch, \
+                                           df_prev=df_prev )
+        tprofile.stop( 'format_chronolog', t1 )
+        ofile_ch.write( ''.join( rows_ch ) )
+    for k, event in merged:
+        i = tinfo['selected'][k]
+        t1 = tprofile.start()
+        utc_tstart_dt = pyephem2datetime( event['tstart'] )
+        utc_tend_dt = pyephem2datetime( event['tend'] )
+        df = np.floor( ephem.Date( utc_tstart_dt )+1.0 ) # number of days since midday on 1 Jan 1900 
+        if ( df_prev!=None ) and ( df-df_prev>=1.0 ):
+            ofile_ch.write( '#{0}\n'.format( '-'*( nchar_ch-1 ) ) )
+        df_prev = df
+        outstr_ch = make_outstr_ch( targets[i], event['mjd'], utc_tstart_dt, utc_tend_dt, \
+                                    event['zenith'], event['airmass'], event['trtype'], \
+                                    event['moonpos'], event['moondist'], event['moonphase'] )
+        tprofile.stop( 'format_chronolog', t1 )
+        ofile_ch.write( outstr_ch )
+    ofile_ch.write( '{0}{1}\n'.format( '#', '-'*( nchar_bp-1 ) ) )
+
+    # Save the output files and finish:
+    ofile_bp.close()
+    ofile_ch.close()
+    print '\nSaved output in:'
+    print '  %s' % ofilename_byplanet
+    print '  %s' % ofilename_chronolog
+
+    return ofilename_byplanet, ofilename_chronolog
+
+
+def output_filenames( observatory, sigtype='transits', ofilename_byplanet='default', \
+                      ofilename_chronolog='default' ):
+    """
+    Returns the names of the byplanet and chronolog output files, replacing
+    the 'default' setting with the names described in calc_visible().
+    """
+
+    obs_name = observatory_name( observatory )
+    if ofilename_byplanet=='default':
+        if sigtype=='transits':
+            ofilename_byplanet = '{0}_transits_byplanet.txt'.format( obs_name )
+            ofilename_chronolog = '{0}_transits_chronolog.txt'.format( obs_name )
+        elif sigtype=='eclipses':
+            ofilename_byplanet = '{0}_eclipses_byplanet.txt'.format( obs_name )
+            ofilename_chronolog = '{0}_eclipses_chronolog.txt'.format( obs_name )            
+        else:
+            raise ValueError( 'sigtype must be either \'transits\' or \'eclipses\'' )
+
+    return ofilename_byplanet, ofilename_chronolog
+
+
+def calc_visible_batch( observatories, date_start, date_end, sigtype='transits', \
+                        sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, \
+                        moon_alt_set=-6, target_elev_min=25, oot_deltdur=0.5, \
+                        tr_signals='signals_transits.txt', ec_signals='signals_eclipses.txt', \
+                        exclude_unranked=False, max_rank=None, engine='pyephem', \
+                        sunmoon_step=None, workers=1, events_file=None, incremental=False, \
+                        result_cache=None ):
+    """
+    Runs calc_visible() for a list of observatories over the same time window.
+    The work that does not depend on the observatory (reading the ephemeris
+    and ranking files, working out which targets to consider, parsing their
+    coordinates and generating their transit/eclipse mid-times) is only done
+    once and shared between all of the observatories.
+
+    INPUTS
+      **observatories - List containing any combination of string identifiers
+          used in the observatories() routine and custom-defined observatory
+          dictionaries (see setup_observatory()). Custom observatories can be
+          given a 'name' entry to be used in the output file names, and must be
+          if there is more than one of them, as each observatory needs a unique
+          name (see observatory_name()).
+      **events_file - If set, the events for each observatory are saved to a
+          separate file, named by prefixing this with the observatory name and
+          an underscore (e.g. 'LaPalma_events.npz'), as described in calc_visible().
+      Other inputs are the same as for calc_visible().
+
+    OUTPUT
+      Returns a dictionary with the observatory names as keys, each entry
+      containing the names of the byplanet and chronolog output files for
+      that observatory, as returned by calc_visible().
+    """
+
+    # Each observatory's output files are named after it, so the names
+    # have to be unique to avoid one overwriting another:
+    obs_names = [ observatory_name( observatory ) for observatory in observatories ]
+    duplicates = sorted( set( [ name for name in obs_names if obs_names.count( name )>1 ] ) )
+    if len( duplicates )>0:
+        raise ValueError( 'observatory names must be unique, but found more than one {0} '\
+                          '(give custom observatories a \'name\' entry)'.format( ', '.join( duplicates ) ) )
+
+    tinfo = prepare_targets( sigtype=sigtype, tr_signals=tr_signals, ec_signals=ec_signals, \
+                             exclude_unranked=exclude_unranked, max_rank=max_rank )
+    tinfo = add_transit_times( tinfo, ephem.Date( date_start ), ephem.Date( date_end ), \
+                               sigtype=sigtype )
+
+    outputs = {}
+    for observatory, obs_name in zip( observatories, obs_names ):
+        if events_file!=None:
+            obs_events_file = '{0}_{1}'.format( obs_name, events_file )
+        else:
+            obs_events_file = None
+        outputs[obs_name] = calc_visible( observatory, date_start, date_end, sigtype=sigtype, \
+                                          sun_alt_max=sun_alt_max, sun_alt_twil=sun_alt_twil, \
+                                          sun_alt_dark=sun_alt_dark, moon_alt_set=moon_alt_set, \
+                                          target_elev_min=target_elev_min, oot_deltdur=oot_deltdur, \
+                                          max_rank=max_rank, engine=engine, \
+                                          sunmoon_step=sunmoon_step, workers=workers, tinfo=tinfo, \
+                                          events_file=obs_events_file, incremental=incremental, \
+                                          result_cache=result_cache )
+
+    return outputs
+
+
+def observing_intervals( observatory, date_start, date_end, sigtype='transits', \
+                         sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, \
+                         moon_alt_set=-6, target_elev_min=25, oot_deltdur=0.5, \
+                         tr_signals='signals_transits.txt', ec_signals='signals_eclipses.txt', \
+                         exclude_unranked=False, max_rank=None, method='tastro', tinfo=None ):
+    """
+    Works out when the Sun and Moon are below their altitude limits, when
+    each target is above target_elev_min and when their transits/eclipses
+    occur, as sets of intervals covering the nights between date_start and
+    date_end, rather than classifying individual transits/eclipses like
+    calc_visible(). Each night runs from local mean noon to the next, and
+    the scheduling questions can be answered from the output without any
+    further ephemeris calculations, using night_intervals(),
+    observable_windows() and windows_overlapping().
+
+    INPUTS
+      **method - Either 'tastro' (default) or 'pyephem', setting whether
+          the Sun and Moon crossing times are solved for with the tastro
+          module or pyephem (see body_crossings()). The target rise and set
+          times are always solved for analytically (see target_crossings()).
+      Other inputs are the same as for calc_visible().
+
+    OUTPUT
+      Returns a dictionary containing the following entries, or None if the
+      observatory is not recognised. All times are pyephem dates and each set
+      of intervals is a tuple of arrays of the start and end dates of the
+      intervals in chronological order (see the tintervals module).
+        nights - The boundaries of the nights, so that night n runs from
+            nights[n] to nights[n+1].
+        night_labels - The local date at the start of each night.
+        sun - Dictionary with sun_alt_max, sun_alt_twil and sun_alt_dark as
+            keys, containing the intervals with the Sun below each altitude.
+        moon_down - Intervals with the Moon below moon_alt_set.
+        targets - Names of the targets selected by prepare_targets().
+        target_up - List with the intervals that each target is at or above
+            target_elev_min.
+        observable - List with the intervals that each target is at or above
+            target_elev_min while the Sun is below sun_alt_max.
+        windows - Dictionary describing the observing windows of the
+            transits/eclipses, including the requested out-of-transit
+            baselines, with arrays of the target positions in the targets
+            list ('target'), the epoch numbers ('epoch'), the mid-times
+            ('tmid') and the start and end times ('tstart', 'tend'), along
+            with an index over them built by tintervals.build_index()
+            ('index').
+    """
+
+    if tinfo==None:
+        tinfo = prepare_targets( sigtype=sigtype, tr_signals=tr_signals, ec_signals=ec_signals, \
+                                 exclude_unranked=exclude_unranked, max_rank=max_rank )
+    obs, tz = setup_observatory( observatory )
+    if ( obs==None ) and ( tz==None ):
+        return None
+    date_start = ephem.Date( date_start )
+    date_end = ephem.Date( date_end )
+    tinfo = add_transit_times( tinfo, date_start, date_end, sigtype=sigtype )
+    selected = tinfo['selected']
+
+    # Nights run between successive local mean noons, which fall on the
+    # integer pyephem dates (12h UT) shifted by the longitude:
+    noon_offset = float( obs.long ) / ( 2*np.pi )
+    first = int( np.floor( float( date_start ) + noon_offset ) )
+    last = int( np.floor( float( date_end ) + noon_offset ) )
+    noons = np.arange( first, last+2 )
+    nights = noons - noon_offset
+    night_labels = [ ephem.Date( noon ).datetime().strftime( '%Y/%m/%d' ) for noon in noons[:-1] ]
+
+    # Observing windows of the transits/eclipses:
+    nepochs = [ len( tmids_k ) for tmids_k in tinfo['tmids'] ]
+    durs = np.array( [ tinfo['durs'][i] for i in selected ] ) / 24.
+    window_targets = np.repeat( np.arange( len( selected ) ), nepochs )
+    window_tmids = np.concatenate( [ np.asarray( tmids_k, dtype=float ) for tmids_k in tinfo['tmids'] ] + \
+                                   [ np.zeros( 0 ) ] )
+    window_epochs = np.concatenate( [ np.asarray( epochs_k, dtype=int ) for epochs_k in tinfo['epochs'] ] + \
+                                    [ np.zeros( 0, dtype=int ) ] )
+    halfwidths = ( 0.5 + oot_deltdur )*durs[window_targets]
+    windows = { 'target':window_targets, 'epoch':window_epochs, 'tmid':window_tmids, \
+                'tstart':window_tmids - halfwidths, 'tend':window_tmids + halfwidths }
+    windows['index'] = tintervals.build_index( windows['tstart'], windows['tend'] )
+
+    # The intervals need to cover all of the nights and observing windows:
+    date1 = nights[0]
+    date2 = nights[-1]
+    if len( window_tmids )>0:
+        date1 = min( [ date1, np.min( windows['tstart'] ) ] )
+        date2 = max( [ date2, np.max( windows['tend'] ) ] )
+
+    t1 = tprofile.start()
+    sun = body_crossings( obs, date1, date2, [ sun_alt_max, sun_alt_twil, sun_alt_dark ], \
+                          body='sun', method=method )
+    moon_down = body_crossings( obs, date1, date2, [ moon_alt_set ], body='moon', \
+                                method=method )[moon_alt_set]
+    tprofile.stop( 'sunmoon_crossings', t1 )
+
+    # Precess the target coordinates once to the middle of the window:
+    t1 = tprofile.start()
+    jd_epoch = tastro.pyephem2jd( 0.5*( date1 + date2 ) )
+    ras, decs = tastro.precess( np.asarray( tinfo['ra_rads'] )[selected], \
+                                np.asarray( tinfo['dec_rads'] )[selected], jd_epoch )
+    target_up = target_crossings( obs, ras, decs, date1, date2, target_elev_min=target_elev_min )
+    observable = [ tintervals.intersect_intervals( up, sun[sun_alt_max] ) for up in target_up ]
+    tprofile.stop( 'target_crossings', t1 )
+
+    intervals = { 'nights':nights, 'night_labels':night_labels, 'sun':sun, 'moon_down':moon_down, \
+                  'targets':[ tinfo['targets'][i] for i in selected ], 'target_up':target_up, \
+                  'observable':observable, 'windows':windows }
+
+    return intervals
+
+
+def night_intervals( intervals, night ):
+    """
+    Returns a dictionary with the same Sun, Moon and target entries as the
+    output of observing_intervals(), with the intervals clipped to the
+    given night, which can be its position in the 'nights' entry or its
+    label (e.g. '2014/01/31'). The start and end of the night are included
+    as 'start' and 'end'.
+    """
+
+    n = night_number( intervals, night )
+    start = intervals['nights'][n]
+    end = intervals['nights'][n+1]
+    clip = lambda x: tintervals.clip_intervals( x, start, end )
+    output = { 'start':start, 'end':end, \
+               'label':intervals['night_labels'][n], \
+               'sun':dict( [ [ key, clip( intervals['sun'][key] ) ] for key in intervals['sun'] ] ), \
+               'moon_down':clip( intervals['moon_down'] ), \
+               'targets':intervals['targets'], \
+               'target_up':[ clip( x ) for x in intervals['target_up'] ], \
+               'observable':[ clip( x ) for x in intervals['observable'] ] }
+
+    return output
+
+
+def night_number( intervals, night ):
+    """
+    Returns the position of a night in the output of observing_intervals(),
+    given either its position or its label.
+    """
+
+    if type( night )==str:
+        if night not in intervals['night_labels']:
+            raise ValueError( 'night {0} is not covered by the intervals'.format( night ) )
+        n = intervals['night_labels'].index( night )
+    else:
+        n = int( night )
+        if ( n<0 ) or ( n>=len( intervals['night_labels'] ) ):
+            raise ValueError( 'night {0} is not covered by the intervals'.format( night ) )
+
+    return n
+
+
+def observable_windows( intervals, night, moon_down=False ):
+    """
+    Returns the positions in the 'windows' entry of the output of
+    observing_intervals() of the transits/eclipses that are fully observable
+    on a night, given as its position or label, i.e. those whose entire
+    observing window lies within a single interval with the target at or
+    above target_elev_min and the Sun below sun_alt_max. If moon_down is
+    set to True, the Moon must also be below moon_alt_set throughout.
+    """
+
+    n = night_number( intervals, night )
+    windows = intervals['windows']
+    ixs = windows_overlapping( intervals, intervals['nights'][n], intervals['nights'][n+1] )
+    ok = np.zeros( len( ixs ), dtype=bool )
+    for k in np.unique( windows['target'][ixs] ):
+        jxs = ( windows['target'][ixs]==k )
+        tstart = windows['tstart'][ixs][jxs]
+        tend = windows['tend'][ixs][jxs]
+        ok[jxs] = tintervals.within_interval( intervals['observable'][k], tstart, tend )
+    if moon_down:
+        ok *= tintervals.within_interval( intervals['moon_down'], windows['tstart'][ixs], \
+                                          windows['tend'][ixs] )
+
+    return ixs[ok]
+
+
+def windows_overlapping( intervals, date1, date2 ):
+    """
+    Returns the positions in the 'windows' entry of the output of
+    observing_intervals() of the transits/eclipses whose observing windows
+    overlap the span between the pyephem dates date1 and date2 (e.g. a UT
+    range), in order of their start times.
+    """
+
+    ixs = tintervals.overlapping( intervals['windows']['index'], float( ephem.Date( date1 ) ), \
+                                  float( ephem.Date( date2 ) ) )
+
+    return ixs
+
+
+def observatory_name( observatory ):
+    """
+    Returns the name used to label an observatory in the output files,
+    which is either the string identifier for predefined observatories
+    or the 'name' entry of custom-defined observatory dictionaries.
+    """
+
+    if type( observatory )==str:
+        obs_name = observatory
+    else:
+        obs_name = observatory.get( 'name', 'custom_observatory' )
+
+    return obs_name
+
+
+def prepare_targets( sigtype='transits', tr_signals='signals_transits.txt', \
+                     ec_signals='signals_eclipses.txt', exclude_unranked=False, max_rank=None ):
+    """
+    Reads in the basic target information from the ephemeris file along
+    with the transit/eclipse rankings, and works out which targets have
+    been ranked highly enough to be considered by calc_visible(). These
+    steps do not depend on the observatory or the observing window.
+
+    Returns a dictionary containing the lists returned by read_eph() under
+    the keys 'targets', 'vmags', 'ras', 'decs', 'ttrs', 'pers', 'durs',
+    along with the coordinates in radians ('ra_rads', 'dec_rads'), the
+    pyephem database strings for each target ('dbs'), the
+    indices of the targets that should be considered ('selected'), their
+    ranks and whether or not they were ranked ('ranks', 'unranked') and
+    the total number of ranked signals ('nranked').
+    """
+
+    # Read in the basic target information for all transiting exoplanets:
+    eph = load_eph( EPH_FILE )
+    targets = eph['target'].tolist()
+    vmags = eph['vmag'].tolist()
+    ras = eph['ra'].tolist()
+    decs = eph['dec'].tolist()
+    ttrs = eph['ttr'].tolist()
+    pers = eph['per'].tolist()
+    durs = eph['dur'].tolist()
+
+    # Read in the rankings for the relevant signals:
+    if sigtype=='transits':
+        ranks_index = rank_index( tr_signals )
+    elif sigtype=='eclipses':
+        ranks_index = rank_index( ec_signals )
+    else:
+        raise ValueError( 'sigtype must be either \'transits\' or \'eclipses\'' )
+    nranked = len( ranks_index )
+
+    # Create the databases that will be used by pyephem for calculating
+    # ephemerides for each object:
+    ntargets = len( targets )
+    dbs = []
+    for i in range( ntargets ):
+        db_str = '{targ},f|S,{ra},{dec},{vmag}'.format( targ=targets[i], \
+                                                        ra=ras[i], \
+                                                        dec=decs[i], \
+                                                        vmag=vmags[i] )
+        dbs += [ db_str ]
+    ra_rads = eph['ra_rad']
+    dec_rads = eph['dec_rad']
+
+    selected = []
+    ranks = []
+    unrankeds = []
+    for i in range( ntargets ):
+
+        # Check to see if the current target's signal has been ranked,
+        # and if it has, make sure that it was ranked highly enough,
+        # otherwise we skip to the next target straight away:
+        rank_i = lookup_rank( ranks_index, targets[i] )
+        unranked = ( rank_i==None )
+        if unranked==True:
+            if exclude_unranked==True:
+                continue
+        elif ( max_rank!=None )*( max_rank!=-1 ):
+            if rank_i>max_rank:
+                continue
+        selected += [ i ]
+        ranks += [ rank_i ]
+        unrankeds += [ unranked ]
+
+    tinfo = { 'targets':targets, 'vmags':vmags, 'ras':ras, 'decs':decs, \
+              'ttrs':ttrs, 'pers':pers, 'durs':durs, 'dbs':dbs, \
+              'ra_rads':ra_rads, 'dec_rads':dec_rads, \
+              'selected':selected, 'ranks':ranks, 'unranked':unrankeds, \
+              'nranked':nranked }
+
+    return tinfo
+
+
+def add_transit_times( tinfo, date_start, date_end, sigtype='transits' ):
+    """
+    Generates the transit/eclipse mid-times within the window between the
+    pyephem dates date_start and date_end for each of the targets selected
+    by prepare_targets(). These are stored in tinfo under the key 'tmids'
+    as a list with an array for each selected target, with the matching
+    epoch numbers stored under 'epochs' and the window they were generated
+    for stored under 'tmids_window'. The mid-times do not depend on the
+    observatory, so they are only regenerated if the window changes.
+    """
+
+    window = ( float( date_start ), float( date_end ), sigtype )
+    if tinfo.get( 'tmids_window' )==window:
+        return tinfo
+
+    tmids = []
+    epochs = []
+    for i in tinfo['selected']:
+        tmids_i, epochs_i = transit_times( tinfo['ttrs'][i], tinfo['pers'][i], tinfo['durs'][i] / 24., \
+                                           date_start, date_end, sigtype=sigtype )
+        tmids += [ tmids_i ]
+        epochs += [ epochs_i ]
+    tinfo['tmids'] = tmids
+    tinfo['epochs'] = epochs
+    tinfo['tmids_window'] = window
+
+    return tinfo
+
+
+def calc_events( tinfo, obs, date_start, date_end, sigtype='transits', engine='pyephem', \
+                 sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, moon_alt_set=-6, \
+                 target_elev_min=25, oot_deltdur=0.5, sunmoon_step=None, workers=1, \
+                 reuse=None ):
+    """
+    Identifies the visible transits/eclipses for each of the targets selected
+    by prepare_targets() from the pyephem Observer() object obs, between the
+    pyephem dates date_start and date_end. The engine, sunmoon_step and
+    workers arguments are described in calc_visible(), and reuse is
+    described in iter_events().
+
+    Returns a list with an entry for each of the selected targets, which is
+    itself a chronologically-ordered list of dictionaries, one per event.
+    """
+
+    events = []
+    for k, events_k in iter_events( tinfo, obs, date_start, date_end, sigtype=sigtype, \
+                                    engine=engine, sun_alt_max=sun_alt_max, \
+                                    sun_alt_twil=sun_alt_twil, sun_alt_dark=sun_alt_dark, \
+                                    moon_alt_set=moon_alt_set, target_elev_min=target_elev_min, \
+                                    oot_deltdur=oot_deltdur, sunmoon_step=sunmoon_step, \
+                                    workers=workers, reuse=reuse ):
+        events += [ events_k ]
+
+    return events
+
+
+def iter_events( tinfo, obs, date_start, date_end, sigtype='transits', engine='pyephem', \
+                 sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, moon_alt_set=-6, \
+                 target_elev_min=25, oot_deltdur=0.5, sunmoon_step=None, workers=1, \
+                 chunk_size=100, reuse=None ):
+    """
+    Generator version of calc_events() that yields a (k, events_k) tuple for
+    each of the selected targets in turn, where k is the index of the target
+    in tinfo['selected'] and events_k is its chronologically-ordered list of
+    events. The targets are processed in chunks of chunk_size at a time (or
+    farmed out to a pool of worker processes as chunks), so only the events
+    for the chunks currently being processed are held in memory.
+
+    If reuse is set to the events from a previous run returned by
+    load_events(), the targets whose fingerprints (see target_fingerprint())
+    match are not recalculated and their previous events are yielded instead.
+    If the previous run covered a different window, its events that fall
+    outside the new window are dropped and only the transits/eclipses that
+    were outside the previous window are calculated.
+    Targets that can never reach target_elev_min from the observatory (see
+    reachable_targets()) are yielded with no events without being calculated.
+    """
+
+    if engine=='pyephem':
+        calc_func = calc_events_pyephem
+    elif engine=='vectorized':
+        calc_func = calc_events_vectorized
+    else:
+        raise ValueError( 'engine must be either \'pyephem\' or \'vectorized\'' )
+
+    # Generate the transit mid-times if they aren't already available:
+    tinfo = add_transit_times( tinfo, date_start, date_end, sigtype=sigtype )
+    if engine=='pyephem':
+        method = 'pyephem'
+    else:
+        method = 'tastro'
+
+    # Tabulate the Sun and Moon over the observing window, padded to
+    # allow for the longest observations that straddle either end:
+    if sunmoon_step!=None:
+        durs = [ tinfo['durs'][i] / 24. for i in tinfo['selected'] ]
+        pad = ( 1 + oot_deltdur )*max( durs + [ 0 ] ) + sunmoon_step/1440.
+        # Align the samples to a fixed grid so they don't depend on which
+        # targets have been selected:
+        step = sunmoon_step / 1440.
+        table_start = np.floor( ( date_start - pad ) / step )*step
+        t1 = tprofile.start()
+        sunmoon = sunmoon_table( obs, table_start, date_end + pad, \
+                                 step=sunmoon_step, method=method )
+        tprofile.stop( 'sunmoon_table', t1 )
+    else:
+        sunmoon = None
+
+    # Solve for the times that the Sun crosses each of the altitude limits
+    # over the window, which is all that's needed to account for the Sun:
+    t1 = tprofile.start()
+    sun_intervals = window_sun_crossings( tinfo, obs, date_start, date_end, \
+                                          [ sun_alt_max, sun_alt_twil, sun_alt_dark ], \
+                                          oot_deltdur=oot_deltdur, method=method, sunmoon=sunmoon )
+    tprofile.stop( 'sun_crossings', t1 )
+
+    kwargs = { 'sigtype':sigtype, 'sun_alt_max':sun_alt_max, 'sun_alt_twil':sun_alt_twil, \
+               'sun_alt_dark':sun_alt_dark, 'moon_alt_set':moon_alt_set, \
+               'target_elev_min':target_elev_min, 'oot_deltdur':oot_deltdur, \
+               'sunmoon':sunmoon, 'sun_intervals':sun_intervals }
+
+    # Reuse the events of any targets whose inputs haven't changed since
+    # they were saved by save_events():
+    nselected = len( tinfo['selected'] )
+    reused = {}
+    extended = {}
+    if reuse!=None:
+        window = ( float( date_start ), float( date_end ) )
+        for k in range( nselected ):
+            i = tinfo['selected'][k]
+            entry = reuse.get( tinfo['targets'][i], None )
+            if ( entry==None ) or ( entry[0]!=target_fingerprint( tinfo, i ) ):
+                continue
+            if tuple( entry[2] )==window:
+                reused[k] = entry[1]
+                continue
+
+            # Saved for a different window, so keep the events that are still
+            # within the new window and flag the epochs that need calculating:
+            epochs_k = np.asarray( tinfo['epochs'][k] )
+            saved_epochs = transit_times( tinfo['ttrs'][i], tinfo['pers'][i], tinfo['durs'][i] / 24., \
+                                          entry[2][0], entry[2][1], sigtype=sigtype )[1]
+            current = set( epochs_k.tolist() )
+            kept = [ event for event in entry[1] if event['epoch'] in current ]
+            new = ( np.in1d( epochs_k, saved_epochs )==False )
+            if np.any( new ):
+                extended[k] = ( kept, new )
+            else:
+                reused[k] = kept
+    tprofile.count( 'targets_reused', len( reused ) )
+    tprofile.count( 'targets_extended', len( extended ) )
+
+    # Targets that never get high enough in the sky at this site are given
+    # empty event lists straight away, without considering any epochs:
+    reachable = reachable_targets( tinfo, obs, target_elev_min )
+    for k in range( nselected ):
+        if ( reachable[k]==False ) and ( k not in reused ):
+            reused[k] = []
+            extended.pop( k, None )
+            tprofile.count( 'targets_unreachable' )
+    todo = np.array( [ k for k in range( nselected ) if k not in reused ], dtype=int )
+    tprofile.count( 'targets_calculated', len( todo ) )
+
+    # Split the remaining targets into contiguous chunks:
+    parallel = ( workers>1 )*( len( todo )>1 )
+    if parallel:
+        nchunks = min( [ len( todo ), 4*workers ] )
+    else:
+        nchunks = int( np.ceil( len( todo ) / float( max( [ chunk_size, 1 ] ) ) ) )
+    tinfo_chunks = []
+    for ixs in np.array_split( todo, max( [ nchunks, 1 ] ) ):
+        tinfo_chunk = tinfo.copy()
+        if parallel:
+            tinfo_chunk.pop( 'bodies', None ) # pyephem bodies can't be pickled
+        for key in [ 'selected', 'ranks', 'unranked' ]:
+            tinfo_chunk[key] = [ tinfo[key][k] for k in ixs ]
+        for key in [ 'tmids', 'epochs' ]:
+            tinfo_chunk[key] = [ np.asarray( tinfo[key][k] )[extended[k][1]] if k in extended \
+                                 else tinfo[key][k] for k in ixs ]
+        tinfo_chunks += [ ( ixs, tinfo_chunk ) ]
+
+    def calc_chunks():
+        if parallel:
+
+            # Farm the chunks out to a pool of processes; pyephem Observer()
+            # objects can't be pickled so the observatory is passed in as a
+            # dictionary of its properties. The chunks come back in the order
+            # they were sent out, so the events are yielded in the same order
+            # as for a serial run:
+            obs_dict = { 'lat':float( obs.lat ), 'long':float( obs.long ), \
+                         'elevation':obs.elevation, 'pressure':obs.pressure, 'temp':obs.temp }
+            setup = { 'engine':engine, 'obs':obs_dict, 'date_start':float( date_start ), \
+                      'date_end':float( date_end ), 'kwargs':kwargs }
+            pool = multiprocessing.Pool( processes=workers, initializer=init_events_worker, \
+                                         initargs=( setup, ) )
+            try:
+                events_chunks = pool.imap( calc_events_chunk, [ c[1] for c in tinfo_chunks ] )
+                for ( ixs, tinfo_chunk ), events_chunk in itertools.izip( tinfo_chunks, events_chunks ):
+                    yield ixs, events_chunk
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for ixs, tinfo_chunk in tinfo_chunks:
+                t1 = tprofile.start()
+                events_chunk = calc_func( tinfo_chunk, obs, date_start, date_end, **kwargs )
+                tprofile.stop( 'calc_events', t1 )
+                yield ixs, events_chunk
+
+    # Interleave the calculated and reused events in target order, merging
+    # the events kept from a previous window with the new ones:
+    ks_reused = sorted( reused.keys() )
+    r = 0
+    for ixs, events_chunk in calc_chunks():
+        for j in range( len( ixs ) ):
+            while ( r<len( ks_reused ) ) and ( ks_reused[r]<ixs[j] ):
+                yield ks_reused[r], reused[ks_reused[r]]
+                r += 1
+            if ixs[j] in extended:
+                events_j = sorted( extended[ixs[j]][0] + events_chunk[j], key=lambda event: event['ttr'] )
+            else:
+                events_j = events_chunk[j]
+            yield ixs[j], events_j
+    for k in ks_reused[r:]:
+        yield k, reused[k]
+
+
+def merge_events( events ):
+    """
+    Merges per-target event lists into a single chronological sequence.
+    The events argument is an iterable of (k, events_k) tuples, as yielded
+    by iter_events(), where each events_k is already in chronological order,
+    so the merge is done lazily with a heap containing the next event from
+    each target. Yields (k, event) tuples in order of event mid-time.
+    """
+
+    def keyed( k, events_k ):
+        for event in events_k:
+            yield event['mjd'], k, event
+
+    streams = [ keyed( k, events_k ) for k, events_k in events ]
+    for mjd, k, event in heapq.merge( *streams ):
+        yield k, event
+
+
+def events_settings( obs, date_start, date_end, sigtype='transits', engine='pyephem', \
+                     sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, moon_alt_set=-6, \
+                     target_elev_min=25, oot_deltdur=0.5, sunmoon_step=None ):
+    """
+    Returns a dictionary of all the settings other than the target
+    ephemerides that the events calculated by calc_events() depend on.
+    """
+
+    settings = { 'lat':float( obs.lat ), 'long':float( obs.long ), \
+                 'elevation':float( obs.elevation ), 'pressure':float( obs.pressure ), \
+                 'temp':float( obs.temp ), 'date_start':float( date_start ), \
+                 'date_end':float( date_end ), 'sigtype':sigtype, 'engine':engine, \
+                 'sun_alt_max':sun_alt_max, 'sun_alt_twil':sun_alt_twil, \
+                 'sun_alt_dark':sun_alt_dark, 'moon_alt_set':moon_alt_set, \
+                 'target_elev_min':target_elev_min, 'oot_deltdur':oot_deltdur, \
+                 'sunmoon_step':sunmoon_step }
+
+    return settings
+
+
+def target_fingerprint( tinfo, i ):
+    """
+    Returns a hash of the ephemeris of the ith target in tinfo, which
+    changes if any of its coordinates, magnitude, reference mid-time,
+    period or duration change.
+    """
+
+    fingerprint_str = '{0} {1!r} {2!r} {3!r}'.format( tinfo['dbs'][i], tinfo['ttrs'][i], \
+                                                    tinfo['pers'][i], tinfo['durs'][i] )
+
+    return hashlib.sha1( fingerprint_str ).hexdigest()
+
+
+def save_events( events_file, tinfo, events, settings ):
+    """
+    Saves the events returned by calc_events() to a NumPy .npz file, along
+    with the settings returned by events_settings() and the fingerprint of
+    each target (see target_fingerprint()), so that they can be reused by
+    later runs (see load_events()).
+    """
+
+    names = [ tinfo['targets'][i] for i in tinfo['selected'] ]
+    nchar = max( [ len( name ) for name in names ] + [ 1 ] )
+    targets = np.empty( len( names ), dtype=[ ( 'target', 'S{0}'.format( nchar ) ), \
+                                              ( 'fingerprint', 'S40' ) ] )
+    targets['target'] = names
+    targets['fingerprint'] = [ target_fingerprint( tinfo, i ) for i in tinfo['selected'] ]
+    dtype = [ ( 'target', 'S{0}'.format( nchar ) ), ( 'ttr', 'f8' ), ( 'epoch', 'i8' ), \
+              ( 'mjd', 'f8' ), ( 'tstart', 'f8' ), ( 'tend', 'f8' ), ( 'zenith', 'f8' ), \
+              ( 'airmass', 'f8' ), ( 'trtype', 'S21' ), ( 'moonpos', 'S12' ), \
+              ( 'moondist', 'S8' ), ( 'moonphase', 'S8' ), ( 'observable', 'f8' ) ]
+    rows = []
+    for k in range( len( names ) ):
+        for event in events[k]:
+            rows += [ ( names[k], event['ttr'], event['epoch'], event['mjd'], event['tstart'], \
+                        event['tend'], event['zenith'], event['airmass'], event['trtype'], \
+                        event['moonpos'], event['moondist'], event['moonphase'], \
+                        event['observable'] ) ]
+    np.savez( events_file, targets=targets, events=np.array( rows, dtype=dtype ), \
+              settings=json.dumps( settings, sort_keys=True ) )
+
+    return None
+
+
+def load_events( events_file, settings, incremental=False ):
+    """
+    Reads the events saved by save_events(), provided the file exists and
+    was made with the same settings, or with the same settings other than
+    date_start and date_end if incremental is set to True. Returns a
+    dictionary with the target names as keys, each entry containing the
+    target fingerprint, its list of events and the (date_start, date_end)
+    window they were calculated for, or an empty dictionary if the events
+    can't be reused.
+    """
+
+    if os.path.isfile( events_file )==False:
+        return {}
+    saved = np.load( events_file )
+    saved_settings = json.loads( str( saved['settings'] ) )
+    if incremental:
+        compared = [ dict( [ [ key, x[key] ] for key in x if key not in [ 'date_start', 'date_end' ] ] ) \
+                     for x in [ saved_settings, settings ] ]
+    else:
+        compared = [ saved_settings, settings ]
+    if json.dumps( compared[0], sort_keys=True )!=json.dumps( compared[1], sort_keys=True ):
+        return {}
+    if 'observable' not in saved['events'].dtype.names:
+        return {} # saved before the observable fractions were calculated
+    window = ( saved_settings['date_start'], saved_settings['date_end'] )
+    previous = {}
+    for target, fingerprint in saved['targets']:
+        previous[target] = ( fingerprint, [], window )
+    for row in saved['events']:
+        event = { 'ttr':float( row['ttr'] ), 'epoch':int( row['epoch'] ), \
+                  'mjd':float( row['mjd'] ), 'tstart':float( row['tstart'] ), \
+                  'tend':float( row['tend'] ), 'zenith':float( row['zenith'] ), \
+                  'airmass':float( row['airmass'] ), 'trtype':str( row['trtype'] ), \
+                  'moonpos':str( row['moonpos'] ), 'moondist':str( row['moondist'] ), \
+                  'moonphase':str( row['moonphase'] ), 'observable':float( row['observable'] ) }
+        previous[row['target']][1].append( event )
+    saved.close()
+
+    return previous
+
+
+def result_key( observatory, date_start, date_end, tinfo, settings, max_rank=None ):
+    """
+    Returns the key identifying the output files of calc_visible() in the
+    result cache, which is a SHA-1 hash of everything that the contents of
+    the files depend on: the settings returned by events_settings(), which
+    include the observatory coordinates and the thresholds, the observatory
+    name and dates as they appear in the headers, max_rank and the name,
+    ephemeris (see target_fingerprint()), coordinates and rank of each of
+    the targets selected by prepare_targets().
+    """
+
+    sha1 = hashlib.sha1()
+    header = { 'version':RESULT_CACHE_VERSION, 'observatory':observatory_name( observatory ), \
+               'date_start':str( date_start ), 'date_end':str( date_end ), 'settings':settings, \
+               'max_rank':max_rank, 'nranked':tinfo['nranked'] }
+    sha1.update( json.dumps( header, sort_keys=True ) )
+    for k, i in enumerate( tinfo['selected'] ):
+        sha1.update( '{0}|{1}|{2}|{3}|{4}|{5}\n'.format( tinfo['targets'][i], target_fingerprint( tinfo, i ), \
+                                                        tinfo['ras'][i], tinfo['decs'][i], \
+                                                        tinfo['ranks'][k], tinfo['unranked'][k] ) )
+
+    return sha1.hexdigest()
+
+
+def save_result( cache_dir, key, contents_bp, contents_ch, max_bytes=None ):
+    """
+    Saves the contents of the byplanet and chronolog output files to the
+    result cache in cache_dir under key (see result_key()). Each result is
+    stored as a single zlib-compressed file containing the lengths of the
+    two files followed by their contents. The least recently used results
+    are then removed until the cache is no larger than max_bytes, which
+    defaults to RESULT_CACHE_MAX_BYTES. A result that is larger than
+    max_bytes once compressed is not saved at all.
+
+    The index is updated while holding the lock (see lock_result_cache()),
+    and the sizes used for the eviction are taken from the result files on
+    disk, so result files missing from the index (e.g. if another process
+    was killed part-way through saving) are counted and evicted first.
+    """
+
+    if max_bytes==None:
+        max_bytes = RESULT_CACHE_MAX_BYTES
+    if os.path.isdir( cache_dir )==False:
+        os.makedirs( cache_dir )
+    blob = zlib.compress( struct.pack( '<QQ', len( contents_bp ), len( contents_ch ) ) \
+                          + contents_bp + contents_ch )
+    if len( blob )>max_bytes:
+        return None # would be evicted straight away
+    result_file = os.path.join( cache_dir, '{0}.bin'.format( key ) )
+    fd, tmp_file = tempfile.mkstemp( dir=cache_dir, suffix='.tmp' )
+    ofile = os.fdopen( fd, 'wb' )
+    ofile.write( blob )
+    ofile.close()
+
+    lock_result_cache( cache_dir )
+    try:
+        os.rename( tmp_file, result_file )
+        index = read_result_index( cache_dir )
+        index['clock'] += 1
+        index['entries'][key] = { 'size':len( blob ), 'used':index['clock'] }
+        entries = {}
+        for filename in os.listdir( cache_dir ):
+            if filename.endswith( '.bin' )==False:
+                continue
+            k = filename[:-len( '.bin' )]
+            entries[k] = index['entries'].get( k, { 'used':0 } )
+            entries[k]['size'] = os.path.getsize( os.path.join( cache_dir, filename ) )
+        index['entries'] = entries
+        total = sum( [ entries[k]['size'] for k in entries ] )
+        for k in sorted( entries.keys(), key=lambda k: entries[k]['used'] ):
+            if total<=max_bytes:
+                break
+            total -= entries[k]['size']
+            remove_result( cache_dir, k )
+            del entries[k]
+        write_result_index( cache_dir, index )
+    finally:
+        unlock_result_cache( cache_dir )
+
+    return None
+
+
+def load_result( cache_dir, key ):
+    """
+    Returns the contents of the byplanet and chronolog output files saved
+    under key in the result cache in cache_dir (see save_result()) as a
+    tuple of strings, marking them as the most recently used, or None if
+    they aren't in the cache. The lock is held throughout (see
+    lock_result_cache()), so the result can't be evicted while it is read.
+    """
+
+    if os.path.isfile( os.path.join( cache_dir, RESULT_CACHE_INDEX ) )==False:
+        return None
+    lock_result_cache( cache_dir )
+    try:
+        index = read_result_index( cache_dir )
+        if key not in index['entries']:
+            return None
+        result_file = os.path.join( cache_dir, '{0}.bin'.format( key ) )
+        try:
+            ifile = open( result_file, 'rb' )
+            blob = zlib.decompress( ifile.read() )
+            ifile.close()
+            nbp, nch = struct.unpack( '<QQ', blob[:16] )
+            if len( blob )!=16 + nbp + nch:
+                raise ValueError( 'truncated result' )
+        except ( IOError, zlib.error, struct.error, ValueError ):
+            # Missing or damaged, so drop it from the cache:
+            remove_result( cache_dir, key )
+            del index['entries'][key]
+            write_result_index( cache_dir, index )
+            return None
+        index['clock'] += 1
+        index['entries'][key]['used'] = index['clock']
+        write_result_index( cache_dir, index )
+    finally:
+        unlock_result_cache( cache_dir )
+
+    return blob[16:16+nbp], blob[16+nbp:]
+
+
+def lock_result_cache( cache_dir ):
+    """
+    Acquires the lock on the index of the result cache in cache_dir, so
+    that processes sharing the cache don't overwrite each other's changes
+    to the index. The lock is a file that is created exclusively, waiting
+    for any other process holding it to remove it. A lock file older than
+    RESULT_CACHE_LOCK_TIMEOUT seconds is assumed to have been left behind
+    by a process that died and is removed. Release the lock with
+    unlock_result_cache().
+    """
+
+    lock_file = os.path.join( cache_dir, RESULT_CACHE_LOCK )
+    while True:
+        try:
+            fd = os.open( lock_file, os.O_CREAT|os.O_EXCL|os.O_WRONLY )
+            os.close( fd )
+            break
+        except OSError as err:
+            if err.errno!=errno.EEXIST:
+                raise
+        try:
+            if ( time.time() - os.path.getmtime( lock_file ) )>RESULT_CACHE_LOCK_TIMEOUT:
+                os.remove( lock_file )
+                continue
+        except OSError:
+            continue # released in the meantime
+        time.sleep( 0.01 )
+
+    return None
+
+
+def unlock_result_cache( cache_dir ):
+    """
+    Releases the lock acquired by lock_result_cache().
+    """
+
+    lock_file = os.path.join( cache_dir, RESULT_CACHE_LOCK )
+    if os.path.isfile( lock_file ):
+        os.remove( lock_file )
+
+    return None
+
+
+def remove_result( cache_dir, key ):
+    """
+    Deletes the file holding the result saved under key in cache_dir.
+    """
+
+    result_file = os.path.join( cache_dir, '{0}.bin'.format( key ) )
+    if os.path.isfile( result_file ):
+        os.remove( result_file )
+
+    return None
+
+
+def read_result_index( cache_dir ):
+    """
+    Returns the index of the result cache in cache_dir, which is a dictionary
+    containing a counter that is incremented every time a result is saved or
+    loaded ('clock') and a dictionary with the keys of the results as keys,
+    each entry containing the size of the result file in bytes ('size') and
+    the value of the counter when it was last used ('used').
+    """
+
+    index_file = os.path.join( cache_dir, RESULT_CACHE_INDEX )
+    index = { 'clock':0, 'entries':{} }
+    if os.path.isfile( index_file )==False:
+        return index
+    ifile = open( index_file, 'r' )
+    try:
+        index = json.load( ifile )
+    except ValueError:
+        pass
+    finally:
+        ifile.close()
+
+    return index
+
+
+def write_result_index( cache_dir, index ):
+    """
+    Saves the index of the result cache in cache_dir (see read_result_index()).
+    """
+
+    index_file = os.path.join( cache_dir, RESULT_CACHE_INDEX )
+    tmp_file = '{0}.tmp'.format( index_file )
+    ofile = open( tmp_file, 'w' )
+    json.dump( index, ofile, sort_keys=True )
+    ofile.close()
+    os.rename( tmp_file, index_file )
+
+    return None
+
+
+def reachable_targets( tinfo, obs, target_elev_min ):
+    """
+    Returns a boolean array flagging which of the targets selected by
+    prepare_targets() can reach an altitude of target_elev_min degrees
+    from the pyephem Observer() object obs. The maximum altitude of a
+    target, reached as it crosses the meridian, is 90 - |lat - dec|. This
+    is increased by PREFILTER_MARGIN degrees to allow for refraction and
+    precession of the J2000 coordinates, so no target is rejected that
+    calc_events() would have found visible.
+    """
+
+    decs = np.asarray( tinfo['dec_rads'], dtype=float )[tinfo['selected']]
+    alt_max = np.rad2deg( tastro.max_altitude( decs, float( obs.lat ) ) )
+
+    return ( alt_max + PREFILTER_MARGIN )>=target_elev_min
+
+
+def candidate_epochs( tinfo, obs, date_start, date_end, sun_intervals, sun_alt_max=-6, \
+                      target_elev_min=25 ):
+    """
+    Works out which of the transit/eclipse mid-times generated by
+    add_transit_times() could be observable, before any pyephem
+    calculations are made, by rejecting those where the Sun is above
+    sun_alt_max according to the intervals returned by sun_crossings()
+    and those that certainly have the target too low (see high_epochs()).
+    The target coordinates are precessed once to the middle of the window
+    between the pyephem dates date_start and date_end, and the epochs of
+    all the targets are checked at once.
+
+    Returns a list with a boolean array for each selected target.
+    """
+
+    selected = tinfo['selected']
+    nepochs = [ len( tmids_k ) for tmids_k in tinfo['tmids'] ]
+    if sum( nepochs )==0:
+        return [ np.zeros( n, dtype=bool ) for n in nepochs ]
+    dates = np.concatenate( [ np.asarray( tmids_k, dtype=float ) for tmids_k in tinfo['tmids'] ] )
+    kixs = np.repeat( np.arange( len( selected ) ), nepochs )
+
+    jd_epoch = tastro.pyephem2jd( 0.5*( float( date_start ) + float( date_end ) ) )
+    ras, decs = tastro.precess( np.asarray( tinfo['ra_rads'] )[selected], \
+                                np.asarray( tinfo['dec_rads'] )[selected], jd_epoch )
+    night = tintervals.in_intervals( sun_intervals[sun_alt_max], dates )
+    high = high_epochs( obs, ras[kixs], decs[kixs], dates, target_elev_min )
+    if tprofile.PROFILE!=None:
+        tprofile.count( 'rejected_sun', int( np.sum( night==False ) ) )
+        tprofile.count( 'rejected_altitude_analytic', int( np.sum( night*( high==False ) ) ) )
+
+    return np.split( night*high, np.cumsum( nepochs )[:-1] )
+
+
+def high_epochs( obs, ra, dec, dates, target_elev_min ):
+    """
+    Returns a boolean array flagging which of the pyephem dates could have
+    fixed targets with coordinates ra and dec (radians, already precessed to
+    around the dates) at or above target_elev_min degrees, as seen from the
+    pyephem Observer() object obs. The altitudes are evaluated analytically
+    from the local sidereal time using the tastro module, including
+    refraction, and are allowed PREFILTER_MARGIN degrees of slack for the
+    neglected nutation and aberration, so only dates where the target is
+    certainly too low are rejected.
+    """
+
+    if len( dates )==0:
+        return np.zeros( 0, dtype=bool )
+    jd = tastro.pyephem2jd( dates )
+    alt = tastro.altaz( ra, dec, jd, float( obs.lat ), float( obs.long ) )[0]
+    alt = alt + tastro.refraction( alt, pressure=obs.pressure, temp=obs.temp )
+
+    return ( np.rad2deg( alt ) + PREFILTER_MARGIN )>=target_elev_min
+
+
+def init_events_worker( setup ):
+    """
+    Initialises a calc_events() worker process with the settings that are
+    shared between all chunks of targets, so that these (including any
+    Sun/Moon table) only need to be sent to each process once.
+    """
+
+    WORKER_SETUP.clear()
+    WORKER_SETUP.update( setup )
+
+    return None
+
+
+def calc_events_chunk( tinfo ):
+    """
+    Worker function used by calc_events() to calculate the events for a
+    chunk of targets in a separate process, using the settings stored
+    by init_events_worker().
+    """
+
+    obs_dict = WORKER_SETUP['obs']
+    obs = ephem.Observer()
+    obs.lat = obs_dict['lat']
+    obs.long = obs_dict['long']
+    obs.elevation = obs_dict['elevation']
+    obs.pressure = obs_dict['pressure']
+    obs.temp = obs_dict['temp']
+    if WORKER_SETUP['engine']=='pyephem':
+        calc_func = calc_events_pyephem
+    else:
+        calc_func = calc_events_vectorized
+    events = calc_func( tinfo, obs, WORKER_SETUP['date_start'], WORKER_SETUP['date_end'], \
+                        **WORKER_SETUP['kwargs'] )
 
-    # Create the observatory and timezone objects:
-    obs, tz = setup_observatory( observatory )
-    if ( obs==None ) and ( tz==None ):
-        ofile_bp.close()
-        os.remove( ofilename_byplanet )
-        return None
+    return events
 
-    # Generate instances of the Sun and Moon:
-    sun = ephem.Sun()
-    moon = ephem.Moon()
 
-    # Convert start and end dates of observing period
-    # to pyephem float objects:
-    date_start = ephem.Date( date_start )
-    date_end = ephem.Date( date_end )
+def calc_events_pyephem( tinfo, obs, date_start, date_end, sigtype='transits', \
+                         sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, moon_alt_set=-6, \
+                         target_elev_min=25, oot_deltdur=0.5, sunmoon=None, sun_intervals=None ):
+    """
+    Identifies visible transits/eclipses one event at a time, with the
+    target and Moon positions calculated using pyephem. If a table
+    generated by sunmoon_table() is passed in as sunmoon, the Moon
+    quantities are interpolated from it instead. The Sun is accounted
+    for using the intervals returned by sun_crossings(), which are
+    calculated here if they aren't passed in as sun_intervals.
+    """
+
+    # Generate an instance of the Moon:
+    moon = ephem.Moon()
 
-    # Go through the targets one-at-a-time, checking for visible transits:
-    mjds = []
-    date_floats = []
-    outstrs_ch = []
+    targets = tinfo['targets']
+    ntargets = len( targets )
+    bodies = tinfo.setdefault( 'bodies', {} )
+    if sun_intervals==None:
+        sun_intervals = window_sun_crossings( tinfo, obs, date_start, date_end, \
+                                              [ sun_alt_max, sun_alt_twil, sun_alt_dark ], \
+                                              oot_deltdur=oot_deltdur, method='pyephem', \
+                                              sunmoon=sunmoon )
+    candidates = candidate_epochs( tinfo, obs, date_start, date_end, sun_intervals, \
+                                   sun_alt_max=sun_alt_max, target_elev_min=target_elev_min )
+    events = []
     print '\nCalculating visible transits for:'
-    for i in range( ntargets ):
+    for k in range( len( tinfo['selected'] ) ):
 
+        i = tinfo['selected'][k]
         print '  ... target {0:d} of {1:d} --> {2} '\
               .format( i+1, ntargets, targets[i] )
-        first_i = True
-        per_i = pers[i]
-        dur_i = durs[i] / 24.
+        kept_i = []
+        dur_i = tinfo['durs'][i] / 24.
         
-        # Initiate the ephem object for the target:
-        target_i = ephem.readdb( dbs[i] )
-
-        # Check to see if the current target's signal has been ranked,
-        # and if it has, make sure that it was ranked highly enough,
-        # otherwise we skip to the next target straight away:
-        if sigtype=='transits':
-            nranked = len( targets_tr )
-            for j in range( nranked ):
-                if targets_tr[j]==target_i.name:
-                    rank_i = int( ranks_tr[j] )
-                    if ( max_rank!=None ):
-                        if ( max_rank != -1 ) * ( rank_i>max_rank ):
-                            include = False
-                        else:
-                            include = True
-                    unranked = False
-                    break
-                else:
-                    if j==nranked-1:
-                        unranked = True
-        elif sigtype=='eclipses':
-            nranked = len( targets_ec )
-            for j in range( nranked ):
-                if targets_ec[j]==target_i.name:
-                    rank_i = int( ranks_ec[j] )
-                    if ( max_rank!=None ):
-                        if ( max_rank!=-1 ) * ( rank_i>max_rank ):
-                            include = False
-                        else:
-                            include = True
-                    unranked = False
-                    break
-                else:
-                    if j==nranked-1:
-                        unranked = True
-        # See if we want to skip the current target for some reason:
-        if unranked==True:
-            if exclude_unranked==True:
-                continue
-        else:
-            if include==False:
-                continue
-                    
-        # Convert the JD transit time to a pyephem date:
-        ttr_i = jd2pyephemdate( ttrs[i] )
-
-        # If we're wanting eclipse information, approximate the eclipse
-        # time by subtracting half a period (the more eccentric the orbit,
-        # the worse this approximation will be):
-        if sigtype=='eclipses':
-            ttr_i -= 0.5 * per_i
-
-        # Find the transit with mid-time occurring immediately
-        # before the observing run:
-        if ttr_i>date_start:
-            while ttr_i>date_start:
-                ttr_i -= per_i
-        else:
-            while ttr_i<date_start:
-                ttr_i += per_i
-            ttr_i -= per_i
-
-        # If it's not even partially visible, start at the next transit: 
-        if ( ttr_i + 0.5*dur_i )<date_start:
-            ttr_i += per_i
-
-        # Now that we have a starting time, loop over successive transits
-        # until we reach the one with mid-time immediately before the end
-        # of the observing window:
-        while ttr_i<date_end:
+        # Initiate the ephem object for the target, reusing it if it has
+        # already been set up for another observatory:
+        if i not in bodies:
+            bodies[i] = ephem.readdb( tinfo['dbs'][i] )
+        target_i = bodies[i]
+
+        # Loop over the successive transits that fall within the window,
+        # skipping those that can't be observable (see candidate_epochs()),
+        # which includes all those with the Sun too high at mid-time:
+        ixs = candidates[k]
+        for ttr_i, epoch_i in zip( np.asarray( tinfo['tmids'][k] )[ixs], \
+                                   np.asarray( tinfo['epochs'][k] )[ixs] ):
 
             # Set the UT date of the current transit within the
             # observatory object:
@@ -274,267 +1621,845 @@ def calc_visible( observatory, date_start, date_end, sigtype='transits', \
             # Update the target ephemerides and calculate its
             # elevation in the sky:
             target_i.compute( obs )
+            tprofile.count( 'compute_target' )
             target_i_alt_midtime = np.rad2deg( float( target_i.alt ) )
-            # If the target is not above the minimum elevation, bump up to
-            # the next transit and go back to the top of the loop:
+            # If the target is not above the minimum elevation, skip
+            # to the next transit:
             if target_i_alt_midtime<target_elev_min:
-                ttr_i += per_i
+                tprofile.count( 'rejected_altitude' )
                 continue
 
             # Given the altitude, calculate the approximate airmass:
             zenith_i_midtime = 90 - target_i_alt_midtime
             airmass = calc_airmass( zenith_i_midtime )
             
-            # Update the Sun and Moon ephemerides and work out
-            # their elevations with respect to the horizon:
-            sun.compute( obs )
-            sun_alt_midtime = np.rad2deg( float( sun.alt ) )
-            moon.compute( obs )
-            moon_alt_midtime = np.rad2deg( float( moon.alt ) )
-            # If the Sun is above the maximum elevation limit, bump up to
-            # the next transit and go back to the top of the loop:
-            if sun_alt_midtime>sun_alt_max:
-                ttr_i += per_i
+            # Look up the Moon in the table if we have one, otherwise
+            # update its ephemerides at mid-time and at the start and
+            # end of the observations:
+            if sunmoon!=None:
+                offsets = np.array( [ 0, -( 0.5 + oot_deltdur ), ( 0.5 + oot_deltdur ) ] )
+                sm = interp_sunmoon( sunmoon, ttr_i + offsets*dur_i )
+                moonphase = '{0:d}'.format( int( np.round( sm['moon_phase'][0] ) ) )
+                moondist = tastro.separation( float( target_i.az ), float( target_i.alt ), \
+                                              np.deg2rad( sm['moon_az'][0] ), np.deg2rad( sm['moon_alt'][0] ) )
+                moondist = '{0:d}'.format( int( np.round( np.rad2deg( moondist ) ) ) )
+                moon_alt_start, moon_alt_end = sm['moon_alt'][1:]
+            else:
+                moon.compute( obs )
+                # Get the Moon phase as a percentage of the illuminated face:
+                moonphase = '{0:d}'.format( int( np.round( moon.phase ) ) )
+                # Get the target-Moon angular separation:
+                moondist = int( np.round( np.rad2deg( ephem.separation( ( target_i.az, target_i.alt ), \
+                                                                          ( moon.az, moon.alt ) ) ) ) )
+                moondist = '{0:d}'.format( moondist )
+                obs.date = ttr_i - dur_i*( 0.5 + oot_deltdur )
+                moon.compute( obs )
+                moon_alt_start = np.rad2deg( float( moon.alt ) )
+                obs.date = ttr_i + dur_i*( 0.5 + oot_deltdur )
+                moon.compute( obs )
+                moon_alt_end = np.rad2deg( float( moon.alt ) )
+                tprofile.count( 'compute_moon', 3 )
+
+            moonpos = classify_moon( moon_alt_start, moon_alt_end, moon_alt_set=moon_alt_set )
+            if moonpos=='moon-down':
+                moonphase = '-'
+                moondist = '-'
+            kept_i += [ ( ttr_i, epoch_i, zenith_i_midtime, airmass, moonpos, moondist, moonphase ) ]
+
+        # Work out how much of each transit can be observed with the Sun
+        # low enough, for all of the transits of the current target at once:
+        ttrs_i = np.array( [ kept[0] for kept in kept_i ] )
+        trtypes, observable = classify_sun( sun_intervals, ttrs_i, dur_i, oot_deltdur=oot_deltdur, \
+                                            sun_alt_max=sun_alt_max, sun_alt_twil=sun_alt_twil, \
+                                            sun_alt_dark=sun_alt_dark )
+        events_i = []
+        for j in range( len( kept_i ) ):
+            ttr_i, epoch_i, zenith_i_midtime, airmass, moonpos, moondist, moonphase = kept_i[j]
+            events_i += [ make_event( ttr_i, epoch_i, dur_i, zenith_i_midtime, airmass, \
+                                      trtypes[j], moonpos, moondist, moonphase, \
+                                      observable=observable[j] ) ]
+        tprofile.count( 'events_evaluated', len( tinfo['tmids'][k] ) )
+        events += [ events_i ]
+
+    return events
+
+
+def calc_events_vectorized( tinfo, obs, date_start, date_end, sigtype='transits', \
+                            sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, moon_alt_set=-6, \
+                            target_elev_min=25, oot_deltdur=0.5, sunmoon=None, sun_intervals=None ):
+    """
+    Identifies visible transits/eclipses for all epochs of all targets at
+    once. The epochs are concatenated into flat NumPy arrays and the target
+    and Moon altitudes are evaluated in bulk using the low-precision formulae
+    in the tastro module, so no pyephem compute() calls are made. If a table
+    generated by sunmoon_table() is passed in as sunmoon, the Moon quantities
+    are interpolated from it instead. The Sun is accounted for using the
+    intervals returned by sun_crossings(), which are calculated here with
+    the tastro module if they aren't passed in as sun_intervals.
+    """
+
+    lat = float( obs.lat )
+    lon = float( obs.long )
+    atm = { 'pressure':obs.pressure, 'temp':obs.temp }
+    selected = tinfo['selected']
+    nselected = len( selected )
+    events = [ [] for k in range( nselected ) ]
+
+    # Concatenate the transit mid-times for all targets, keeping track
+    # of which target each epoch belongs to:
+    kixs = []
+    ttrs = []
+    epochs = []
+    for k in range( nselected ):
+        ttrs_k = tinfo['tmids'][k]
+        ttrs += [ ttrs_k ]
+        epochs += [ tinfo['epochs'][k] ]
+        kixs += [ k*np.ones( len( ttrs_k ), dtype=int ) ]
+    if nselected==0:
+        return events
+    ttrs = np.concatenate( ttrs )
+    epochs = np.concatenate( epochs )
+    kixs = np.concatenate( kixs )
+    if len( ttrs )==0:
+        return events
+    ras = tinfo['ra_rads'][selected][kixs]
+    decs = tinfo['dec_rads'][selected][kixs]
+    durs = np.array( [ tinfo['durs'][i] for i in selected ] )[kixs] / 24.
+    if sun_intervals==None:
+        sun_intervals = window_sun_crossings( tinfo, obs, date_start, date_end, \
+                                              [ sun_alt_max, sun_alt_twil, sun_alt_dark ], \
+                                              oot_deltdur=oot_deltdur, method='tastro', \
+                                              sunmoon=sunmoon )
+
+    # Calculate the target altitudes at the transit mid-times and discard
+    # the transits where the target is too low or the Sun too high:
+    jd = tastro.pyephem2jd( ttrs )
+    target_alt, target_az = tastro.fixed_altaz( ras, decs, jd, lat, lon, **atm )
+    target_alt = np.rad2deg( target_alt )
+    sun_ok = tintervals.in_intervals( sun_intervals[sun_alt_max], ttrs )
+    ixs = ( target_alt>=target_elev_min )*sun_ok
+    if tprofile.PROFILE!=None:
+        tprofile.count( 'events_evaluated', len( ttrs ) )
+        tprofile.count( 'rejected_altitude', int( np.sum( target_alt<target_elev_min ) ) )
+        tprofile.count( 'rejected_sun', int( np.sum( ( target_alt>=target_elev_min )*( sun_ok==False ) ) ) )
+    ttrs, epochs, kixs, durs, jd = ttrs[ixs], epochs[ixs], kixs[ixs], durs[ixs], jd[ixs]
+    target_alt, target_az = target_alt[ixs], target_az[ixs]
+    zenith = 90 - target_alt
+    airmass = calc_airmass( zenith )
+
+    # Classify the transits according to the Sun altitude:
+    trtypes, observable = classify_sun( sun_intervals, ttrs, durs, oot_deltdur=oot_deltdur, \
+                                        sun_alt_max=sun_alt_max, sun_alt_twil=sun_alt_twil, \
+                                        sun_alt_dark=sun_alt_dark )
+
+    # Evaluate the Moon altitudes at the start and end of the observations:
+    offsets = np.array( [ -( 0.5 + oot_deltdur ), ( 0.5 + oot_deltdur ) ] )
+    jds = jd[np.newaxis,:] + offsets[:,np.newaxis]*durs[np.newaxis,:]
+    if sunmoon!=None:
+        moon_alts = interp_sunmoon( sunmoon, jds - tastro.PYEPHEM_JD0 )['moon_alt']
+    else:
+        moon_alts = np.rad2deg( tastro.moon_altaz( jds, lat, lon, **atm )[0] )
+
+    # Moon position and phase at the transit mid-times:
+    if sunmoon!=None:
+        sm = interp_sunmoon( sunmoon, ttrs )
+        moon_alt = np.deg2rad( sm['moon_alt'] )
+        moon_az = np.deg2rad( sm['moon_az'] )
+        moonphases = sm['moon_phase']
+    else:
+        moon_alt, moon_az = tastro.moon_altaz( jd, lat, lon, **atm )
+        moonphases = tastro.moon_phase( jd )
+    moondists = np.rad2deg( tastro.separation( target_az, np.deg2rad( target_alt ), moon_az, moon_alt ) )
+
+    for j in range( len( ttrs ) ):
+        moonpos = classify_moon( moon_alts[0,j], moon_alts[1,j], moon_alt_set=moon_alt_set )
+        if moonpos=='moon-down':
+            moonphase = '-'
+            moondist = '-'
+        else:
+            moonphase = '{0:d}'.format( int( np.round( moonphases[j] ) ) )
+            moondist = '{0:d}'.format( int( np.round( moondists[j] ) ) )
+        events[kixs[j]] += [ make_event( ttrs[j], epochs[j], durs[j], zenith[j], airmass[j], \
+                                         trtypes[j], moonpos, moondist, moonphase, \
+                                         observable=observable[j] ) ]
+
+    return events
+
+
+def compare_engines( observatory, date_start, date_end, sigtype='transits', \
+                     sun_alt_max=-6, sun_alt_twil=-12, sun_alt_dark=-18, \
+                     moon_alt_set=-6, target_elev_min=25, oot_deltdur=0.5, \
+                     tr_signals='signals_transits.txt', ec_signals='signals_eclipses.txt', \
+                     exclude_unranked=False, max_rank=None, zenith_tol=1, airmass_tol=0.05, \
+                     moondist_tol=2, moonphase_tol=2, mismatch_frac_tol=0.02 ):
+    """
+    Runs the 'pyephem' and 'vectorized' engines of calc_visible() on the same
+    inputs and checks that they agree to within the specified tolerances.
+
+    Events are matched by target and mid-time. The zenith angle, airmass, Moon
+    distance and Moon phase of matched events must agree to within zenith_tol,
+    airmass_tol, moondist_tol and moonphase_tol respectively. Events that are
+    only found by one engine, or that are classified differently, are expected
+    occasionally for altitudes lying right on one of the thresholds, so they
+    are only treated as a failure if they make up more than mismatch_frac_tol
+    of the events found by the pyephem engine.
+
+    Returns a dictionary summarising the comparison, where the 'passed' entry
+    is True if the engines agree to within the tolerances.
+    """
+
+    tinfo = prepare_targets( sigtype=sigtype, tr_signals=tr_signals, ec_signals=ec_signals, \
+                             exclude_unranked=exclude_unranked, max_rank=max_rank )
+    obs, tz = setup_observatory( observatory )
+    date_start = ephem.Date( date_start )
+    date_end = ephem.Date( date_end )
+    kwargs = { 'sigtype':sigtype, 'sun_alt_max':sun_alt_max, 'sun_alt_twil':sun_alt_twil, \
+               'sun_alt_dark':sun_alt_dark, 'moon_alt_set':moon_alt_set, \
+               'target_elev_min':target_elev_min, 'oot_deltdur':oot_deltdur }
+    events_ref = calc_events( tinfo, obs, date_start, date_end, engine='pyephem', **kwargs )
+    events_vec = calc_events( tinfo, obs, date_start, date_end, engine='vectorized', **kwargs )
+
+    nref = 0
+    nunmatched = 0
+    ntrtype = 0
+    nmoonpos = 0
+    diffs = { 'zenith':[ 0 ], 'airmass':[ 0 ], 'moondist':[ 0 ], 'moonphase':[ 0 ] }
+    for k in range( len( tinfo['selected'] ) ):
+        ref_k = dict( [ ( e['ttr'], e ) for e in events_ref[k] ] )
+        vec_k = dict( [ ( e['ttr'], e ) for e in events_vec[k] ] )
+        nref += len( ref_k )
+        nunmatched += len( set( ref_k.keys() ).symmetric_difference( vec_k.keys() ) )
+        for ttr in set( ref_k.keys() ).intersection( vec_k.keys() ):
+            e1 = ref_k[ttr]
+            e2 = vec_k[ttr]
+            ntrtype += ( e1['trtype']!=e2['trtype'] )
+            if e1['moonpos']!=e2['moonpos']:
+                nmoonpos += 1
                 continue
-            # Get the Moon phase as a percentage of the illuminated face:
-            moonphase = '{0:d}'.format( int( np.round( moon.phase ) ) )
-            # Get the target-Moon angular separation:
-            moondist = int( np.round( np.rad2deg( ephem.separation( ( target_i.az, target_i.alt ), \
-                                                                      ( moon.az, moon.alt ) ) ) ) )
-            moondist = '{0:d}'.format( moondist )
-
-            # If we make it to here we will consider the transit potentially
-            # observable. Next, evaluate whether or not its detectability rank
-            # meets our requirements:
-            if first_i==True:
-
-                # Write the header for the current object to the output file:
-                nchar = max( [ len( colheadingsa_bp ), len( colheadingsb_bp ) ] )
-                ofile_bp.write( '\n\n{0}\n#\n'.format( '#'*( nchar_bp ) ) )
-                if unranked==True:
-                    if sigtype=='transits':
-                        header_str = '#  {0}   -->   not enough information to rank primary transit signal \n#\n'\
-                                     .format( targets[i]  )
-                    else:
-                        header_str = '#  {0}   -->   not enough information to rank secondary eclipse signal \n#\n'\
-                                     .format( targets[i]  )
-                else:
-                    if sigtype=='transits':
-                        header_str = '#  {0}   -->   primary transit signal ranked {1} out of {2} \n#\n'\
-                                     .format( targets[i], str( rank_i ), str( nranked ) )
-                    else:
-                        header_str = '#  {0}   -->   secondary eclipse signal ranked {1} out of {2} \n#\n'\
-                                     .format( targets[i], str( rank_i ), str( nranked ) )
-                header_str += '#  RA (hh mm ss.s) Dec (dd mm ss.s)\n'
-                ra_str = ras[i].replace( ':', ' ' )
-                dec_str = decs[i].replace( ':', ' ' )
-                header_str += '#  {0} {1}\n#\n'.format( ra_str, dec_str )
-                header_str += colheadingsa_bp
-                header_str += colheadingsb_bp
-
-                ofile_bp.write( header_str )
-                ofile_bp.write( '{0}{1}\n'.format( '#', '-'*( nchar_bp-1 ) ) )
-                
-                first_i = False
-                
-            # Now we want to work out some more details about
-            # what kind of transit it will be.
-
-            # Determine the Sun, Moon and target elevations
-            # at the start of the observations:
-            obs.date = ttr_i - dur_i*( 0.5 + oot_deltdur )
-            sun.compute( obs )
-            sun_alt_start = np.rad2deg( float( sun.alt ) )
-            moon.compute( obs )
-            moon_alt_start = np.rad2deg( float( moon.alt ) )
-            target_i.compute( obs )
-            target_i_alt_start = np.rad2deg( float( target_i.alt ) )            
+            diffs['zenith'] += [ abs( e1['zenith'] - e2['zenith'] ) ]
+            diffs['airmass'] += [ abs( e1['airmass'] - e2['airmass'] ) ]
+            if e1['moonpos']!='moon-down':
+                diffs['moondist'] += [ abs( int( e1['moondist'] ) - int( e2['moondist'] ) ) ]
+                diffs['moonphase'] += [ abs( int( e1['moonphase'] ) - int( e2['moonphase'] ) ) ]
+
+    summary = { 'nevents':nref, 'nunmatched':nunmatched, 'ntrtype_mismatch':ntrtype, \
+                'nmoonpos_mismatch':nmoonpos }
+    for key in diffs.keys():
+        summary[ 'max_{0}_diff'.format( key ) ] = np.max( diffs[key] )
+    nmismatch = nunmatched + ntrtype + nmoonpos
+    summary['passed'] = ( summary['max_zenith_diff']<=zenith_tol ) \
+                        and ( summary['max_airmass_diff']<=airmass_tol ) \
+                        and ( summary['max_moondist_diff']<=moondist_tol ) \
+                        and ( summary['max_moonphase_diff']<=moonphase_tol ) \
+                        and ( nmismatch<=mismatch_frac_tol*max( [ nref, 1 ] ) )
+
+    print '\nComparison of pyephem and vectorized engines:'
+    for key in sorted( summary.keys() ):
+        print '  {0} = {1}'.format( key, summary[key] )
+
+    return summary
+
+
+def sunmoon_table( obs, date_start, date_end, step=10., method='pyephem' ):
+    """
+    Tabulates the Sun and Moon as seen from the pyephem Observer() object
+    obs, sampled every step minutes between the pyephem dates date_start
+    and date_end. The quantities are calculated with pyephem if method is
+    'pyephem', or in bulk with the low-precision formulae in the tastro
+    module if method is 'tastro'.
+
+    Returns a dictionary containing arrays of the pyephem dates ('dates'),
+    the Sun and Moon altitudes in degrees ('sun_alt', 'moon_alt'), the Moon
+    azimuth in degrees ('moon_az', unwrapped so that it can be interpolated)
+    and the percentage of the Moon that is illuminated ('moon_phase'). The
+    values at other times can be obtained with interp_sunmoon().
+    """
 
-            # Do the same for the end of the observations:
-            obs.date = ttr_i + dur_i*( 0.5 + oot_deltdur )
+    nsteps = max( [ int( np.ceil( ( date_end - date_start )*1440. / step ) ) + 1, 0 ] )
+    dates = float( date_start ) + ( step / 1440. )*np.arange( nsteps )
+
+    if method=='pyephem':
+        obs = obs.copy() # leave the date of the input observer untouched
+        sun = ephem.Sun()
+        moon = ephem.Moon()
+        sun_alt = np.zeros( nsteps )
+        moon_alt = np.zeros( nsteps )
+        moon_az = np.zeros( nsteps )
+        moon_phase = np.zeros( nsteps )
+        for i in range( nsteps ):
+            obs.date = dates[i]
             sun.compute( obs )
-            sun_alt_end = np.rad2deg( float( sun.alt ) )
             moon.compute( obs )
-            moon_alt_end = np.rad2deg( float( moon.alt ) )
-            target_i.compute( obs )
-            target_i_alt_end = np.rad2deg( float( target_i.alt ) )
+            sun_alt[i] = float( sun.alt )
+            moon_alt[i] = float( moon.alt )
+            moon_az[i] = float( moon.az )
+            moon_phase[i] = moon.phase
+        tprofile.count( 'compute_sun', nsteps )
+        tprofile.count( 'compute_moon', nsteps )
+    elif method=='tastro':
+        lat = float( obs.lat )
+        lon = float( obs.long )
+        jd = tastro.pyephem2jd( dates )
+        sun_alt = tastro.sun_altaz( jd, lat, lon, pressure=obs.pressure, temp=obs.temp )[0]
+        moon_alt, moon_az = tastro.moon_altaz( jd, lat, lon, pressure=obs.pressure, temp=obs.temp )
+        moon_phase = tastro.moon_phase( jd )
+    else:
+        raise ValueError( 'method must be either \'pyephem\' or \'tastro\'' )
 
-            # Determine the Sun, Moon and target elevations
-            # at ingress:
-            obs.date = ttr_i-0.5*dur_i
-            sun.compute( obs )
-            sun_alt_ingress = np.rad2deg( float( sun.alt ) )
-            moon.compute( obs )
-            moon_alt_ingress = np.rad2deg( float( moon.alt ) )
-            target_i.compute( obs )
-            target_i_alt_ingress = np.rad2deg( float( target_i.alt ) )            
+    table = { 'dates':dates, \
+              'sun_alt':np.rad2deg( sun_alt ), \
+              'moon_alt':np.rad2deg( moon_alt ), \
+              'moon_az':np.rad2deg( np.unwrap( moon_az ) ), \
+              'moon_phase':moon_phase }
 
-            # Do the same for egress:
-            obs.date = ttr_i+0.5*dur_i
-            sun.compute( obs )
-            sun_alt_egress = np.rad2deg( float( sun.alt ) )
-            moon.compute( obs )
-            moon_alt_egress = np.rad2deg( float( moon.alt ) )
-            target_i.compute( obs )
-            target_i_alt_egress = np.rad2deg( float( target_i.alt ) )
-
-            # First category of transits are those where the entire transit and
-            # requested out-of-transit baselines either side of ingress and egress
-            # occur while the Sun is below the maximum acceptable altitude:
-            if ( sun_alt_start<sun_alt_max )*( sun_alt_end<sun_alt_max ):
-
-                # Case 1 = The Sun is always below our dark night time threshold:
-                if ( sun_alt_start<sun_alt_dark )*( sun_alt_end<sun_alt_dark ):
-                    trtype = 'full-all_in_darktime'
-
-                # Case 2 = The Sun remains within the twilight range for the entire transit:
-                elif ( sun_alt_start>sun_alt_dark )*( sun_alt_start<sun_alt_twil )*\
-                     ( sun_alt_end>sun_alt_dark )*( sun_alt_end<sun_alt_twil ):
-                    trtype = 'full-all_in_twilight'
-                    
-                # Case 3 = The Sun starts low enough to be classified as twilight,
-                # but not low enough to be classified dark, and by the end of the
-                # transit has descended low enough to be considered dark:         
-                elif ( sun_alt_start<sun_alt_twil )*( sun_alt_start>sun_alt_dark )* \
-                     ( sun_alt_end<sun_alt_dark ):
-                    trtype = 'full-twilight_to_dark'
-
-                # Case 4 = The Sun starts low enough to be considered at dark, but
-                # by the end of the transit it has ascended enough that it is no
-                # longer considered dark but twilight instead:
-                elif ( sun_alt_end<sun_alt_twil )*( sun_alt_end>sun_alt_dark)* \
-                     ( sun_alt_start<sun_alt_dark ):
-                    trtype = 'full-dark_to_twilight'
-
-                # Case 5 = At the start of the transit, the Sun is at an altitude
-                # somewhere between its maximum acceptable value and the twilight
-                # value, so we say the transit starts at 'dusk':
-                elif ( sun_alt_start<sun_alt_max )*( sun_alt_start>sun_alt_twil ):
-                    trtype = 'full-start_at_dusk'
-
-                # Case 6 = At the end of the transit, the Sun is at an altitude
-                # somewhere between its maximum acceptable value and the twilight
-                # value, so we say the transit ends at 'dawn':
-                elif ( sun_alt_end<sun_alt_max )*( sun_alt_end>sun_alt_twil ):
-                    trtype = 'full-end_at_dawn'
-
-                # Don't think there should be any other cases?
-                else:
-                    pdb.set_trace() #if this happens, need to work out what the Case should be
-                    print 'backstop'
-                    pdb.set_trace()
-                    
-            # The following variations describe cases where we do not get the
-            # full transit plus out-of-transit baseline:
-
-            elif ( sun_alt_ingress<sun_alt_max )*( sun_alt_egress<sun_alt_max ):
-
-                # Case 6 = The sky darkness was within our acceptable range for the
-                # full duration of the transit but we don't get the full out-of-transit
-                # baseline either before or after the transit within this range:
-                trtype = 'full-partial_oot'
-
-            elif ( sun_alt_ingress>sun_alt_max )*( sun_alt_end<sun_alt_max ):
-
-                # Case 7 = At the start of the transit, the Sun was above our minimum
-                # acceptable altitude, but by the time of mid-transit it had descended
-                # below this level and remained acceptable until the end of the transit:
-                trtype = 'partial-miss_ingress'
-
-            elif ( sun_alt_start<sun_alt_max )*( sun_alt_egress>sun_alt_max ):
-
-                # Case 8 = At the start of the transit, the Sun was above our minimum
-                # acceptable altitude, but by the time of mid-transit it had descended
-                # below this level and remained acceptable until the end of the transit:
-                trtype = 'partial-miss_egress'
+    return table
 
-            else:
-                # Case 9 = In the case of a transit lasting longer than the entire night,
-                # the Sun altitude meets the minimum requirement at the transit mid-time,
-                # but it's at an unacceptable altitude for both the start and end:
-                trtype = 'partial-only_middle'
-
-            # Now work out if the Moon is above or below the horizon:
-            if ( moon_alt_start<moon_alt_set )*( moon_alt_end<moon_alt_set ):
-                moonpos = 'moon-down'
-                moonphase = '-'
-                moondist = '-'
-            else:
-                if ( moon_alt_start>0 )*( moon_alt_end>0 ):
-                    moonpos = 'moon-up'
-                elif ( moon_alt_start<0 )*( moon_alt_end>moon_alt_set ):
-                    moonpos = 'moon-rising'
-                elif ( moon_alt_start>moon_alt_set )*( moon_alt_end<0 ):
-                    moonpos = 'moon-setting'
-                else:
-                    pdb.set_trace() #this shouldn't happen
 
-            # Determine the start and end times of transit in UT: 
-            utc_tstart_tuple = ephem.date( ttr_i-0.5*dur_i ).tuple()
-            utc_tstart_dt = datetime.datetime( int(utc_tstart_tuple[0]), \
-                                               int(utc_tstart_tuple[1]), \
-                                               int(utc_tstart_tuple[2]), \
-                                               int(utc_tstart_tuple[3]), \
-                                               int(utc_tstart_tuple[4]), \
-                                               int(utc_tstart_tuple[5]), \
-                                               tzinfo=pytz.utc )
-
-            utc_tend_tuple = ephem.date( ttr_i+0.5*dur_i ).tuple()
-            utc_tend_dt = datetime.datetime( int(utc_tend_tuple[0]), \
-                                             int(utc_tend_tuple[1]), \
-                                             int(utc_tend_tuple[2]), \
-                                             int(utc_tend_tuple[3]), \
-                                             int(utc_tend_tuple[4]), \
-                                             int(utc_tend_tuple[5]), \
-                                             tzinfo=pytz.utc )
-            
-            # Express the transit mid-time as a Modified Julian Date:
-            mjd = ephem.julian_date( ttr_i ) - 2400000.5
+def interp_sunmoon( table, dates ):
+    """
+    Linearly interpolates the quantities tabulated by sunmoon_table() to
+    the pyephem date(s) dates, which can be a scalar or an array of any
+    shape. Returns a dictionary with the same keys as the table.
+    """
 
-            # Prepare and write output line to file:
-            outstr_bp = make_outstr_bp( mjd, utc_tstart_dt, utc_tend_dt, zenith_i_midtime, \
-                                        airmass, trtype, moonpos, moondist, moonphase )
-            ofile_bp.write( outstr_bp )
+    x = np.asarray( dates, dtype=float )
+    if ( np.min( x )<table['dates'][0] ) or ( np.max( x )>table['dates'][-1] ):
+        raise ValueError( 'dates fall outside the range covered by the Sun/Moon table' )
+    sm = { 'dates':x }
+    for key in [ 'sun_alt', 'moon_alt', 'moon_az', 'moon_phase' ]:
+        sm[key] = np.interp( x.ravel(), table['dates'], table[key] ).reshape( x.shape )
+    sm['moon_az'] = np.mod( sm['moon_az'], 360. )
 
-            # Also save the lines to be written to other chronological output file later:
-            mjds += [ mjd ]
-            date_floats += [ ephem.Date( utc_tstart_dt )+1.0 ] # number of days since midday on 1 Jan 1900 
+    return sm
 
-            outstr_ch = make_outstr_ch( targets[i], mjd, utc_tstart_dt, utc_tend_dt, zenith_i_midtime, \
-                                        airmass, trtype, moonpos, moondist, moonphase )
-            outstrs_ch += [ outstr_ch ]
 
-            # Tick over to the next transit for the next loop:
-            ttr_i += per_i
+def window_sun_crossings( tinfo, obs, date_start, date_end, altitudes, oot_deltdur=0.5, \
+                          method='pyephem', sunmoon=None ):
+    """
+    Runs sun_crossings() over the window between the pyephem dates date_start
+    and date_end, padded to allow for the longest observations of the targets
+    selected by prepare_targets() that straddle either end.
+    """
 
-    # Now that we've identified all of the transits, sort them into
-    # chronological order and write this information to output:
-    header_str = '#\n#\n{0}\n'.format( '#'*nchar_ch )
-    header_str += colheadingsa_ch
-    header_str += colheadingsb_ch
-    ofile_ch.write( header_str )
-    ofile_ch.write( '{0}{1}\n'.format( '#', '-'*( nchar_ch-1 ) ) )
-    mjds = np.array( mjds )
-    date_floats = np.array( date_floats )
-    ixs = np.argsort( mjds )
-    for i in range( len( mjds ) ):
-        j = ixs[i]
-        df = np.floor( date_floats[j] )
-        if i!=0:
-            df_prev = np.floor( date_floats[ixs[i-1]] )
-            if df-df_prev>=1.0:
-                ofile_ch.write( '#{0}\n'.format( '-'*( nchar_ch-1 ) ) )
-        ofile_ch.write( outstrs_ch[j] )
-    ofile_ch.write( '{0}{1}\n'.format( '#', '-'*( nchar-1 ) ) )
+    durs = [ tinfo['durs'][i] / 24. for i in tinfo['selected'] ]
+    pad = ( 1 + oot_deltdur )*max( durs + [ 0 ] ) + SUN_TRACK_STEP/1440.
+    sun_intervals = sun_crossings( obs, date_start - pad, date_end + pad, altitudes, \
+                                   method=method, sunmoon=sunmoon )
 
-    # Save the output files and finish:
-    ofile_bp.close()
-    ofile_ch.close()
-    print '\nSaved output in:'
-    print '  %s' % ofilename_byplanet
-    print '  %s' % ofilename_chronolog
+    return sun_intervals
 
-    return ofilename_byplanet, ofilename_chronolog
+
+def sun_crossings( obs, date_start, date_end, altitudes, method='pyephem', sunmoon=None, \
+                   step=SUN_TRACK_STEP ):
+    """
+    Solves for the times that the Sun crosses each of the altitudes (in
+    degrees) as seen from the pyephem Observer() object obs, between the
+    pyephem dates date_start and date_end, giving the intervals of each
+    night during which the Sun is below each altitude (see body_crossings()).
+    """
+
+    sun_intervals = body_crossings( obs, date_start, date_end, altitudes, body='sun', \
+                                    method=method, sunmoon=sunmoon, step=step )
+
+    return sun_intervals
+
+
+def body_crossings( obs, date_start, date_end, altitudes, body='sun', method='pyephem', \
+                    sunmoon=None, step=SUN_TRACK_STEP ):
+    """
+    Solves for the times that the Sun (body='sun') or Moon (body='moon')
+    crosses each of the altitudes (in degrees) as seen from the pyephem
+    Observer() object obs, between the pyephem dates date_start and date_end.
+
+    The altitude is first tabulated every step minutes with the tastro
+    module, which brackets each crossing, and the crossing times are then
+    solved for to within tintervals.CROSSING_TOL days using pyephem
+    (method='pyephem') or the tastro module (method='tastro'). If a table
+    generated by sunmoon_table() is passed in as sunmoon, its altitudes are
+    used instead, with the crossings found by linear interpolation in the
+    same way as interp_sunmoon().
+
+    Returns a dictionary with the altitudes as keys, each entry containing
+    a tuple of arrays of the pyephem dates at the start and end of the
+    intervals, in chronological order, with the body below that altitude.
+    """
+
+    if sunmoon!=None:
+        dates = sunmoon['dates']
+        track = sunmoon['{0}_alt'.format( body )]
+        body_alt = None
+    else:
+        # Align the samples to a fixed grid so that the crossings solved for
+        # don't depend on the window (see calc_visible() incremental mode):
+        first = np.floor( float( date_start )*1440. / step )*step / 1440.
+        nsteps = int( np.ceil( ( float( date_end ) - first )*1440. / step ) ) + 1
+        dates = first + ( step / 1440. )*np.arange( nsteps )
+        track = body_altitude( obs, body=body, method='tastro' )( dates )
+        body_alt = body_altitude( obs, body=body, method=method )
+
+    body_intervals = {}
+    for altitude in altitudes:
+        if body_alt==None:
+            func = None
+        else:
+            func = lambda date, altitude=altitude: body_alt( date ) - altitude
+        body_intervals[altitude] = tintervals.track_intervals( dates, track - altitude, func=func )
+
+    return body_intervals
+
+
+def body_altitude( obs, body='sun', method='pyephem' ):
+    """
+    Returns a function that gives the altitude in degrees of the Sun
+    (body='sun') or Moon (body='moon') at a pyephem date as seen from the
+    pyephem Observer() object obs, calculated with pyephem (method='pyephem')
+    or the tastro module (method='tastro'). The tastro version also accepts
+    an array of dates.
+    """
+
+    if body=='sun':
+        pyephem_body = ephem.Sun
+        tastro_altaz = tastro.sun_altaz
+    elif body=='moon':
+        pyephem_body = ephem.Moon
+        tastro_altaz = tastro.moon_altaz
+    else:
+        raise ValueError( 'body must be either \'sun\' or \'moon\'' )
+
+    if method=='pyephem':
+        obs = obs.copy() # leave the date of the input observer untouched
+        instance = pyephem_body()
+        counter = 'compute_{0}'.format( body )
+        def body_alt( date ):
+            obs.date = date
+            instance.compute( obs )
+            tprofile.count( counter )
+            return np.rad2deg( float( instance.alt ) )
+    elif method=='tastro':
+        lat = float( obs.lat )
+        lon = float( obs.long )
+        def body_alt( date ):
+            alt = tastro_altaz( tastro.pyephem2jd( date ), lat, lon, \
+                                pressure=obs.pressure, temp=obs.temp )[0]
+            return np.rad2deg( alt )
+    else:
+        raise ValueError( 'method must be either \'pyephem\' or \'tastro\'' )
+
+    return body_alt
+
+
+def target_crossings( obs, ras, decs, date_start, date_end, target_elev_min=25 ):
+    """
+    Returns a list containing the intervals between the pyephem dates
+    date_start and date_end during which each of the fixed targets with
+    coordinates ras and decs (radians, already precessed to around the
+    window) is at or above target_elev_min degrees, as seen from the
+    pyephem Observer() object obs.
+
+    The rise and set times are solved for analytically: the target is above
+    the limit while its hour angle is within +/-H0 of the meridian, where
+    cos(H0) = ( sin(h0) - sin(lat)sin(dec) )/( cos(lat)cos(dec) ) and h0 is
+    target_elev_min corrected for refraction, and the meridian crossings
+    recur every sidereal day. Nutation and aberration are neglected, which
+    shifts the times by no more than a few seconds.
+    """
+
+    ras = np.asarray( ras, dtype=float )
+    decs = np.asarray( decs, dtype=float )
+    lat = float( obs.lat )
+    lon = float( obs.long )
+    h0 = np.deg2rad( target_elev_min )
+    h0 = h0 - tastro.unrefraction( h0, pressure=obs.pressure, temp=obs.temp )
+    cos_ha = ( np.sin( h0 ) - np.sin( lat )*np.sin( decs ) ) / ( np.cos( lat )*np.cos( decs ) )
+    ha_half = np.arccos( np.clip( cos_ha, -1, 1 ) )
+
+    # Hour angles at the start of the window, wrapped to +/-pi, give the
+    # times of the nearest meridian crossings:
+    ha_start = tastro.gmst( tastro.pyephem2jd( date_start ) ) + lon - ras
+    ha_start = np.mod( ha_start + np.pi, 2*np.pi ) - np.pi
+    sidereal_day = 1. / SIDEREAL_RATE
+    rate = 2*np.pi*SIDEREAL_RATE
+    transit0 = float( date_start ) - ha_start / rate
+    ncross = int( np.ceil( ( float( date_end ) - float( date_start ) ) / sidereal_day ) ) + 2
+    crossings = np.arange( -1, ncross )*sidereal_day
+
+    target_intervals = []
+    for k in range( len( ras ) ):
+        if cos_ha[k]<=-1:
+            starts = np.array( [ float( date_start ) ] )
+            ends = np.array( [ float( date_end ) ] )
+        elif cos_ha[k]>=1:
+            starts = np.zeros( 0 )
+            ends = np.zeros( 0 )
+        else:
+            starts = transit0[k] + crossings - ha_half[k] / rate
+            ends = transit0[k] + crossings + ha_half[k] / rate
+        target_intervals += [ tintervals.clip_intervals( ( starts, ends ), date_start, date_end ) ]
+
+    return target_intervals
+
+
+def transit_times( ttr, per, dur, date_start, date_end, sigtype='transits' ):
+    """
+    Returns arrays containing the pyephem dates and epoch numbers of the
+    successive transit mid-times that are at least partially visible within
+    the window between date_start and date_end. The reference mid-time ttr
+    is given as a Julian date and defines epoch zero, while the period per
+    and duration dur are both given in days. If sigtype='eclipses', the
+    eclipse times are approximated as occurring half a period after the
+    transits, so that eclipse E falls half a period before transit E.
+
+    The epochs are found directly from the number of periods between the
+    reference mid-time and the window, rather than by stepping through
+    the intervening transits one period at a time.
+    """
+
+    # Convert the JD transit time to a pyephem date:
+    ttr_i = float( jd2pyephemdate( ttr ) )
+
+    # If we're wanting eclipse information, approximate the eclipse
+    # time by subtracting half a period (the more eccentric the orbit,
+    # the worse this approximation will be):
+    if sigtype=='eclipses':
+        ttr_i -= 0.5 * per
+
+    # Find the transit with mid-time occurring immediately before the
+    # observing run, starting at the next transit if that one isn't even
+    # partially visible:
+    epoch_first = int( np.floor( ( date_start - ttr_i ) / per ) )
+    if ( ttr_i + epoch_first*per + 0.5*dur )<date_start:
+        epoch_first += 1
+
+    # The last transit is the one with mid-time immediately before the
+    # end of the observing window:
+    epoch_last = int( np.ceil( ( date_end - ttr_i ) / per ) ) - 1
+
+    epochs = np.arange( epoch_first, epoch_last+1 )
+    ttrs = ttr_i + epochs*per
+
+    return ttrs, epochs
+
+
+def full_trtype( band_start, band_end ):
+    """
+    Returns the 'Transit-type' string for observations that are entirely
+    made with the Sun below the maximum acceptable altitude, given which
+    range the Sun is in at the start and end: 0 if it is below the dark
+    altitude, 1 if it is in the twilight range, or 2 if it is above that
+    (i.e. dusk or dawn).
+    """
+
+    # At the start of the transit, the Sun is at an altitude somewhere
+    # between its maximum acceptable value and the twilight value, so we
+    # say the transit starts at 'dusk':
+    if band_start==2:
+        trtype = 'full-start_at_dusk'
+
+    # At the end of the transit, the Sun is at an altitude somewhere
+    # between its maximum acceptable value and the twilight value, so
+    # we say the transit ends at 'dawn':
+    elif band_end==2:
+        trtype = 'full-end_at_dawn'
+
+    # The Sun is always below our dark night time threshold:
+    elif ( band_start==0 )*( band_end==0 ):
+        trtype = 'full-all_in_darktime'
+
+    # The Sun remains within the twilight range for the entire transit:
+    elif ( band_start==1 )*( band_end==1 ):
+        trtype = 'full-all_in_twilight'
+
+    # The Sun starts low enough to be classified as twilight, but not
+    # low enough to be classified dark, and by the end of the transit
+    # has descended low enough to be considered dark:
+    elif band_start==1:
+        trtype = 'full-twilight_to_dark'
+
+    # The Sun starts low enough to be considered at dark, but by the end
+    # of the transit it has ascended enough that it is no longer considered
+    # dark but twilight instead:
+    else:
+        trtype = 'full-dark_to_twilight'
+
+    return trtype
+
+
+def classify_sun( sun_intervals, ttrs, durs, oot_deltdur=0.5, sun_alt_max=-6, \
+                  sun_alt_twil=-12, sun_alt_dark=-18 ):
+    """
+    Classifies transits/eclipses with mid-times ttrs and durations durs
+    (pyephem dates and days, as arrays or scalars) according to how much of
+    the transit/eclipse and its out-of-transit baseline can be observed,
+    returning the 'Transit-type' strings that appear in the calc_visible()
+    output files. Observations made entirely with the Sun below sun_alt_max
+    are described by where the Sun is at the start and end (see
+    full_trtype()), while the rest are 'full-partial_oot' if the whole
+    transit/eclipse but not its baseline can be observed, otherwise
+    'partial-miss_ingress', 'partial-miss_egress' or 'partial-only_middle'.
+
+    The intervals returned by sun_crossings() are used rather than the Sun
+    altitudes at a few instants, so no ephemerides need to be calculated.
+    Only observations that lie entirely within a single interval with the
+    Sun below sun_alt_max are counted as 'full', so long observations that
+    continue through a whole day are not.
+
+    Returns a list of the 'Transit-type' strings and an array containing
+    the fraction of each observation (including the out-of-transit baseline)
+    for which the Sun is below sun_alt_max.
+    """
+
+    ttrs = np.atleast_1d( np.asarray( ttrs, dtype=float ) )
+    durs = np.asarray( durs, dtype=float ) + np.zeros( ttrs.shape )
+    tstart = ttrs - ( 0.5 + oot_deltdur )*durs
+    tend = ttrs + ( 0.5 + oot_deltdur )*durs
+    tingress = ttrs - 0.5*durs
+    tegress = ttrs + 0.5*durs
+
+    night = sun_intervals[sun_alt_max]
+    full = tintervals.within_interval( night, tstart, tend )
+    full_transit = tintervals.within_interval( night, tingress, tegress )
+    ok_start = tintervals.in_intervals( night, tstart )
+    ok_end = tintervals.in_intervals( night, tend )
+    ok_ingress = tintervals.in_intervals( night, tingress )
+    ok_egress = tintervals.in_intervals( night, tegress )
+    bands = []
+    for dates in [ tstart, tend ]:
+        in_twil = tintervals.in_intervals( sun_intervals[sun_alt_twil], dates )
+        in_dark = tintervals.in_intervals( sun_intervals[sun_alt_dark], dates )
+        bands += [ np.where( in_dark, 0, np.where( in_twil, 1, 2 ) ) ]
+    span = tend - tstart
+    with np.errstate( invalid='ignore', divide='ignore' ):
+        overlap = tintervals.interval_overlap( night, tstart, tend )
+        observable = np.where( span>0, overlap / span, ok_start )
+
+    trtypes = []
+    for j in range( len( ttrs ) ):
+        if full[j]:
+            trtype = full_trtype( bands[0][j], bands[1][j] )
+        elif full_transit[j]:
+            trtype = 'full-partial_oot'
+        elif ( ok_ingress[j]==False )*ok_end[j]:
+            trtype = 'partial-miss_ingress'
+        elif ok_start[j]*( ok_egress[j]==False ):
+            trtype = 'partial-miss_egress'
+        else:
+            trtype = 'partial-only_middle'
+        trtypes += [ trtype ]
+
+    return trtypes, observable
+
+
+def classify_moon( moon_alt_start, moon_alt_end, moon_alt_set=-6 ):
+    """
+    Uses the Moon altitudes at the start and end of the observations to
+    work out if the Moon is above or below the horizon, returning the
+    'Moon-type' string that appears in the calc_visible() output files.
+    """
+
+    if ( moon_alt_start<moon_alt_set )*( moon_alt_end<moon_alt_set ):
+        moonpos = 'moon-down'
+    else:
+        if ( moon_alt_start>0 )*( moon_alt_end>0 ):
+            moonpos = 'moon-up'
+        elif ( moon_alt_start<0 )*( moon_alt_end>moon_alt_set ):
+            moonpos = 'moon-rising'
+        elif ( moon_alt_start>moon_alt_set )*( moon_alt_end<0 ):
+            moonpos = 'moon-setting'
+        elif moon_alt_end>=moon_alt_start:
+            moonpos = 'moon-rising' # only reached with an altitude of exactly zero
+        else:
+            moonpos = 'moon-setting'
+
+    return moonpos
+
+
+def make_event( ttr, epoch, dur, zenith, airmass, trtype, moonpos, moondist, moonphase, \
+                observable=np.nan ):
+    """
+    Packs the quantities describing a single visible transit/eclipse with
+    mid-time ttr (pyephem date), epoch number epoch and duration dur (days)
+    into a dictionary, along with the observable fraction returned by
+    classify_sun().
+    """
+
+    event = { 'ttr':float( ttr ), \
+              'epoch':int( epoch ), \
+              'mjd':( float( ttr ) + tastro.PYEPHEM_JD0 ) - 2400000.5, \
+              'tstart':float( ttr ) - 0.5*dur, \
+              'tend':float( ttr ) + 0.5*dur, \
+              'zenith':zenith, \
+              'airmass':airmass, \
+              'trtype':trtype, \
+              'moonpos':moonpos, \
+              'moondist':moondist, \
+              'moonphase':moonphase, \
+              'observable':float( observable ) }
+
+    return event
+
+
+def pyephem2datetime( date ):
+    """
+    Converts a pyephem date to a UTC datetime object, truncated
+    to the nearest second.
+    """
+
+    utc_tuple = ephem.date( date ).tuple()
+    utc_dt = datetime.datetime( int(utc_tuple[0]), \
+                                int(utc_tuple[1]), \
+                                int(utc_tuple[2]), \
+                                int(utc_tuple[3]), \
+                                int(utc_tuple[4]), \
+                                int(utc_tuple[5]), \
+                                tzinfo=pytz.utc )
+
+    return utc_dt
+
+def pyephem2strings( dates ):
+    """
+    Vectorised version of pyephem2datetime() that converts an array of
+    pyephem dates to the UTC strings of the form YYYY:MM:DD:hh:mm:ss used
+    in the output files, truncated to the nearest second, and also returns
+    an array of the number of whole seconds since the pyephem zero date.
+    The seconds are rounded to the nearest microsecond before truncating,
+    as pyephem does, and any date within DATE_SECOND_TOL seconds of a whole
+    second is converted with pyephem2datetime() instead, so the strings are
+    always identical to those from the pyephem conversion.
+    """
+
+    dates = np.asarray( dates, dtype=float )
+    seconds = ( dates + 0.5/8.64e10 )*86400.
+    whole = np.floor( seconds )
+    fraction = seconds - whole
+    whole = whole.astype( np.int64 )
+    zero_dt = datetime.datetime( 1899, 12, 31, 12, tzinfo=pytz.utc ) # pyephem zero date
+    for j in np.flatnonzero( ( fraction<DATE_SECOND_TOL )+( fraction>1-DATE_SECOND_TOL ) ):
+        delta = pyephem2datetime( dates[j] ) - zero_dt
+        whole[j] = delta.days*86400 + delta.seconds
+
+    # Split into calendar dates and times of day, counting from midnight:
+    days, secs = np.divmod( whole + 43200, 86400 )
+    day_dates = np.datetime64( '1899-12-31', 'D' ) + days.astype( 'm8[D]' )
+    years = day_dates.astype( 'M8[Y]' )
+    months = day_dates.astype( 'M8[M]' )
+    year = ( years.astype( np.int64 ) + 1970 ).tolist()
+    month = ( months.astype( np.int64 ) % 12 + 1 ).tolist()
+    day = ( ( day_dates - months.astype( 'M8[D]' ) ).astype( np.int64 ) + 1 ).tolist()
+    hour = ( secs // 3600 ).tolist()
+    minute = ( ( secs % 3600 ) // 60 ).tolist()
+    second = ( secs % 60 ).tolist()
+    strs = [ '{0:04d}:{1:02d}:{2:02d}:{3:02d}:{4:02d}:{5:02d}'.format( *fields ) \
+             for fields in zip( year, month, day, hour, minute, second ) ]
+
+    return strs, whole
+
+
+def centre_column( values, width ):
+    """
+    Centres each of the strings in values within width characters in the
+    same way as str.center(), doing the work once for each distinct value.
+    """
+
+    centred = {}
+    for value in set( values ):
+        centred[value] = value.center( width )
+
+    return [ centred[value] for value in values ]
+
+
+def format_rows_bp( events ):
+    """
+    Bulk version of make_outstr_bp() that formats a list of events into
+    the lines of the byplanet output file in one go. Each column is prepared
+    for all of the events at once and each line is made with a single call
+    to the ROW_TEMPLATE_BP template. Also returns an array of the start times
+    in whole seconds since the pyephem zero date (see pyephem2strings()).
+    """
+
+    if len( events )==0:
+        return [], np.zeros( 0, dtype=np.int64 )
+    columns = events_columns( events )
+    whole = columns.pop()
+    rows = [ ROW_TEMPLATE_BP.format( *fields ) for fields in zip( *columns ) ]
+
+    return rows, whole
+
+
+def write_rows_bp( ofile, pending ):
+    """
+    Writes a list of ( header, events ) tuples to the byplanet output file
+    ofile, formatting the events of all the targets together with
+    format_rows_bp() and writing each header before the lines for its target.
+    """
+
+    events = [ event for header, events_k in pending for event in events_k ]
+    t1 = tprofile.start()
+    rows, whole = format_rows_bp( events )
+    tprofile.stop( 'format_byplanet', t1 )
+    j = 0
+    for header, events_k in pending:
+        ofile.write( header )
+        ofile.write( ''.join( rows[j:j+len( events_k )] ) )
+        j += len( events_k )
+    tprofile.count( 'events_written', j )
+
+    return None
+
+
+def format_rows_ch( names, events, nchar, df_prev=None ):
+    """
+    Bulk version of make_outstr_ch() that formats a chronological list of
+    events, with the target names in the matching list names, into the lines
+    of the chronolog output file. These are the byplanet lines made by
+    format_rows_bp() with the target name in front. A separator line of
+    nchar characters is inserted wherever a new night starts, as done by
+    write_visible(), with df_prev being the night number of the previous
+    line, if any. Returns the lines and the night number of the last event.
+    """
+
+    if len( events )==0:
+        return [], df_prev
+    rows, whole = format_rows_bp( events )
+    rows = [ '{0:>11} {1}'.format( name.replace( ' ', '' ), row ) for name, row in zip( names, rows ) ]
+
+    # Night numbers counted from midday, as in write_visible(), which agree
+    # with the pyephem calculation except possibly at exactly midday:
+    dfs = whole // 86400 + 1
+    for j in np.flatnonzero( whole % 86400==0 ):
+        dfs[j] = np.floor( ephem.Date( pyephem2datetime( events[j]['tstart'] ) ) + 1.0 )
+    separator = '#{0}\n'.format( '-'*( nchar - 1 ) )
+    lines = []
+    for j in range( len( rows ) ):
+        if ( df_prev!=None ) and ( dfs[j]-df_prev>=1.0 ):
+            lines += [ separator ]
+        df_prev = dfs[j]
+        lines += [ rows[j] ]
+
+    return lines, df_prev
+
+
+def events_columns( events ):
+    """
+    Returns the columns of the output files for a list of events, ready to
+    be passed to the row templates (see format_rows_bp()), followed by the
+    whole seconds of the start times returned by pyephem2strings().
+    """
+
+    tstart_strs, tstart_whole = pyephem2strings( [ event['tstart'] for event in events ] )
+    tend_strs = pyephem2strings( [ event['tend'] for event in events ] )[0]
+    zeniths = np.round( [ event['zenith'] for event in events ] ).astype( int ).tolist()
+    columns = [ [ float( event['mjd'] ) for event in events ], \
+                tstart_strs, \
+                tend_strs, \
+                zeniths, \
+                [ float( event['airmass'] ) for event in events ], \
+                centre_column( [ event['trtype'] for event in events ], 21 ), \
+                [ event['moonpos'] for event in events ], \
+                centre_column( [ event['moondist'] for event in events ], 9 ), \
+                [ event['moonphase'] for event in events ], \
+                tstart_whole ]
+
+    return columns
 
 
 def make_eph():
@@ -544,10 +2469,10 @@ def make_eph():
     """
 
     # Get table data:
-    tr_file = 'exoplanets_transiting.fits'
-    if os.path.isfile( tr_file )==False:
+    t = tutilities.load_transiting_table()
+    if t is None:
         tutilities.download_data()
-    t = atpy.Table( tr_file )
+        t = tutilities.load_transiting_table()
 
     # Open and prepare file for output writing to:
     eph_file_w = open( EPH_FILE, 'w' )
@@ -843,61 +2768,118 @@ def make_outstr_ch( target, mjd, utc_tstart_dt, utc_tend_dt, zenith_midtime, air
 
 def read_eph( eph_file ):
 
+    eph = load_eph( eph_file )
+    targets = eph['target'].tolist()
+    vmags = eph['vmag'].tolist()
+    ras = eph['ra'].tolist()
+    decs = eph['dec'].tolist()
+    ttrs = eph['ttr'].tolist()
+    pers = eph['per'].tolist()
+    durs = eph['dur'].tolist()
+
+    return targets, vmags, ras, decs, ttrs, pers, durs
+
+
+def load_eph( eph_file ):
+    """
+    Reads the ephemerides file generated by make_eph() in a single pass,
+    splitting each line once, and returns a NumPy structured array with
+    one row per target and the fields:
+
+      target - Target name.
+      vmag - V-band magnitude.
+      ra, dec - Coordinate strings exactly as they appear in the file.
+      ttr - Reference mid-time (HJD).
+      per - Orbital period in days.
+      dur - Transit duration in hours.
+      ra_rad, dec_rad - Coordinates in radians.
+
+    As for read_eph(), lines starting with '#' are skipped, which is how
+    targets are disabled, along with any lines that don't have exactly
+    seven entries.
+    """
+
     ifile = open( eph_file, 'r' )
-    targets = []
-    vmags = []
-    ras = []
-    decs = []
-    ttrs = []
-    pers = []
-    durs = []
-    for line in ifile:
-        if ( line[0]=='#' ) or ( line[0]=='\n' ) or ( line[0]=='' ):
-            continue
-        else:
-            entries = line.split()
-            if len( entries )==7:
-                targets += [ str( line.split()[0] ) ]
-                vmags   += [ float( line.split()[1] ) ]
-                ras     += [ str( line.split()[2] ) ]            
-                decs    += [ str( line.split()[3] ) ]
-                ttrs    += [ float( line.split()[4] ) ]
-                pers    += [ float( line.split()[5] ) ]
-                durs    += [ float( line.split()[6] ) ]
+    rows = [ line.split() for line in ifile if line[0]!='#' ]
     ifile.close()
+    rows = [ row for row in rows if len( row )==7 ]
+    if len( rows )>0:
+        cols = zip( *rows )
+    else:
+        cols = [ () ]*7
+
+    # Size the string fields to fit the longest entries:
+    nchars = [ max( [ len( entry ) for entry in col ] + [ 1 ] ) for col in cols[:4] ]
+    dtype = [ ( 'target', 'S{0}'.format( nchars[0] ) ), ( 'vmag', 'f8' ), \
+              ( 'ra', 'S{0}'.format( nchars[2] ) ), ( 'dec', 'S{0}'.format( nchars[3] ) ), \
+              ( 'ttr', 'f8' ), ( 'per', 'f8' ), ( 'dur', 'f8' ), \
+              ( 'ra_rad', 'f8' ), ( 'dec_rad', 'f8' ) ]
+    eph = np.empty( len( rows ), dtype=dtype )
+    eph['target'] = cols[0]
+    eph['vmag'] = np.array( cols[1], dtype=float )
+    eph['ra'] = cols[2]
+    eph['dec'] = cols[3]
+    eph['ttr'] = np.array( cols[4], dtype=float )
+    eph['per'] = np.array( cols[5], dtype=float )
+    eph['dur'] = np.array( cols[6], dtype=float )
+    eph['ra_rad'] = np.deg2rad( 15*sexagesimal2deg( cols[2] ) )
+    eph['dec_rad'] = np.deg2rad( sexagesimal2deg( cols[3] ) )
+
+    return eph
+
+
+def sexagesimal2deg( strs ):
+    """
+    Converts a sequence of colon-separated sexagesimal strings such as
+    '+26:08:43.1' to an array of decimal values in the same units as the
+    leading field (i.e. degrees for declinations and hours for RAs). Any
+    missing minutes or seconds fields are taken to be zero.
+    """
 
-    return targets, vmags, ras, decs, ttrs, pers, durs
+    fields = [ ( entry.split( ':' ) + [ '0', '0' ] )[:3] for entry in strs ]
+    fields = np.array( fields, dtype=float ).reshape( ( len( fields ), 3 ) )
+    signs = np.array( [ entry.strip()[:1]=='-' for entry in strs ], dtype=bool )
+    values = np.abs( fields[:,0] ) + fields[:,1]/60. + fields[:,2]/3600.
+    values[signs] *= -1
 
+    return values
 
-def eclipse_ranks( ec_signals ):
 
-    ec_file = open( ec_signals, 'r' )
-    targets_ec = []
-    ranks_ec = []
-    ec_file.seek( 0 )
-    for line in ec_file:
+def rank_index( signals_file ):
+    """
+    Reads a signals file generated by tsignals.transmission() or
+    tsignals.emission() and returns a dictionary mapping the target
+    names, normalised by normalise_name(), to their integer ranks.
+    Ranks can then be looked up directly with lookup_rank().
+    """
+
+    ifile = open( signals_file, 'r' )
+    index = {}
+    for line in ifile:
         if line[0]=='#':
             continue
-        ranks_ec += [ line.split()[0] ]
-        targets_ec += [ line.split()[1] ]
-    ec_file.close()
+        entries = line.split()
+        if len( entries )<2:
+            continue
+        index[ normalise_name( entries[1] ) ] = int( entries[0] )
+    ifile.close()
 
-    return targets_ec, ranks_ec
+    return index
 
 
-def transit_ranks( tr_signals ):
+def lookup_rank( index, name ):
+    """
+    Returns the rank of the target name in a dictionary generated by
+    rank_index(), or None if the target has not been ranked.
+    """
 
-    tr_file = open( tr_signals, 'r' )
-    targets_tr = []
-    ranks_tr = []
-    tr_file.seek( 0 )
-    for line in tr_file:
-        if line[0]=='#':
-            continue
-        ranks_tr += [ line.split()[0] ]
-        targets_tr += [ line.split()[1] ]
-    tr_file.close()
+    return index.get( normalise_name( name ), None )
 
-    return targets_tr, ranks_tr
 
+def normalise_name( name ):
+    """
+    Normalises a target name by removing any spaces, which is the form
+    the names take in the ephemeris and signals files.
+    """
 
+    return name.replace( ' ', '' )
@@ -0,0 +1,244 @@
+import numpy as np
+
+# Sets of time intervals and a sorted index over them, used to describe
+# when the Sun, Moon and targets are above or below their altitude limits
+# and when the transits/eclipses occur. A set of intervals is a tuple of
+# arrays of the start and end pyephem dates of non-overlapping intervals
+# in chronological order, e.g. as returned by tephem.sun_crossings(). An
+# index built by build_index() can hold overlapping intervals, such as
+# the observing windows of many targets, and answers stabbing queries
+# (see stab()) and overlap queries (see overlapping()) with a binary
+# search rather than a pass through all of the intervals.
+
+CROSSING_TOL = 1e-6 # days to which the crossing times are solved for (see solve_crossing())
+
+
+def track_intervals( dates, track, func=None ):
+    """
+    Finds the intervals where a function of time is negative, given its
+    values track sampled at the pyephem dates. If func is None, the function
+    is taken to vary linearly between the samples, otherwise each crossing
+    bracketed by the samples is solved for with func (see solve_crossing()).
+    Crossings that func doesn't confirm, which can happen when the function
+    only just reaches zero, are ignored. Returns arrays of the start and end
+    dates of the intervals, which are clipped to the range of the samples,
+    and are empty if there are no samples (e.g. for a reversed window).
+    """
+
+    nsamples = len( dates )
+    if nsamples==0:
+        return np.zeros( 0 ), np.zeros( 0 )
+    ixs = np.flatnonzero( ( track[1:]<0 )!=( track[:-1]<0 ) )
+    if func==None:
+        below = ( track[0]<0 )
+    else:
+        below = ( func( dates[0] )<0 )
+    starts = []
+    ends = []
+    if below:
+        starts += [ dates[0] ]
+    for j in ixs:
+        if func==None:
+            date = dates[j] + ( dates[j+1] - dates[j] )*track[j] / ( track[j] - track[j+1] )
+            down = ( track[j+1]<0 )
+        else:
+            date = None
+            for lo, hi in [ [ j, j+1 ], [ max( [ j-1, 0 ] ), min( [ j+2, nsamples-1 ] ) ] ]:
+                f_lo = func( dates[lo] )
+                f_hi = func( dates[hi] )
+                if ( f_lo<0 )!=( f_hi<0 ):
+                    date = solve_crossing( func, dates[lo], dates[hi], f_lo, f_hi )
+                    down = ( f_hi<0 )
+                    break
+            if date==None:
+                continue
+        if down and ( below==False ):
+            starts += [ date ]
+            below = True
+        elif ( down==False ) and below:
+            ends += [ date ]
+            below = False
+    if below:
+        ends += [ dates[-1] ]
+
+    return np.array( starts, dtype=float ), np.array( ends, dtype=float )
+
+
+def solve_crossing( func, t_lo, t_hi, f_lo, f_hi ):
+    """
+    Solves for the time between t_lo and t_hi at which func changes sign
+    to within CROSSING_TOL, given its values f_lo and f_hi at either end,
+    using the Illinois variant of the regula falsi method.
+    """
+
+    side = 0
+    for i in range( 100 ):
+        if ( t_hi - t_lo )<CROSSING_TOL:
+            break
+        t = ( t_lo*f_hi - t_hi*f_lo ) / ( f_hi - f_lo )
+        f = func( t )
+        if f==0:
+            return t
+        elif ( f<0 )==( f_hi<0 ):
+            t_hi, f_hi = t, f
+            if side==-1:
+                f_lo *= 0.5
+            side = -1
+        else:
+            t_lo, f_lo = t, f
+            if side==1:
+                f_hi *= 0.5
+            side = 1
+
+    return 0.5*( t_lo + t_hi )
+
+
+def in_intervals( intervals, dates ):
+    """
+    Returns a boolean array flagging which of the dates fall within any of
+    the intervals, given as a tuple of arrays of their start and end dates
+    in chronological order (see tephem.sun_crossings()).
+    """
+
+    starts, ends = intervals
+    dates = np.asarray( dates, dtype=float )
+    if len( starts )==0:
+        return np.zeros( dates.shape, dtype=bool )
+    i = np.searchsorted( starts, dates, side='right' ) - 1
+
+    return ( i>=0 )*( dates<ends[np.maximum( i, 0 )] )
+
+
+def within_interval( intervals, dates1, dates2 ):
+    """
+    Returns a boolean array flagging which of the spans from dates1 to
+    dates2 lie entirely within a single one of the intervals.
+    """
+
+    starts, ends = intervals
+    dates1 = np.asarray( dates1, dtype=float )
+    dates2 = np.asarray( dates2, dtype=float )
+    if len( starts )==0:
+        return np.zeros( dates1.shape, dtype=bool )
+    i = np.searchsorted( starts, dates1, side='right' ) - 1
+    end = ends[np.maximum( i, 0 )]
+
+    return ( i>=0 )*( dates1<end )*( dates2<=end )
+
+
+def interval_overlap( intervals, dates1, dates2 ):
+    """
+    Returns the total time that the spans from dates1 to dates2 overlap
+    with the intervals.
+    """
+
+    starts, ends = intervals
+    dates1 = np.asarray( dates1, dtype=float )
+    dates2 = np.asarray( dates2, dtype=float )
+    if len( starts )==0:
+        return np.zeros( dates1.shape )
+    lengths = ends - starts
+    cumulative = np.concatenate( [ [ 0 ], np.cumsum( lengths ) ] )
+    def covered( dates ):
+        i = np.searchsorted( starts, dates, side='right' ) - 1
+        j = np.maximum( i, 0 )
+        return np.where( i>=0, cumulative[j] + np.clip( dates - starts[j], 0, lengths[j] ), 0 )
+
+    return covered( dates2 ) - covered( dates1 )
+
+
+def clip_intervals( intervals, date1, date2 ):
+    """
+    Returns the parts of the intervals that fall between the pyephem
+    dates date1 and date2.
+    """
+
+    starts, ends = intervals
+    i1 = np.searchsorted( ends, date1, side='right' )
+    i2 = np.searchsorted( starts, date2, side='left' )
+    starts = np.maximum( starts[i1:i2], date1 )
+    ends = np.minimum( ends[i1:i2], date2 )
+
+    return starts, ends
+
+
+def intersect_intervals( intervals1, intervals2 ):
+    """
+    Returns the intervals covered by both of the sets intervals1 and
+    intervals2.
+    """
+
+    starts1, ends1 = intervals1
+    starts2, ends2 = intervals2
+    if ( len( starts1 )==0 ) or ( len( starts2 )==0 ):
+        return np.zeros( 0 ), np.zeros( 0 )
+
+    # Each interval of the first set can only overlap the run of intervals
+    # in the second set that end after it starts and start before it ends:
+    i1 = np.searchsorted( ends2, starts1, side='right' )
+    i2 = np.searchsorted( starts2, ends1, side='left' )
+    n = np.maximum( i2 - i1, 0 )
+    ix1 = np.repeat( np.arange( len( starts1 ) ), n )
+    ix2 = np.repeat( i1 - np.cumsum( n ) + n, n ) + np.arange( np.sum( n ) )
+    starts = np.maximum( starts1[ix1], starts2[ix2] )
+    ends = np.minimum( ends1[ix1], ends2[ix2] )
+    keep = ( ends>starts )
+
+    return starts[keep], ends[keep]
+
+
+def build_index( starts, ends ):
+    """
+    Builds an index over intervals with the pyephem dates starts and ends,
+    which can overlap one another and be in any order. The intervals are
+    sorted by their start dates, and the length of the longest interval is
+    recorded so that the intervals overlapping any span can be found with
+    a pair of binary searches (see overlapping()). This is efficient when
+    the intervals have similar lengths, like the observing windows of
+    transits/eclipses.
+
+    Returns a dictionary containing the sorted start and end dates ('starts',
+    'ends'), the positions of the sorted intervals in the input arrays
+    ('order') and the length of the longest interval ('maxlen').
+    """
+
+    starts = np.asarray( starts, dtype=float )
+    ends = np.asarray( ends, dtype=float )
+    order = np.argsort( starts, kind='mergesort' )
+    if len( starts )>0:
+        maxlen = float( np.max( ends - starts ) )
+    else:
+        maxlen = 0.
+    index = { 'starts':starts[order], 'ends':ends[order], 'order':order, 'maxlen':maxlen }
+
+    return index
+
+
+def overlapping( index, date1, date2 ):
+    """
+    Returns the positions in the arrays passed to build_index() of the
+    intervals that overlap the span between the pyephem dates date1 and
+    date2, in order of their start dates. Intervals that only touch the
+    span at one end are not included.
+    """
+
+    # Intervals that overlap the span must start before it ends, and since
+    # none is longer than maxlen they must also start after date1 - maxlen:
+    i1 = np.searchsorted( index['starts'], date1 - index['maxlen'], side='left' )
+    i2 = np.searchsorted( index['starts'], date2, side='left' )
+    ixs = i1 + np.flatnonzero( index['ends'][i1:i2]>date1 )
+
+    return index['order'][ixs]
+
+
+def stab( index, date ):
+    """
+    Returns the positions in the arrays passed to build_index() of the
+    intervals that contain the pyephem date, in order of their start dates.
+    """
+
+    i1 = np.searchsorted( index['starts'], date - index['maxlen'], side='left' )
+    i2 = np.searchsorted( index['starts'], date, side='right' )
+    ixs = i1 + np.flatnonzero( index['ends'][i1:i2]>date )
+
+    return index['order'][ixs]
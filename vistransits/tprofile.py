@@ -0,0 +1,140 @@
+import time
+
+# Optional counters and timers for the hot paths in tephem and tsignals.
+# Profiling is off by default, in which case count() and start()/stop()
+# return straight away. It can be switched on around a call with
+# profile(), e.g.:
+#
+#   ofilenames, report = tprofile.profile( tephem.calc_visible, 'LaPalma', \
+#                                          '2014/01/01', '2014/02/01' )
+#
+# or with enable() and disable() around a longer piece of code. Counts
+# and times are only collected in the current process, so calc_visible()
+# should be run with workers=1 when profiling.
+
+PROFILE = None # counters and timers accumulated while profiling is enabled
+
+
+def enable():
+    """
+    Switches profiling on, resetting any counters and timers.
+    """
+
+    global PROFILE
+    PROFILE = { 'counts':{}, 'times':{} }
+
+    return None
+
+
+def disable():
+    """
+    Switches profiling off and returns the report (see report()).
+    """
+
+    global PROFILE
+    profile_report = report()
+    PROFILE = None
+
+    return profile_report
+
+
+def count( key, n=1 ):
+    """
+    Adds n to the counter key if profiling is enabled.
+    """
+
+    if PROFILE==None:
+        return None
+    counts = PROFILE['counts']
+    counts[key] = counts.get( key, 0 ) + n
+
+    return None
+
+
+def start():
+    """
+    Returns the current time if profiling is enabled, or None if not, to
+    be passed to stop() at the end of the section being timed.
+    """
+
+    if PROFILE==None:
+        return None
+
+    return time.time()
+
+
+def stop( key, t1 ):
+    """
+    Adds the time since t1, as returned by start(), to the timer key.
+    Does nothing if t1 is None, i.e. if profiling was disabled at the
+    start of the section being timed.
+    """
+
+    if ( t1==None ) or ( PROFILE==None ):
+        return None
+    times = PROFILE['times']
+    times[key] = times.get( key, 0. ) + ( time.time() - t1 )
+
+    return None
+
+
+def report():
+    """
+    Returns a dictionary containing copies of the 'counts' and 'times'
+    (in seconds) dictionaries accumulated since profiling was enabled,
+    or None if profiling is disabled.
+    """
+
+    if PROFILE==None:
+        return None
+
+    return { 'counts':PROFILE['counts'].copy(), 'times':PROFILE['times'].copy() }
+
+
+def profile( func, *args, **kwargs ):
+    """
+    Calls func( *args, **kwargs ) with profiling enabled, prints a summary
+    of the counters and timers (see print_report()) and returns the output
+    of func along with the report as a tuple. Any profiling that was already
+    in progress is switched off afterwards.
+    """
+
+    enable()
+    t1 = time.time()
+    try:
+        output = func( *args, **kwargs )
+    finally:
+        PROFILE['times']['total'] = time.time() - t1
+        profile_report = disable()
+    print_report( profile_report )
+
+    return output, profile_report
+
+
+def print_report( profile_report=None ):
+    """
+    Prints the counters and timers in a report returned by disable(),
+    report() or profile(), or those accumulated so far if no report
+    is provided.
+    """
+
+    if profile_report==None:
+        profile_report = report()
+    if profile_report==None:
+        print '\nProfiling is not enabled'
+        return None
+
+    times = profile_report['times']
+    counts = profile_report['counts']
+    total = times.get( 'total', None )
+    print '\nTimers (s):'
+    for key in sorted( times.keys(), key=lambda key: -times[key] ):
+        if total:
+            print '  {0:<36s}{1:12.4f}{2:8.1f}%'.format( key, times[key], 100*times[key] / total )
+        else:
+            print '  {0:<36s}{1:12.4f}'.format( key, times[key] )
+    print '\nCounters:'
+    for key in sorted( counts.keys() ):
+        print '  {0:<36s}{1:12d}'.format( key, counts[key] )
+
+    return None
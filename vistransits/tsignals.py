@@ -1,8 +1,8 @@
-import os, sys, pdb
-import atpy
+import sys, time
 import ephem
 import numpy as np
 import tutilities
+import tprofile
 
 G = 6.67428e-11 # gravitational constant in m^3/kg^-1/s^-2
 HPLANCK = 6.62607e-34 # planck's constant in J*s
@@ -14,7 +14,10 @@ RJUP = 7.1492e7 # jupiter radius in m
 MJUP = 1.89852e27 # jupiter mass in kg
 AU2M = 1.49598e11 # au to metres conversion factor
 MUJUP = 2.22e-3 # jupiter atmosphere mean molecular weight in kg/mole
-TR_TABLE = 'exoplanets_transiting.fits' # fits file for known exoplanets that transit
+PLANCK_C1 = 2 * HPLANCK * ( C**2. ) # first radiation constant for spectral radiance in W*m^2/sr
+PLANCK_C2 = HPLANCK * C / KB # second radiation constant in m*K
+WIEN_XMAX = 700. # value of hc/(lambda*k*T) above which the Wien limit is used by planck()
+EXPM1_XMIN = 1e-2 # value of hc/(lambda*k*T) below which planck_expm1() switches to np.expm1()
 
 
 
@@ -30,68 +33,27 @@ def emission( wav=2.2, wav_ref=2.2, obj_ref='WASP-19 b', outfile='signals_eclips
     constant when working with magnitudes at arbitrary wavelengths.
     """
 
-    # Convert the wavelengths from microns to metres:
-    wav = wav / 1e6
-    wav_ref = wav_ref / 1e6
-
-    # Get table data for planets that we have enough information on:
-    t = filter_table( sigtype='emission', download_latest=download_latest )
+    # Calculate the signals for the planets that we have enough information on:
+    signals = rank_signals( [ wav ], wav_ref=wav_ref, obj_ref=obj_ref, \
+                            download_latest=download_latest )
+    ixs = signals['emission_ok']
+    t = signals['table'][ixs]
     nplanets = len( t.NAME )
-
-    # Calculate the equilibrium temperatures for all planets on list:
-    Temp_eq = Teq( t )
-
-    # Assuming black body radiation, calculate the ratio between the
-    # energy emitted by the planet per m^2 of surface per second,
-    # compared to the star:
-    bratio = planck( wav, Temp_eq ) / planck( wav, t.TEFF )
-
-    # Convert the above to the ratio of the measured fluxes:
-    fratio = bratio * ( ( t.R * RJUP) / ( t.RSTAR * RSUN ) )**2
-
-    # Using the known Ks ( ~2.2microns ) magnitude as a reference,
-    # approximate the magnitude in the current wavelength of interest:
-    kratio = planck( wav, t.TEFF ) / planck( 2.2e-6, t.TEFF )
-    mag_star = t.KS - 2.5 * np.log10( kratio )
-    # Note that this assumes the magnitude of the reference star that
-    # the magnitudes such as t.KS are defined wrt is approximately the
-    # same at wav and 2.2 microns.
-
-    # Convert the approximate magnitude to an unnormalised stellar flux 
-    # in the wavelength of interest:
-    flux_star_unnorm = 10**( -mag_star / 2.5 )
-
-    # Use the fact that the signal-to-noise is:
-    #   signal:noise = f_planet / sqrt( flux_star )
-    #                = sqrt( f_star ) * fratio
-    # but note that we still have the normalising
-    # constant to be taken care of (see next):
-    snr_unnorm = np.sqrt( flux_star_unnorm ) * fratio
-
-    # The signal-to-noise ratio is still not normalised, so we need to repeat
-    # the above for another reference star; seeing as the normalising constant
-    # It might be useful to put the signal-to-noise in different units, namely,
-    # compare the size of the current signal to that of another reference target 
-    # at some reference wavelength. Basically repeat the above for the reference:
-    ii = ( t.NAME==obj_ref )
-    bratio_ref = planck( wav_ref, Temp_eq[ii] ) / planck( wav_ref, t.TEFF[ii] )
-    fratio_ref = bratio_ref * ( ( t.R[ii] * RJUP ) / ( t.RSTAR[ii] * RSUN ) )**2
-    kratio_ref = planck( wav_ref, t.TEFF[ii] ) / planck( 2.2e-6, t.TEFF[ii] )
-    mag_ref = t.KS[ii] - 2.5 * np.log10( kratio_ref )
-    flux_ref = 10**( -mag_ref/2.5 )
-    snr_ref = np.sqrt( flux_ref ) * fratio_ref
-
-    # Reexpress the signal-to-noise of our target as a scaling of the reference
-    # signal-to-noise:
-    snr_norm = snr_unnorm / snr_ref
+    if np.any( t.NAME==obj_ref )==False:
+        print '\n\nPlease select a different reference star for which we have a Ks magnitude\n\n'
+        return None
+    Temp_eq = signals['Teq'][ixs]
+    fratio = signals['fratio'][ixs,0]
+    snr_norm = signals['emission'][ixs,0]
 
     # Rearrange the targets in order of the most promising:
     s = np.argsort( snr_norm )
     s = s[::-1]
 
     # Open the output file and write the column headings:
+    t1 = tprofile.start()
     ofile = open( outfile, 'w' )
-    header = make_header_ec( nplanets, wav, wav_ref, obj_ref )
+    header = make_header_ec( nplanets, wav / 1e6, wav_ref / 1e6, obj_ref )
     ofile.write( header )
     
     for j in range( nplanets ):
@@ -101,10 +63,13 @@ def emission( wav=2.2, wav_ref=2.2, obj_ref='WASP-19 b', outfile='signals_eclips
                                  fratio[i], snr_norm[i] )
         ofile.write( outstr )
     ofile.close()
+    tprofile.stop( 'write_signals', t1 )
+    tprofile.count( 'signals_written', nplanets )
     print 'Saved output in {0}'.format( outfile )
     
     return outfile
 
+
 def transmission( wav_vis=0.7, wav_ir=2.2, wav_ref=2.2, obj_ref='WASP-19 b', outfile='signals_transits.txt', download_latest=True ):
     """
     
@@ -117,14 +82,12 @@ def transmission( wav_vis=0.7, wav_ir=2.2, wav_ref=2.2, obj_ref='WASP-19 b', out
     # making it simple to extrapolate from the output this produces:
     n = 1
 
-    # Convert the wavelengths from microns to metres:
-    wav_vis = wav_vis / 1e6
-    wav_ir = wav_ir / 1e6    
-    wav_ref = wav_ref / 1e6
-
-    # Make we exclude table rows that do not contain
-    # all the necessary properties:
-    t = filter_table( sigtype='transmission', download_latest=download_latest )
+    # Calculate the signals for the planets that we have enough information on,
+    # at the visible and IR wavelengths:
+    signals = rank_signals( [ wav_vis, wav_ir ], wav_ref=wav_ref, obj_ref=obj_ref, \
+                            download_latest=download_latest )
+    ixs = signals['transmission_ok']
+    t = signals['table'][ixs]
     nplanets = len( t.NAME )
 
     # First check to make sure we have both a V and Ks
@@ -133,89 +96,24 @@ def transmission( wav_vis=0.7, wav_ir=2.2, wav_ref=2.2, obj_ref='WASP-19 b', out
     if ( np.isfinite( t.KS[ix] )==False ) or ( np.isfinite( t.V[ix] )==False ):
         print '\n\nPlease select a different reference star for which we have both a V and Ks magnitude\n\n'
         return None
-
-
-    # Calculate the approximate planetary equilibrium temperature:
-    Temp_eq = Teq( t )
-
-    # Calculate the gravitaional accelerations at the surface zero-level:
-    MPLANET = np.zeros( nplanets )
-    for i in range( nplanets ):
-        try:
-            MPLANET[i] = np.array( t.MASS[i], dtype=float )
-        except:
-            MPLANET[i] = np.array( t.MSINI[i], dtype=float )
-            print t.NAME[i]
-    little_g = G * MPLANET * MJUP / ( t.R * RJUP )**2
-
-    # Calculate the atmospheric scale height in metres; note that
-    # we use RGAS instead of KB because MUJUP is **per mole**:
-    Hatm = RGAS * Temp_eq / MUJUP / little_g
-
-    # Calculate the approximate change in transit depth for a
-    # wavelength range where some species in the atmosphere
-    # increases the opacity of the planetary limb for an additional
-    # 2.5 (i.e. 5/2) scale heights:
-    depth_tr = ( ( t.R * RJUP ) / ( t.RSTAR * RSUN ) )**2
-    delta_tr = 2 * n * ( t.R * RJUP ) * Hatm / ( t.RSTAR * RSUN )**2
-
-    # Using the known Ks magnitude of the target, estimate the
-    # unnormalised signal-to-noise ratio of the change in transit
-    # depth that we would measure in the visible and IR separately:
-    bratio = planck( wav_vis, t.TEFF ) / planck( 2.2e-6, t.TEFF )
-    mag = t.KS - 2.5 * np.log10( bratio )
-    flux_unnorm = 10**( -mag/2.5 )
-    snr_unnorm_vis = np.sqrt( flux_unnorm ) * delta_tr
-
-    bratio = planck( wav_ir, t.TEFF ) / planck( 2.2e-6, t.TEFF )
-    mag = t.KS - 2.5 * np.log10( bratio )
-    flux_unnorm = 10**( -mag/2.5 )
-    snr_unnorm_ir = np.sqrt( flux_unnorm ) * delta_tr
-
-    # Repeat the above using the known V band for any that didn't
-    # have known KS magnitudes:
-    ixs = ( np.isfinite( t.KS )==False )
-    
-    bratio = planck( wav_vis, t.TEFF[ixs] ) / planck( 0.6e-6, t.TEFF[ixs] )
-    mag = t.V[ixs] - 2.5 * np.log10( bratio )
-    flux_unnorm = 10**( -mag/2.5 )
-    snr_unnorm_vis[ixs] = np.sqrt( flux_unnorm ) * delta_tr[ixs]
-
-    bratio = planck( wav_ir, t.TEFF[ixs] ) / planck( 2.2e-6, t.TEFF[ixs] )
-    mag = t.KS[ixs] - 2.5 * np.log10( bratio )
-    flux_unnorm = 10**( -mag/2.5 )
-    snr_unnorm_ir[ixs] = np.sqrt( flux_unnorm ) * delta_tr[ixs]
-    
-
-    # The signal-to-noise ratio is still not normalised, so we need to repeat
-    # the above for another reference star; seeing as the normalising constant
-    # It might be useful to put the signal-to-noise in different units, namely,
-    # compare the size of the current signal to that of another reference target 
-    # at some reference wavelength. Basically repeat the above for the reference:
-    ii = ( t.NAME==obj_ref )
-    delta_tr_ref = 2 * n * ( t.R[ii] * RJUP) * Hatm[ii] / ( t.RSTAR[ii] * RSUN )**2
-    kratio_ref = planck( wav_ref, t.TEFF[ii] ) / planck( 2.2e-6, t.TEFF[ii] )
-
-    mag_ref_ir = t.KS[ii] - 2.5 * np.log10( kratio_ref )
-    flux_ref_ir = 10**( -mag_ref_ir/2.5 )
-    snr_ref_ir = np.sqrt( flux_ref_ir ) * delta_tr_ref
-
-    mag_ref_vis = t.V[ii] - 2.5 * np.log10( kratio_ref )
-    flux_ref_vis = 10**( -mag_ref_vis/2.5 )
-    snr_ref_vis = np.sqrt( flux_ref_vis ) * delta_tr_ref
-
-    # Reexpress the signal-to-noise of our target as a scaling of the reference
-    # signal-to-noise:
-    snr_norm_vis = snr_unnorm_vis / snr_ref_vis
-    snr_norm_ir = snr_unnorm_ir / snr_ref_ir
+    Temp_eq = signals['Teq'][ixs]
+    Hatm = signals['Hatm'][ixs]
+    depth_tr = signals['depth_tr'][ixs]
+    delta_tr = signals['delta_tr'][ixs]
+    snr_norm_vis = signals['transmission_vis'][ixs,0]
+    snr_norm_ir = signals['transmission_ir'][ixs,1]
+    nmsini = np.sum( signals['mass_source'][ixs]=='MSINI' )
+    if nmsini>0:
+        print 'Using MSINI in place of MASS for {0} of {1} planets'.format( nmsini, nplanets )
 
     # Rearrange the targets in order of the most promising:
     s = np.argsort( snr_norm_vis )
     s = s[::-1]
 
     # Open the output file and write the column headings:
+    t1 = tprofile.start()
     ofile = open( outfile, 'w' )
-    header = make_header_tr( nplanets, wav_vis, wav_ir, wav_ref, obj_ref, n )
+    header = make_header_tr( nplanets, wav_vis / 1e6, wav_ir / 1e6, wav_ref / 1e6, obj_ref, n )
     ofile.write( header )
     
     for j in range( nplanets ):
@@ -234,36 +132,339 @@ def transmission( wav_vis=0.7, wav_ir=2.2, wav_ref=2.2, obj_ref='WASP-19 b', out
                                  snr_norm_vis[i], snr_norm_ir[i] )
         ofile.write( outstr )
     ofile.close()
+    tprofile.stop( 'write_signals', t1 )
+    tprofile.count( 'signals_written', nplanets )
     print 'Saved output in {0}'.format( outfile )
     
     return outfile
 
 
+def rank_signals( wavs, wav_ref=2.2, obj_ref='WASP-19 b', table=None, download_latest=True ):
+    """
+    Evaluates the eclipse and transmission signal-to-noise ratios of all the
+    transiting planets that we have enough information on, at each of the
+    wavelengths in wavs (microns), relative to the reference planet obj_ref
+    at the reference wavelength wav_ref (microns). The table is loaded and
+    filtered once (or can be provided as table, in which case it should have
+    already been through filter_table()) and the calculations are broadcast
+    over planets and wavelengths in a single pass, using the same approach
+    as emission() and transmission().
+
+    Returns a dictionary containing:
+      table - The filtered table, with one row per planet.
+      wavs - The wavelengths in microns.
+      Teq - The planet equilibrium temperatures (see Teq()).
+      emission_ok - Mask of planets with the properties needed by emission().
+      transmission_ok - Mask of planets with the properties needed by transmission().
+      fratio - Planet-to-star flux ratios with shape (nplanets, nwavs).
+      emission - Eclipse signal-to-noise ratios with shape (nplanets, nwavs).
+      Hatm - Atmospheric scale heights in metres.
+      depth_tr - Transit depths.
+      delta_tr - Change in transit depth for one atmospheric scale height.
+      transmission_vis, transmission_ir - Transmission signal-to-noise ratios
+          with shape (nplanets, nwavs), normalised using the V and Ks magnitudes
+          of the reference star respectively, as for the visible and IR columns
+          of the transmission() output.
+      mass, mass_source - Planet masses and where they came from (see planet_masses()).
+    Values for planets that are missing the properties needed for a particular
+    signal, or for all planets if the reference planet is, are set to NaN.
+    """
+
+    # Calculate transmission signal as the variation in flux drop
+    # caused by a change in the effective planetary radius by n=1
+    # atmospheric scale heights (see transmission()):
+    n = 1
+
+    # Convert the wavelengths from microns to metres and arrange them
+    # along the second axis, with the planets along the first axis:
+    wavs = np.atleast_1d( np.asarray( wavs, dtype=float ) )
+    wav = wavs[np.newaxis,:] / 1e6
+    wav_ref = wav_ref / 1e6
+
+    # Get table data for planets that we have enough information on:
+    if table is None:
+        t1 = tprofile.start()
+        t = filter_table( sigtype=None, download_latest=download_latest )
+        tprofile.stop( 'load_table', t1 )
+    else:
+        t = table
+    t1 = tprofile.start()
+    nplanets = len( t.NAME )
+    nwavs = len( wavs )
+    tstar = t.TEFF[:,np.newaxis]
+
+    # Calculate the equilibrium temperatures for all planets on list:
+    Temp_eq = Teq( t )
+
+    # Eclipse signals, which need a Ks magnitude. Assuming black body
+    # radiation, calculate the ratio between the energy emitted by the
+    # planet per m^2 of surface per second, compared to the star:
+    emission_ok = np.isfinite( t.KS )
+    bratio = planck_ratio( wav, Temp_eq[:,np.newaxis], tstar )
+
+    # Convert the above to the ratio of the measured fluxes:
+    fratio = bratio * ( ( ( t.R * RJUP) / ( t.RSTAR * RSUN ) )**2 )[:,np.newaxis]
+
+    # Using the known Ks ( ~2.2microns ) magnitude as a reference,
+    # approximate the magnitude in the current wavelength of interest:
+    kratio = planck_wav_ratio( wav, 2.2e-6, tstar )
+    mag_star = t.KS[:,np.newaxis] - 2.5 * np.log10( kratio )
+    # Note that this assumes the magnitude of the reference star that
+    # the magnitudes such as t.KS are defined wrt is approximately the
+    # same at wav and 2.2 microns.
+
+    # Convert the approximate magnitude to an unnormalised stellar flux 
+    # in the wavelength of interest:
+    flux_star_unnorm = 10**( -mag_star / 2.5 )
+
+    # Use the fact that the signal-to-noise is:
+    #   signal:noise = f_planet / sqrt( flux_star )
+    #                = sqrt( f_star ) * fratio
+    # but note that we still have the normalising
+    # constant to be taken care of (see next):
+    snr_unnorm = np.sqrt( flux_star_unnorm ) * fratio
+
+    # Reexpress the signal-to-noise as a scaling of the signal-to-noise
+    # of the reference target at the reference wavelength:
+    ii = ( t.NAME==obj_ref )*emission_ok
+    if np.any( ii ):
+        bratio_ref = planck_ratio( wav_ref, Temp_eq[ii], t.TEFF[ii] )
+        fratio_ref = bratio_ref * ( ( t.R[ii] * RJUP ) / ( t.RSTAR[ii] * RSUN ) )**2
+        kratio_ref = planck_wav_ratio( wav_ref, 2.2e-6, t.TEFF[ii] )
+        mag_ref = t.KS[ii] - 2.5 * np.log10( kratio_ref )
+        flux_ref = 10**( -mag_ref/2.5 )
+        snr_ref = np.sqrt( flux_ref ) * fratio_ref
+        snr_norm = snr_unnorm / snr_ref
+    else:
+        snr_norm = np.zeros( [ nplanets, nwavs ] ) + np.nan
+
+    # Transmission signals, which are only calculated for planets with a
+    # mass and a V and/or Ks magnitude. First calculate the gravitational
+    # accelerations at the surface zero-level:
+    transmission_ok = transmission_mask( t )
+    tr = t[transmission_ok]
+    MPLANET, mass_source = planet_masses( t )
+    little_g = G * MPLANET[transmission_ok] * MJUP / ( tr.R * RJUP )**2
+
+    # Calculate the atmospheric scale height in metres; note that
+    # we use RGAS instead of KB because MUJUP is **per mole**:
+    Hatm_tr = RGAS * Temp_eq[transmission_ok] / MUJUP / little_g
+
+    # Calculate the approximate change in transit depth for a
+    # wavelength range where some species in the atmosphere
+    # increases the opacity of the planetary limb for an additional
+    # 2.5 (i.e. 5/2) scale heights:
+    depth_tr_tr = ( ( tr.R * RJUP ) / ( tr.RSTAR * RSUN ) )**2
+    delta_tr_tr = 2 * n * ( tr.R * RJUP ) * Hatm_tr / ( tr.RSTAR * RSUN )**2
+
+    # Using the known Ks magnitude of the target, estimate the
+    # unnormalised signal-to-noise ratio of the change in transit
+    # depth; the visible and IR columns of the transmission() output
+    # only differ for planets without a Ks magnitude (see below):
+    tstar_tr = tr.TEFF[:,np.newaxis]
+    bratio = planck_wav_ratio( wav, 2.2e-6, tstar_tr )
+    mag = tr.KS[:,np.newaxis] - 2.5 * np.log10( bratio )
+    flux_unnorm = 10**( -mag/2.5 )
+    snr_unnorm_ir = np.sqrt( flux_unnorm ) * delta_tr_tr[:,np.newaxis]
+    snr_unnorm_vis = snr_unnorm_ir.copy()
+
+    # Repeat the above using the known V band for any that didn't
+    # have known KS magnitudes, which is only possible in the visible:
+    ixs = ( np.isfinite( tr.KS )==False )
+    bratio = planck_wav_ratio( wav, 0.6e-6, tstar_tr[ixs] )
+    mag = tr.V[ixs][:,np.newaxis] - 2.5 * np.log10( bratio )
+    flux_unnorm = 10**( -mag/2.5 )
+    snr_unnorm_vis[ixs] = np.sqrt( flux_unnorm ) * delta_tr_tr[ixs][:,np.newaxis]
+
+    # Normalise by the signal-to-noise of the reference target at the
+    # reference wavelength, using its V and Ks magnitudes in turn:
+    ii = ( tr.NAME==obj_ref )
+    snr_norm_vis = np.zeros( [ nplanets, nwavs ] ) + np.nan
+    snr_norm_ir = np.zeros( [ nplanets, nwavs ] ) + np.nan
+    if np.any( ii ):
+        delta_tr_ref = 2 * n * ( tr.R[ii] * RJUP) * Hatm_tr[ii] / ( tr.RSTAR[ii] * RSUN )**2
+        kratio_ref = planck_wav_ratio( wav_ref, 2.2e-6, tr.TEFF[ii] )
+        mag_ref_ir = tr.KS[ii] - 2.5 * np.log10( kratio_ref )
+        flux_ref_ir = 10**( -mag_ref_ir/2.5 )
+        snr_ref_ir = np.sqrt( flux_ref_ir ) * delta_tr_ref
+        mag_ref_vis = tr.V[ii] - 2.5 * np.log10( kratio_ref )
+        flux_ref_vis = 10**( -mag_ref_vis/2.5 )
+        snr_ref_vis = np.sqrt( flux_ref_vis ) * delta_tr_ref
+        snr_norm_vis[transmission_ok] = snr_unnorm_vis / snr_ref_vis
+        snr_norm_ir[transmission_ok] = snr_unnorm_ir / snr_ref_ir
+
+    Hatm = np.zeros( nplanets ) + np.nan
+    depth_tr = np.zeros( nplanets ) + np.nan
+    delta_tr = np.zeros( nplanets ) + np.nan
+    Hatm[transmission_ok] = Hatm_tr
+    depth_tr[transmission_ok] = depth_tr_tr
+    delta_tr[transmission_ok] = delta_tr_tr
+
+    signals = { 'table':t, 'wavs':wavs, 'Teq':Temp_eq, 'emission_ok':emission_ok, \
+                'transmission_ok':transmission_ok, 'fratio':fratio, 'emission':snr_norm, \
+                'Hatm':Hatm, 'depth_tr':depth_tr, 'delta_tr':delta_tr, \
+                'transmission_vis':snr_norm_vis, 'transmission_ir':snr_norm_ir, \
+                'mass':MPLANET, 'mass_source':mass_source }
+    tprofile.stop( 'rank_signals', t1 )
+    tprofile.count( 'signals_ranked', nplanets*nwavs )
+
+    return signals
+
+
+def sweep_signals( wav_min=0.5, wav_max=5.0, nwavs=91, bands=None, nsub=21, wav_ref=2.2, \
+                   obj_ref='WASP-19 b', outfile='signals_sweep.npz', download_latest=True ):
+    """
+    Evaluates the eclipse and transmission signal-to-noise ratios of all the
+    transiting planets over a grid of wavelengths, relative to the reference
+    planet obj_ref at the reference wavelength wav_ref (microns), as for
+    emission() and transmission(). All of the wavelengths are calculated in
+    one go by rank_signals() and the results are saved to a single NumPy
+    .npz file.
+
+    INPUTS
+      **wav_min, wav_max, nwavs - The signal-to-noise ratios are calculated at
+          nwavs wavelengths evenly spaced between wav_min and wav_max (microns).
+      **bands - If set to a list of ( lower, upper ) wavelength pairs (microns),
+          the signal-to-noise ratios are integrated over each of these bands
+          instead, sampling each band at nsub wavelengths. The star and planet
+          fluxes are integrated separately, so the band values are the
+          signal-to-noise relative to the reference planet observed in an
+          equally-wide band centred on wav_ref.
+      **outfile - Name of the .npz output file, or None for no output file.
+
+    OUTPUT
+      Returns a dictionary containing the planet names ('names'), the grid
+      wavelengths or band centres ('wavs'), the band limits ('bands', empty if
+      no bands were given) and arrays of the signal-to-noise ratios with shape
+      (nplanets, nwavs) for eclipses ('emission') and for transmission spectra
+      normalised using the V and Ks magnitudes of the reference star
+      ('transmission_vis', 'transmission_ir'), which are NaN for planets
+      missing the properties needed for that signal. The same arrays are
+      saved in the output file.
+    """
+
+    if bands is None:
+        wavs = np.linspace( wav_min, wav_max, nwavs )
+        signals = rank_signals( wavs, wav_ref=wav_ref, obj_ref=obj_ref, \
+                                download_latest=download_latest )
+        bands = np.zeros( [ 0, 2 ] )
+        sweep = { 'emission':signals['emission'], \
+                  'transmission_vis':signals['transmission_vis'], \
+                  'transmission_ir':signals['transmission_ir'] }
+    else:
+
+        # Sample all of the bands in a single call:
+        bands = np.array( bands, dtype=float ).reshape( [ -1, 2 ] )
+        nbands = len( bands )
+        wavs_sub = np.concatenate( [ np.linspace( band[0], band[1], nsub ) for band in bands ] )
+        signals = rank_signals( wavs_sub, wav_ref=wav_ref, obj_ref=obj_ref, \
+                                download_latest=download_latest )
+        wavs = bands.mean( axis=1 )
+
+        # The stellar flux used for the signal-to-noise ratios is proportional
+        # to the Planck function, so for a signal-to-noise ratio snr and stellar
+        # flux f at each wavelength, the band signal-to-noise is:
+        #   mean( snr * sqrt( f ) ) / sqrt( mean( f ) )
+        # where the means are taken over the band:
+        t = signals['table']
+        flux = planck( wavs_sub[np.newaxis,:] / 1e6, t.TEFF[:,np.newaxis] )
+        flux = flux.reshape( [ len( t.NAME ), nbands, nsub ] )
+        wavs_sub = wavs_sub.reshape( [ 1, nbands, nsub ] )
+        widths = bands[:,1] - bands[:,0]
+        flux_mean = np.trapz( flux, x=wavs_sub, axis=2 ) / widths
+        sweep = {}
+        for key in [ 'emission', 'transmission_vis', 'transmission_ir' ]:
+            snr = signals[key].reshape( [ len( t.NAME ), nbands, nsub ] )
+            snr_mean = np.trapz( snr*np.sqrt( flux ), x=wavs_sub, axis=2 ) / widths
+            sweep[key] = snr_mean / np.sqrt( flux_mean )
+
+    sweep['names'] = np.array( signals['table'].NAME )
+    sweep['wavs'] = wavs
+    sweep['bands'] = bands
+    if outfile!=None:
+        np.savez( outfile, **sweep )
+        print 'Saved output in {0}'.format( outfile )
+
+    return sweep
+
+
 def filter_table( sigtype=None, download_latest=True ):
     """
     Identify entries from the containing values for all of the
     required properties.
     """
 
-    if ( os.path.isfile( TR_TABLE )==False )+( download_latest==True ):
+    if download_latest==True:
         tutilities.download_data()
-    t = atpy.Table( TR_TABLE )
-    t = t.where( np.isfinite( t.RSTAR ) ) # stellar radius
-    t = t.where( np.isfinite( t.R ) ) # planetary radius
-    t = t.where( np.isfinite( t.A ) ) # semimajor axis
-    t = t.where( np.isfinite( t.TEFF ) ) # stellar effective temperature
+    t = tutilities.load_transiting_table()
+    if t is None:
+        tutilities.download_data()
+        t = tutilities.load_transiting_table()
+    t = t[ np.isfinite( t.RSTAR ) ] # stellar radius
+    t = t[ np.isfinite( t.R ) ] # planetary radius
+    t = t[ np.isfinite( t.A ) ] # semimajor axis
+    t = t[ np.isfinite( t.TEFF ) ] # stellar effective temperature
     if sigtype=='emission':
-        t = t.where( np.isfinite( t.KS ) ) # stellar Ks magnitude
+        t = t[ np.isfinite( t.KS ) ] # stellar Ks magnitude
     if sigtype=='transmission':
-        t = t.where( np.isfinite( t.KS ) + np.isfinite( t.V ) ) # stellar Ks and/or V magnitude
-        try:
-            t = t.where( ( np.isfinite( t.MSINI ) * ( t.MSINI>0 ) + \
-                           ( np.isfinite( t.MASS ) * ( t.MASS>0 ) ) ) ) # MSINI and MASS available
-        except:
-            t = t.where( ( np.isfinite( t.MSINI ) * ( t.MSINI>0 ) ) ) # only MSINI available
+        t = t[ transmission_mask( t ) ]
 
     return t
 
+
+def transmission_mask( table ):
+    """
+    Identifies the rows of a table that pass filter_table() with sigtype=None
+    that contain the additional properties required by transmission().
+    """
+
+    t = table
+    mask = np.isfinite( t.KS ) + np.isfinite( t.V ) # stellar Ks and/or V magnitude
+    mask *= ( planet_masses( t )[1]!='none' ) # MASS and/or MSINI available
+
+    return mask
+
+
+def planet_masses( table ):
+    """
+    Returns the planet masses in Jupiter masses, taking the MASS value where
+    it is finite and positive and the MSINI value otherwise, along with an
+    array giving the source of each mass ('MASS', 'MSINI', or 'none' if
+    neither value is usable, in which case the mass is NaN).
+    """
+
+    mass = float_column( table, 'MASS' )
+    msini = float_column( table, 'MSINI' )
+    mass_ok = np.isfinite( mass )*( mass>0 )
+    msini_ok = np.isfinite( msini )*( msini>0 )*( mass_ok==False )
+    MPLANET = np.zeros( len( mass ) ) + np.nan
+    MPLANET[mass_ok] = mass[mass_ok]
+    MPLANET[msini_ok] = msini[msini_ok]
+    source = np.array( [ 'none' ]*len( mass ), dtype='S5' )
+    source[mass_ok] = 'MASS'
+    source[msini_ok] = 'MSINI'
+
+    return MPLANET, source
+
+
+def float_column( table, column ):
+    """
+    Returns a table column as an array of floats, with NaNs for any blank
+    entries, which can be left as strings when the csv file is converted.
+    Missing columns are returned as all NaNs.
+    """
+
+    if column not in table.dtype.names:
+        return np.zeros( len( table ) ) + np.nan
+    values = np.asarray( table[column] )
+    if values.dtype.kind in 'SU':
+        values = np.char.strip( values )
+        values = np.where( values=='', 'nan', values )
+    with np.errstate( invalid='ignore' ):
+        values = values.astype( float )
+
+    return values
+
 def Teq( table ):
     """
     Calculates the equilibrium temperature of the planet, assuming zero
@@ -283,14 +484,140 @@ def planck( wav, temp ):
     """
     Evaluates the Planck function for given values of wavelength
     and temperature. Wavelength should be provided in metres and
-    temperature should be provided in Kelvins.
+    temperature should be provided in Kelvins. Uses expm1() to keep
+    full precision in the Rayleigh-Jeans limit, and the Wien limit
+    where the exponential would otherwise overflow.
+    """
+
+    wav = np.asarray( wav, dtype=float )
+    temp = np.asarray( temp, dtype=float )
+    c2_wav = PLANCK_C2 / wav
+    x = c2_wav / temp
+    term1 = PLANCK_C1 / ( wav**5. )
+    if wien_possible( c2_wav, temp ):
+        with np.errstate( over='ignore' ):
+            bbflux = np.where( x>WIEN_XMAX, term1 * np.exp( -x ), term1 / np.expm1( x ) )
+    else:
+        bbflux = term1 / planck_expm1( x, c2_wav, temp )
+
+    return bbflux[()]
+
+
+def planck_ratio( wav, temp1, temp2 ):
+    """
+    Evaluates planck( wav, temp1 ) / planck( wav, temp2 ) without evaluating
+    the wavelength-dependent prefactor, which cancels. In the Wien limit the
+    ratio is rearranged so that it stays finite even when both Planck
+    functions underflow.
+    """
+
+    temp1 = np.asarray( temp1, dtype=float )
+    temp2 = np.asarray( temp2, dtype=float )
+    c2_wav = PLANCK_C2 / np.asarray( wav, dtype=float )
+    x1 = c2_wav / temp1
+    x2 = c2_wav / temp2
+    if wien_possible( c2_wav, temp1 ) or wien_possible( c2_wav, temp2 ):
+        ratio = np.exp( x2 - x1 ) * np.expm1( -x2 ) / np.expm1( -x1 )
+    else:
+        ratio = planck_expm1( x2, c2_wav, temp2 ) / planck_expm1( x1, c2_wav, temp1 )
+
+    return ratio[()]
+
+
+def planck_wav_ratio( wav1, wav2, temp ):
+    """
+    Evaluates planck( wav1, temp ) / planck( wav2, temp ) in the same way
+    as planck_ratio().
+    """
+
+    wav1 = np.asarray( wav1, dtype=float )
+    wav2 = np.asarray( wav2, dtype=float )
+    temp = np.asarray( temp, dtype=float )
+    c2_wav1 = PLANCK_C2 / wav1
+    c2_wav2 = PLANCK_C2 / wav2
+    x1 = c2_wav1 / temp
+    x2 = c2_wav2 / temp
+    if wien_possible( c2_wav1, temp ) or wien_possible( c2_wav2, temp ):
+        ratio = ( ( wav2 / wav1 )**5. ) * np.exp( x2 - x1 ) * np.expm1( -x2 ) / np.expm1( -x1 )
+    else:
+        ratio = ( ( wav2 / wav1 )**5. ) * planck_expm1( x2, c2_wav2, temp ) \
+                / planck_expm1( x1, c2_wav1, temp )
+
+    return ratio[()]
+
+
+def planck_expm1( x, c2_wav, temp ):
+    """
+    Evaluates exp( x ) - 1 in place for x = c2_wav / temp, which is
+    overwritten. np.expm1() is noticeably slower than np.exp(), so it is
+    only used if some x could be below EXPM1_XMIN, where subtracting 1
+    after np.exp() would start to lose precision.
+    """
+
+    if np.ndim( x )==0:
+        return np.expm1( x )
+    elif np.size( x )==0:
+        return x
+    elif np.min( c2_wav ) / np.max( temp )<EXPM1_XMIN:
+        return np.expm1( x, out=x )
+    np.exp( x, out=x )
+    x -= 1
+
+    return x
+
+
+def wien_possible( c2_wav, temp ):
+    """
+    Checks whether any combination of the wavelengths and temperatures
+    could be beyond WIEN_XMAX, using only the extreme values so that the
+    check costs nothing compared to evaluating the Planck functions.
+    """
+
+    if ( np.size( c2_wav )==0 ) or ( np.size( temp )==0 ):
+        return False
+
+    return np.max( c2_wav ) / np.min( temp )>WIEN_XMAX
+
+
+def benchmark_planck( nplanets=10000, nwavs=100, nrepeats=10 ):
+    """
+    Times the planet/star Planck function ratio used for the eclipse signals
+    over a grid of nplanets random planets and nwavs wavelengths, evaluated
+    directly with np.exp() and recomputed constants as planck() used to,
+    with the current planck(), and with planck_ratio(). Prints and returns
+    the mean time per evaluation in seconds for each approach, along with
+    the maximum relative difference between the old and new ratios.
     """
-    
-    term1 = 2 * HPLANCK * ( C**2. ) / ( wav**5. )
-    term2 = np.exp( HPLANCK * C / KB / wav / temp ) - 1
-    bbflux = term1 / term2
 
-    return bbflux
+    def planck_direct( wav, temp ):
+        term1 = 2 * HPLANCK * ( C**2. ) / ( wav**5. )
+        term2 = np.exp( HPLANCK * C / KB / wav / temp ) - 1
+        return term1 / term2
+
+    np.random.seed( 1 )
+    wav = np.linspace( 0.5e-6, 5e-6, nwavs )[np.newaxis,:]
+    tstar = np.random.uniform( 3000, 7000, nplanets )[:,np.newaxis]
+    tplanet = np.random.uniform( 500, 2500, nplanets )[:,np.newaxis]
+    funcs = [ [ 'direct', lambda: planck_direct( wav, tplanet ) / planck_direct( wav, tstar ) ], \
+              [ 'planck', lambda: planck( wav, tplanet ) / planck( wav, tstar ) ], \
+              [ 'planck_ratio', lambda: planck_ratio( wav, tplanet, tstar ) ] ]
+    timings = {}
+    with np.errstate( over='ignore' ):
+        for name, func in funcs:
+            t1 = time.time()
+            for i in range( nrepeats ):
+                ratio = func()
+            timings[name] = ( time.time() - t1 ) / nrepeats
+        ratio_direct = funcs[0][1]()
+    timings['max_rel_diff'] = np.nanmax( np.abs( ratio / ratio_direct - 1 ) )
+
+    print '\nPlanck ratio for {0} planets x {1} wavelengths:'.format( nplanets, nwavs )
+    for name, func in funcs:
+        print '  {0:<14s}{1:.4f}s  ({2:.1f}x)'.format( name, timings[name], \
+                                                       timings['direct'] / timings[name] )
+    print '  maximum relative difference {0:.1e}'.format( timings['max_rel_diff'] )
+
+    return timings
 
 
 def make_header_ec( nplanets, wav, wav_ref, obj_ref ):
@@ -1,28 +1,229 @@
-import os, pdb
+import os, pdb, json, hashlib, shutil, time, urllib2, tempfile
 import numpy as np
-import atpy
 
 ALL_CSV = 'exoplanets.csv' # csv file for all known exoplanets
 ALL_FITS = 'exoplanets_all.fits' # fits file for all known exoplanets
 ALL_IPAC = 'exoplanets_all.ipac' # ipac file for all known exoplanets
 TR_FITS = 'exoplanets_transiting.fits' # fits file for known exoplanets that transit
 TR_IPAC = 'exoplanets_transiting.ipac' # ipac file for known exoplanets that transit 
+TR_CACHE = 'exoplanets_transiting.npy' # binary cache of the transiting planets table
+TR_MANIFEST = 'exoplanets_transiting.json' # manifest describing the binary cache
+CSV_URL = 'http://exoplanets.org/csv-files/exoplanets.csv' # source of the exoplanets.org csv file
+CSV_CACHE_DIR = 'exoplanets_csv_cache' # directory of downloaded csv files named by their SHA-1 hash
+TR_DIFF = 'exoplanets_transiting_diff.json' # changes made to the transiting planets table by the last download
+DIFF_COLUMNS = [ 'TT', 'PER', 'T14', 'RA', 'DEC', 'RA_STRING', 'DEC_STRING', 'V', 'KS', \
+                 'RSTAR', 'R', 'A', 'TEFF', 'MSINI', 'MASS' ] # columns compared by catalogue_diff()
 
 
-def download_data():
+def download_data( url=CSV_URL, max_age=1., offline=False, cache_dir=CSV_CACHE_DIR ):
   """
-  Uses wget to download a csv ascii file of planetary properties from
-  exoplanets.org then saves the table in fits and ipac formats. Output
-  files are first generated for all planets and then again for the
-  transiting planets only.
+  Downloads a csv ascii file of planetary properties from exoplanets.org
+  then converts it using convert_data().
+
+  If the table of transiting planets changes as a result, the differences
+  between the old and new tables are worked out by catalogue_diff(), saved
+  to the TR_DIFF file and returned. Otherwise None is returned.
+
+  Each download is stored in cache_dir under the SHA-1 hash of its contents,
+  along with an index recording the hash and download time for each url.
+  The url is not fetched again if the previous download is less than max_age
+  days old (set max_age to 0 to always fetch it), and no requests are made at
+  all if offline is True, in which case the most recent download is used. If
+  the download fails the most recent cached copy is used instead. Conversion
+  is skipped if the contents of the csv file haven't changed since they were
+  last converted. Any url handled by urllib2 can be used, including file://
+  urls for local copies.
   """
 
-  # Use wget to download the data:
-  cmd = 'wget http://exoplanets.org/csv-files/exoplanets.csv'
-  if os.path.exists( ALL_CSV ):
-    os.remove( ALL_CSV )
-  os.system( cmd )
-  
+  index = read_csv_index( cache_dir )
+  entry = index.get( url, None )
+  if entry!=None:
+    age = ( time.time() - entry['time'] ) / 86400.
+    cached_file = os.path.join( cache_dir, '{0}.csv'.format( entry['sha1'] ) )
+    if os.path.isfile( cached_file )==False:
+      entry = None
+
+  # Work out which copy of the csv file to use:
+  if offline==True:
+    if entry==None:
+      raise IOError( 'No cached copy of {0} is available in offline mode'.format( url ) )
+    sha1 = entry['sha1']
+  elif ( entry!=None ) and ( max_age>0 ) and ( age<max_age ):
+    print 'Using copy of {0} downloaded {1:.2f} days ago'.format( url, age )
+    sha1 = entry['sha1']
+  else:
+    try:
+      sha1 = fetch_csv( url, cache_dir )
+    except ( IOError, urllib2.URLError ) as err:
+      if entry==None:
+        raise
+      print 'Could not download {0} ({1}), using cached copy'.format( url, err )
+      sha1 = entry['sha1']
+    else:
+      index[url] = { 'sha1':sha1, 'time':time.time() }
+      write_csv_index( index, cache_dir )
+
+  # Only replace and convert the csv file if its contents have changed:
+  cached_file = os.path.join( cache_dir, '{0}.csv'.format( sha1 ) )
+  if os.path.isfile( ALL_CSV ) and ( file_fingerprint( ALL_CSV )['sha1']==sha1 ):
+    if os.path.isfile( TR_FITS ) and cache_valid( ALL_CSV ):
+      print 'Catalogue unchanged ({0}), skipping conversion'.format( sha1 )
+      return None
+  else:
+    shutil.copyfile( cached_file, ALL_CSV )
+
+  # Keep a copy of the previous table so that the changes can be reported:
+  if os.path.isfile( TR_CACHE ):
+    old_table = np.load( TR_CACHE ).view( np.recarray )
+  else:
+    old_table = None
+  convert_data()
+  if old_table is None:
+    return None
+  diff = catalogue_diff( old_table, load_transiting_table() )
+  ofile = open( TR_DIFF, 'w' )
+  json.dump( diff, ofile, indent=2, sort_keys=True )
+  ofile.close()
+  print_diff( diff )
+
+  return diff
+
+
+def catalogue_diff( old_table, new_table, columns=DIFF_COLUMNS ):
+  """
+  Compares two versions of the table of transiting planets, matching the
+  planets by name. Returns a dictionary containing lists of the names of
+  the planets that have been added ('added') and removed ('removed'), and
+  a dictionary ('changed') with the names of planets present in both tables
+  as keys, each entry listing the columns whose values differ. Only the
+  columns listed in columns are compared, and NaNs are treated as equal.
+  """
+
+  old_names = list( old_table.NAME )
+  new_names = list( new_table.NAME )
+  old_index = dict( zip( old_names, range( len( old_names ) ) ) )
+  new_index = dict( zip( new_names, range( len( new_names ) ) ) )
+  added = sorted( set( new_names ) - set( old_names ) )
+  removed = sorted( set( old_names ) - set( new_names ) )
+  common = sorted( set( old_names ) & set( new_names ) )
+  old_ixs = np.array( [ old_index[name] for name in common ], dtype=int )
+  new_ixs = np.array( [ new_index[name] for name in common ], dtype=int )
+
+  changed = {}
+  for column in columns:
+    if ( column not in old_table.dtype.names ) or ( column not in new_table.dtype.names ):
+      continue
+    old_values = old_table[column][old_ixs]
+    new_values = new_table[column][new_ixs]
+    try:
+      old_values = np.asarray( old_values, dtype=float )
+      new_values = np.asarray( new_values, dtype=float )
+      differ = ( old_values!=new_values )*( ( np.isnan( old_values )*np.isnan( new_values ) )==False )
+    except ValueError:
+      differ = ( np.asarray( old_values, dtype=str )!=np.asarray( new_values, dtype=str ) )
+    for j in np.flatnonzero( differ ):
+      changed.setdefault( common[j], [] ).append( column )
+  diff = { 'added':added, 'removed':removed, 'changed':changed }
+
+  return diff
+
+
+def print_diff( diff ):
+  """
+  Prints a summary of the differences returned by catalogue_diff().
+  """
+
+  print '\nCatalogue changes:'
+  print '  {0} added, {1} removed, {2} changed'\
+        .format( len( diff['added'] ), len( diff['removed'] ), len( diff['changed'] ) )
+  for name in diff['added']:
+    print '  + {0}'.format( name )
+  for name in diff['removed']:
+    print '  - {0}'.format( name )
+  for name in sorted( diff['changed'].keys() ):
+    print '  * {0} ({1})'.format( name, ', '.join( diff['changed'][name] ) )
+
+  return None
+
+
+def fetch_csv( url, cache_dir=CSV_CACHE_DIR ):
+  """
+  Downloads a file into cache_dir, naming it after the SHA-1 hash of its
+  contents, and returns the hash. The download goes to a temporary file
+  of its own, so concurrent downloads do not clobber one another, and
+  the temporary file is removed if the download fails.
+  """
+
+  if os.path.isdir( cache_dir )==False:
+    os.makedirs( cache_dir )
+  fd, tmp_file = tempfile.mkstemp( dir=cache_dir, suffix='.tmp' )
+  sha1 = hashlib.sha1()
+  try:
+    ofile = os.fdopen( fd, 'wb' )
+    try:
+      response = urllib2.urlopen( url, timeout=60 )
+      try:
+        for block in iter( lambda: response.read( 1048576 ), '' ):
+          sha1.update( block )
+          ofile.write( block )
+      finally:
+        response.close()
+    finally:
+      ofile.close()
+    sha1 = sha1.hexdigest()
+    os.rename( tmp_file, os.path.join( cache_dir, '{0}.csv'.format( sha1 ) ) )
+  except:
+    os.remove( tmp_file )
+    raise
+  print 'Downloaded {0} ({1})'.format( url, sha1 )
+
+  return sha1
+
+
+def read_csv_index( cache_dir=CSV_CACHE_DIR ):
+  """
+  Returns the index of downloads stored in cache_dir, which is a dictionary
+  with the urls as keys, each entry containing the SHA-1 hash of the most
+  recent download ('sha1') and the time it was made ('time').
+  """
+
+  index_file = os.path.join( cache_dir, 'index.json' )
+  if os.path.isfile( index_file )==False:
+    return {}
+  ifile = open( index_file, 'r' )
+  try:
+    index = json.load( ifile )
+  except ValueError:
+    index = {}
+  finally:
+    ifile.close()
+
+  return index
+
+
+def write_csv_index( index, cache_dir=CSV_CACHE_DIR ):
+  """
+  Saves the index of downloads stored in cache_dir (see read_csv_index()).
+  """
+
+  ofile = open( os.path.join( cache_dir, 'index.json' ), 'w' )
+  json.dump( index, ofile, indent=2, sort_keys=True )
+  ofile.close()
+
+  return None
+
+
+def convert_data():
+  """
+  Saves the table in the downloaded csv file in fits and ipac formats.
+  Output files are first generated for all planets and then again for
+  the transiting planets only, along with a binary cache of the latter
+  (see write_cache()).
+  """
+
+  # atpy is slow to import so only do so when it's actually needed:
+  import atpy
+
   # Read in using atpy:
   exo_dat = atpy.Table( ALL_CSV, type='ascii', delimiter=',', data_start=1, \
                         fill_values=( '', 'nan', 'RSTAR', 'TT', 'T14', 'TEFF', 'A', 'R', 'KS', 'PER', 'MSINI', 'V' ) )
@@ -41,5 +242,118 @@ def download_data():
   transit_dat.write( TR_FITS, overwrite=True )
   transit_dat.write( TR_IPAC, overwrite=True )
   transit_dat.describe()
+  write_cache( transit_dat.data, ALL_CSV )
+
+  return None
+
+
+def load_transiting_table( cache_file=TR_CACHE, manifest_file=TR_MANIFEST ):
+  """
+  Returns the table of transiting planets as a NumPy record array, so the
+  columns can be accessed as attributes in the same way as for an atpy
+  table (e.g. t.NAME). The table is memory-mapped from the binary cache,
+  which is regenerated first if the csv file it was made from has changed
+  since. If there is no csv file the cache is made from the transiting
+  planets fits file instead. Returns None if neither file is available.
+  """
+
+  if os.path.isfile( ALL_CSV ):
+    source = ALL_CSV
+  elif os.path.isfile( TR_FITS ):
+    source = TR_FITS
+  else:
+    return None
+  if cache_valid( source, cache_file=cache_file, manifest_file=manifest_file )==False:
+    if source==ALL_CSV:
+      convert_data()
+    else:
+      import atpy
+      write_cache( atpy.Table( TR_FITS ).data, TR_FITS, cache_file=cache_file, \
+                   manifest_file=manifest_file )
+  table = np.load( cache_file, mmap_mode='r' ).view( np.recarray )
+
+  return table
+
+
+def write_cache( data, source, cache_file=TR_CACHE, manifest_file=TR_MANIFEST ):
+  """
+  Saves a table to a binary .npy file that can be memory-mapped back in
+  without any parsing, along with a manifest recording the columns and
+  a fingerprint of the source file the table was generated from. The
+  table is written to a temporary file that is then renamed over the
+  cache, so tables already memory-mapped from the old cache by
+  load_transiting_table() are left intact.
+  """
+
+  data = np.asarray( data )
+  fd, tmp_file = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( cache_file ) ), suffix='.tmp' )
+  try:
+    ofile = os.fdopen( fd, 'wb' )
+    try:
+      np.save( ofile, data )
+    finally:
+      ofile.close()
+    os.rename( tmp_file, cache_file )
+  except:
+    os.remove( tmp_file )
+    raise
+  manifest = { 'source':source, 'fingerprint':file_fingerprint( source ), \
+               'cache':cache_file, 'nrows':len( data ), 'columns':list( data.dtype.names ) }
+  ofile = open( manifest_file, 'w' )
+  json.dump( manifest, ofile, indent=2, sort_keys=True )
+  ofile.close()
 
   return None
+
+
+def cache_valid( source, cache_file=TR_CACHE, manifest_file=TR_MANIFEST ):
+  """
+  Checks whether the binary cache is up-to-date with the source file. The
+  size and modification time of the source are checked first, and only if
+  these have changed is its contents hash compared, so that touching or
+  re-downloading an identical file does not force the cache to be rebuilt.
+  """
+
+  if ( os.path.isfile( cache_file )==False )+( os.path.isfile( manifest_file )==False ):
+    return False
+  ifile = open( manifest_file, 'r' )
+  try:
+    manifest = json.load( ifile )
+  except ValueError:
+    return False
+  finally:
+    ifile.close()
+  if manifest.get( 'source' )!=source:
+    return False
+  stat = os.stat( source )
+  fingerprint = manifest.get( 'fingerprint', {} )
+  if ( fingerprint.get( 'size' )==stat.st_size )*( fingerprint.get( 'mtime' )==stat.st_mtime ):
+    return True
+  new_fingerprint = file_fingerprint( source )
+  if new_fingerprint['sha1']!=fingerprint.get( 'sha1' ):
+    return False
+
+  # Contents are unchanged, so record the new modification time:
+  manifest['fingerprint'] = new_fingerprint
+  ofile = open( manifest_file, 'w' )
+  json.dump( manifest, ofile, indent=2, sort_keys=True )
+  ofile.close()
+
+  return True
+
+
+def file_fingerprint( filename ):
+  """
+  Returns a dictionary containing the size, modification time and SHA-1
+  hash of the contents of a file.
+  """
+
+  sha1 = hashlib.sha1()
+  ifile = open( filename, 'rb' )
+  for block in iter( lambda: ifile.read( 1048576 ), '' ):
+    sha1.update( block )
+  ifile.close()
+  stat = os.stat( filename )
+  fingerprint = { 'size':stat.st_size, 'mtime':stat.st_mtime, 'sha1':sha1.hexdigest() }
+
+  return fingerprint